@@ -0,0 +1,152 @@
+"""
+Compare the compression codecs on a corpus of real pastes.
+
+Each file is compressed on its own, the same way the app stores them,
+and the ratio and compress/decompress throughput are reported per codec.
+
+The corpus is read from the app's database, a directory of files, or both:
+
+    python benchmarks/compression.py --database ../entries/index.sql
+    python benchmarks/compression.py --corpus ./samples zlib:6 zstd:3 zstd:19 brotli:5
+
+A `zstd` dictionary can be trained on the corpus and then benchmarked:
+
+    python benchmarks/compression.py --corpus ./samples --train-dictionary code.dict
+    python benchmarks/compression.py --corpus ./samples --dictionary code.dict zstd:3
+"""
+
+import sqlite3, sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from paste._codecs import Codec, make_codec # noqa: E402
+
+DEFAULT_CODECS = ["zlib:1", "zlib:6", "zlib:9", "zstd:3", "zstd:9", "zstd:19", "brotli:5", "brotli:11"]
+
+def load_database(path: str) -> list[bytes]:
+    "Load and decompress every file stored in the app's database."
+
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri = True)
+    conn.row_factory = sqlite3.Row
+
+    columns = {row["name"] for row in conn.execute("SELECT name FROM pragma_table_info('files')")}
+
+    # Each distinct content is only counted once, like it's stored,
+    # except in databases from before blobs that keep it in `files`.
+    if "content" in columns:
+        codec_column = "codec" if "codec" in columns else "'zlib'"
+        query = f"SELECT content, {codec_column} AS codec FROM files"
+    else:
+        # Large files kept on disk aren't included.
+        query = "SELECT content, codec FROM blobs WHERE NOT external"
+
+    corpus: list[bytes] = []
+    codecs: dict[str, Codec] = {}
+
+    for row in conn.execute(query):
+        if row["codec"] not in codecs:
+            codecs[row["codec"]] = make_codec(row["codec"])
+
+        corpus.append(codecs[row["codec"]].decompress(row["content"]))
+
+    conn.close()
+
+    return corpus
+
+def load_directory(path: str) -> list[bytes]:
+    "Load every file under a directory."
+
+    return [
+        file.read_bytes()
+        for file in sorted(Path(path).rglob("*"))
+        if file.is_file()
+    ]
+
+def benchmark(name: str, level: int | None, dictionary_path: str | None, corpus: list[bytes], rounds: int) -> dict[str, float]:
+    "Time compressing and decompressing every file in the corpus with one codec."
+
+    codec = make_codec(name, level, dictionary_path)
+
+    total_in = sum(len(data) for data in corpus)
+    compressed: list[bytes] = []
+
+    compress_time = float("inf")
+
+    for _ in range(rounds):
+        start = perf_counter()
+        compressed = [codec.compress(data) for data in corpus]
+        compress_time = min(compress_time, perf_counter() - start)
+
+    decompress_time = float("inf")
+
+    for _ in range(rounds):
+        start = perf_counter()
+
+        for data in compressed:
+            codec.decompress(data)
+
+        decompress_time = min(decompress_time, perf_counter() - start)
+
+    total_out = sum(len(data) for data in compressed)
+
+    return {
+        "ratio": total_in / total_out if total_out else 0.0,
+        "compress_mb_s": total_in / compress_time / 1e6 if compress_time else 0.0,
+        "decompress_mb_s": total_in / decompress_time / 1e6 if decompress_time else 0.0,
+        "stored_bytes": total_out
+    }
+
+def main() -> None:
+    parser = ArgumentParser(description = "Compare compression codecs on a corpus of real pastes.")
+    parser.add_argument("codecs", nargs = "*", default = DEFAULT_CODECS, help = "codecs to compare, as name:level")
+    parser.add_argument("--database", help = "the app's SQLite database to take pastes from")
+    parser.add_argument("--corpus", help = "a directory of files to use as pastes")
+    parser.add_argument("--dictionary", help = "a trained zstd dictionary to benchmark with")
+    parser.add_argument("--train-dictionary", metavar = "PATH", help = "train a zstd dictionary on the corpus and save it")
+    parser.add_argument("--dictionary-size", type = int, default = 112_640, help = "the size of dictionary to train, in bytes")
+    parser.add_argument("--rounds", type = int, default = 3, help = "how many times to time each codec (best is kept)")
+    args = parser.parse_args()
+
+    corpus: list[bytes] = []
+
+    if args.database:
+        corpus += load_database(args.database)
+
+    if args.corpus:
+        corpus += load_directory(args.corpus)
+
+    if not corpus:
+        parser.error("no pastes to benchmark - give a --database or --corpus.")
+
+    print(f"Corpus: {len(corpus)} files, {sum(map(len, corpus)):,} bytes\n")
+
+    if args.train_dictionary:
+        import zstandard # type: ignore
+
+        dictionary = zstandard.train_dictionary(args.dictionary_size, corpus)
+        Path(args.train_dictionary).write_bytes(dictionary.as_bytes())
+
+        print(f"Trained a {len(dictionary.as_bytes()):,} byte dictionary into {args.train_dictionary}.")
+        return
+
+    print(f"{'codec':<12}{'ratio':>8}{'compress MB/s':>16}{'decompress MB/s':>18}{'stored bytes':>16}")
+
+    for spec in args.codecs:
+        name, _, level = spec.partition(":")
+
+        try:
+            result = benchmark(name, int(level) if level else None, args.dictionary, corpus, args.rounds)
+        except ImportError as e:
+            print(f"{spec:<12}skipped ({e.name} is not installed)")
+            continue
+
+        print(
+            f"{spec:<12}{result['ratio']:>8.2f}{result['compress_mb_s']:>16.1f}"
+            f"{result['decompress_mb_s']:>18.1f}{result['stored_bytes']:>16,}"
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,498 @@
+"""
+Load-test every backend endpoint against a throwaway database.
+
+This starts the app in a subprocess on a temporary SQLite file, seeds it
+with pastes, then drives each endpoint at a fixed concurrency and reports
+throughput and p50/p99/p999 latency. Rate limits are turned off so the
+service itself is measured rather than the throttle.
+
+    python benchmarks/load.py
+    python benchmarks/load.py --pastes 50000 --concurrency 64 --duration 20 --output run.json
+    python benchmarks/load.py --endpoints get raw --file-size 20000 --compressibility 0.9
+    python benchmarks/load.py --endpoints get_during_create --file-size 200000 --worker-pool none
+
+`get_during_create` measures `/get/` while a burst of `/create/` calls
+runs alongside it, so its tail latency shows how much compressing big
+uploads holds up everything else. Compare `--worker-pool` settings.
+
+Results are printed as a table and, with `--output`, written as JSON so
+runs can be compared over time.
+"""
+
+import asyncio, hashlib, json, os, random, socket, sqlite3, string, subprocess, sys, tempfile, zlib
+from argparse import ArgumentParser, Namespace
+from datetime import datetime as dt, timedelta as td
+from pathlib import Path
+from time import perf_counter, time
+from typing import Any, Awaitable, Callable
+
+BACKEND = Path(__file__).resolve().parent.parent
+
+ENDPOINTS = ["create", "create_raw", "create_batch", "get", "get_batch", "get_during_create", "raw", "download", "update", "delete"]
+
+WORDS = [
+    "def", "return", "import", "self", "None", "print", "async", "await", "class",
+    "for", "in", "if", "else", "value", "result", "items", "data", "config", "=", "()"
+]
+
+# =================================================================================================
+
+def generate_content(size: int, compressibility: float, rng: random.Random) -> str:
+    """
+    Generate `size` characters of text, where roughly `compressibility`
+    of it is drawn from a small vocabulary (and so compresses well) and
+    the rest is random letters.
+    """
+
+    parts: list[str] = []
+    length = 0
+
+    while length < size:
+        if rng.random() < compressibility:
+            part = rng.choice(WORDS) + (" " if rng.random() < 0.9 else "\n")
+        else:
+            part = "".join(rng.choices(string.ascii_letters + string.digits, k = 8)) + " "
+
+        parts.append(part)
+        length += len(part)
+
+    return "".join(parts)[:size]
+
+def generate_files(args: Namespace, rng: random.Random) -> list[tuple[str | None, str]]:
+    "Generate the files for one paste."
+
+    return [
+        (f"file{i}.py" if i % 2 else None, generate_content(args.file_size, args.compressibility, rng))
+        for i in range(args.files_per_paste)
+    ]
+
+def random_id(length: int, rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_letters + string.digits, k = length))
+
+def seed(database: str, args: Namespace, rng: random.Random) -> list[tuple[str, str]]:
+    """
+    Insert `args.pastes` pastes straight into the database.
+
+    Returns
+    -------
+    `list[tuple[str, str]]`
+        the paste ID and removal ID of each seeded paste.
+    """
+
+    from database import paste_digest
+    from utils import Config
+
+    conn = sqlite3.connect(database, isolation_level = None)
+    conn.execute("PRAGMA foreign_keys = ON")
+
+    now = dt.now()
+    expiration = int((now + td(days = 1)).timestamp())
+    seeded: list[tuple[str, str]] = []
+
+    # A handful of distinct pastes is enough to cover the
+    # data shape; generating each one uniquely is slow.
+    templates = [generate_files(args, rng) for _ in range(min(args.pastes, 50))] or [[]]
+
+    conn.execute("BEGIN")
+
+    for _ in range(args.pastes):
+        paste_id = random_id(Config.PASTE_ID_LENGTH, rng)
+        removal_id = random_id(Config.REMOVAL_ID_LENGTH, rng)
+
+        rows = []
+
+        for position, (filename, content) in enumerate(rng.choice(templates), start = 1):
+            encoded = content.encode()
+            digest = hashlib.sha256(encoded).digest()
+
+            # Pastes made from the same template share their blobs,
+            # the same way identical uploads do.
+            conn.execute(
+                "INSERT OR IGNORE INTO blobs (hash, content, size, crc32, codec) VALUES (?, ?, ?, ?, 'zlib')",
+                (digest, zlib.compress(encoded), len(encoded), zlib.crc32(encoded))
+            )
+
+            rows.append((paste_id, filename, position, digest))
+
+        conn.execute(
+            "INSERT INTO pastes (id, expiration, removal_id, modified, digest) VALUES (?, ?, ?, ?, ?)",
+            (paste_id, expiration, removal_id, int(now.timestamp()), paste_digest((row[1], row[3]) for row in rows))
+        )
+
+        conn.executemany(
+            "INSERT INTO files (id, filename, position, hash) VALUES (?, ?, ?, ?)",
+            rows
+        )
+
+        seeded.append((paste_id, removal_id))
+
+    conn.execute("COMMIT")
+    conn.close()
+
+    return seeded
+
+# =================================================================================================
+
+class HTTPClient:
+    """
+    A minimal keep-alive HTTP/1.1 client, so the benchmark
+    doesn't depend on (or measure) a third-party client.
+    """
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+
+    async def request(self, method: str, path: str, body: bytes = b"", headers: dict[str, str] | None = None) -> tuple[int, bytes]:
+        "Send a request and read back the status code and body."
+
+        if self.writer is None or self.reader is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+
+        # Sanic warns about an unread body on any GET that says it has one, even of 0 bytes.
+        if body or method not in ("GET", "HEAD"):
+            head += f"Content-Length: {len(body)}\r\n"
+
+        for name, value in (headers or {}).items():
+            head += f"{name}: {value}\r\n"
+
+        self.writer.write(head.encode() + b"\r\n" + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+
+        if not status_line:
+            await self.close()
+            raise ConnectionError("server closed the connection.")
+
+        status = int(status_line.split()[1])
+        response_headers: dict[str, str] = {}
+
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode().partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding") == "chunked":
+            chunks: list[bytes] = []
+
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+
+                if size == 0:
+                    break
+
+                chunks.append(chunk[:-2])
+
+            data = b"".join(chunks)
+        else:
+            data = await self.reader.readexactly(int(response_headers.get("content-length", 0)))
+
+        if response_headers.get("connection") == "close":
+            await self.close()
+
+        return status, data
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+        self.reader = self.writer = None
+
+# =================================================================================================
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+async def drive(
+    name: str,
+    make_request: Callable[[HTTPClient], Awaitable[int] | None],
+    args: Namespace
+) -> dict[str, Any]:
+    """
+    Run `args.concurrency` clients against one endpoint for
+    `args.duration` seconds and summarise their latencies.
+
+    `make_request` returns `None` when it has run out of work.
+    Responses with an error status count as errors, along
+    with requests the connection failed partway through.
+    """
+
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    errors = 0
+    deadline = perf_counter() + args.duration
+
+    async def client() -> None:
+        nonlocal errors
+
+        http = HTTPClient("127.0.0.1", args.port)
+
+        try:
+            while perf_counter() < deadline:
+                request = make_request(http)
+
+                if request is None:
+                    return
+
+                start = perf_counter()
+
+                try:
+                    status = await request
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    errors += 1
+                    await http.close()
+                    continue
+
+                latencies.append(perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+                if status >= 400:
+                    errors += 1
+        finally:
+            await http.close()
+
+    start = perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = perf_counter() - start
+
+    latencies.sort()
+
+    return {
+        "endpoint": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "p999": percentile(latencies, 0.999) * 1000,
+            "max": latencies[-1] * 1000 if latencies else 0.0
+        }
+    }
+
+async def run_benchmarks(args: Namespace, seeded: list[tuple[str, str]], rng: random.Random) -> list[dict[str, Any]]:
+    "Drive each requested endpoint in turn."
+
+    paste_ids = [paste_id for paste_id, _ in seeded]
+    # Deletes use up pastes, so they get their own share that nothing else reads.
+    deletable = [removal_id for _, removal_id in seeded[len(seeded) // 2:]]
+    readable = paste_ids[:len(seeded) // 2] or paste_ids
+
+    bodies = [json.dumps({"files": generate_files(args, rng)}).encode() for _ in range(20)]
+    json_headers = {"Content-Type": "application/json"}
+
+    plain_bodies = [generate_content(args.file_size, args.compressibility, rng).encode() for _ in range(20)]
+    plain_headers = {"Content-Type": "text/plain"}
+
+    async def status_of(request: Awaitable[tuple[int, bytes]]) -> int:
+        status, _ = await request
+        return status
+
+    def create(http: HTTPClient) -> Awaitable[int]:
+        return status_of(http.request("POST", "/create/", rng.choice(bodies), json_headers))
+
+    def create_raw(http: HTTPClient) -> Awaitable[int]:
+        return status_of(http.request("POST", "/create/raw/?filename=file.py", rng.choice(plain_bodies), plain_headers))
+
+    def create_batch(http: HTTPClient) -> Awaitable[int]:
+        body = json.dumps({"pastes": [json.loads(rng.choice(bodies)) for _ in range(10)]}).encode()
+
+        return status_of(http.request("POST", "/create/batch", body, json_headers))
+
+    def get_batch(http: HTTPClient) -> Awaitable[int]:
+        body = json.dumps({"ids": rng.sample(readable, min(50, len(readable)))}).encode()
+
+        return status_of(http.request("POST", "/get/batch", body, json_headers))
+
+    def get(http: HTTPClient) -> Awaitable[int]:
+        return status_of(http.request("GET", f"/get/{rng.choice(readable)}"))
+
+    def raw(http: HTTPClient) -> Awaitable[int]:
+        return status_of(http.request("GET", f"/raw/{rng.choice(readable)}"))
+
+    def download(http: HTTPClient) -> Awaitable[int]:
+        return status_of(http.request("GET", f"/download/{rng.choice(readable)}"))
+
+    def update(http: HTTPClient) -> Awaitable[int]:
+        body = json.loads(rng.choice(bodies))
+        body["id"] = rng.choice(readable)
+
+        return status_of(http.request("PUT", "/update/", json.dumps(body).encode(), json_headers))
+
+    def delete(http: HTTPClient) -> Awaitable[int] | None:
+        if not deletable:
+            return None
+
+        return status_of(http.request("GET", f"/delete/{deletable.pop()}"))
+
+    drivers = {
+        "create": create,
+        "create_raw": create_raw,
+        "create_batch": create_batch,
+        "get": get,
+        "get_batch": get_batch,
+        "raw": raw,
+        "download": download,
+        "update": update,
+        "delete": delete
+    }
+
+    results: list[dict[str, Any]] = []
+
+    for name in args.endpoints:
+        if name == "get_during_create":
+            print("Benchmarking /get/ during a /create/ burst ...", file = sys.stderr)
+
+            # Only the reads are reported; the creates are the background load.
+            result, _ = await asyncio.gather(drive(name, get, args), drive("create", create, args))
+            results.append(result)
+            continue
+
+        print(f"Benchmarking /{name}/ ...", file = sys.stderr)
+        results.append(await drive(name, drivers[name], args))
+
+    return results
+
+# =================================================================================================
+
+def serve(args: Namespace) -> None:
+    "Run the app on the given database and port (in the subprocess)."
+
+    sys.path.insert(0, str(BACKEND))
+    os.chdir(BACKEND)
+
+    from utils import Config
+
+    Config.DATABASE_PATH = args.database
+    Config.RATE_LIMITS_ENABLED = args.rate_limits
+    Config.WORKER_POOL = args.worker_pool
+    Config.MAX_ENTRIES = max(Config.MAX_ENTRIES, args.pastes * 2 + 1_000_000)
+
+    from main import app
+
+    app.run(host = "127.0.0.1", port = args.port, access_log = False, single_process = True)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_for_server(port: int, process: subprocess.Popen[bytes], timeout: float = 30) -> None:
+    deadline = perf_counter() + timeout
+
+    while perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited before it started listening.")
+
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+
+    raise TimeoutError("the server didn't start listening in time.")
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = BACKEND, text = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main() -> None:
+    parser = ArgumentParser(description = "Load-test every backend endpoint against a throwaway database.")
+    parser.add_argument("--endpoints", nargs = "+", choices = ENDPOINTS, default = ENDPOINTS, help = "the endpoints to benchmark, in order")
+    parser.add_argument("--pastes", type = int, default = 10_000, help = "how many pastes to seed the database with")
+    parser.add_argument("--files-per-paste", type = int, default = 2, help = "how many files each paste has")
+    parser.add_argument("--file-size", type = int, default = 4_000, help = "how many characters each file has")
+    parser.add_argument("--compressibility", type = float, default = 0.7, help = "roughly how much of each file is repetitive, from 0 to 1")
+    parser.add_argument("--concurrency", type = int, default = 32, help = "how many clients send requests at once")
+    parser.add_argument("--duration", type = float, default = 10, help = "how many seconds to drive each endpoint for")
+    parser.add_argument("--rate-limits", action = "store_true", help = "keep the rate limits on")
+    parser.add_argument("--worker-pool", choices = ["thread", "process", "none"], default = "thread", help = "where the server runs compression work")
+    parser.add_argument("--seed", type = int, default = 0, help = "the random seed for generated pastes")
+    parser.add_argument("--output", help = "a path to write the results to as JSON")
+    parser.add_argument("--serve", action = "store_true", help = "(internal) run the server")
+    parser.add_argument("--database", help = "(internal) the database the server uses")
+    parser.add_argument("--port", type = int, default = 0, help = "(internal) the port the server listens on")
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+
+    sys.path.insert(0, str(BACKEND))
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        args.database = str(Path(directory) / "bench.sql")
+        args.port = free_port()
+
+        command = [
+            sys.executable, __file__, "--serve",
+            "--database", args.database,
+            "--port", str(args.port),
+            "--pastes", str(args.pastes),
+            "--worker-pool", args.worker_pool
+        ]
+
+        if args.rate_limits:
+            command.append("--rate-limits")
+
+        process = subprocess.Popen(command)
+
+        try:
+            # The server creates the schema on startup, so it's seeded afterwards.
+            asyncio.run(wait_for_server(args.port, process))
+
+            print(f"Seeding {args.pastes:,} pastes ...", file = sys.stderr)
+            seeded = seed(args.database, args, rng)
+
+            results = asyncio.run(run_benchmarks(args, seeded, rng))
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(f"\n{'endpoint':<20}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}")
+
+    for result in results:
+        latency = result["latency_ms"]
+
+        print(
+            f"{result['endpoint']:<20}{result['requests']:>10}{result['errors']:>8}"
+            f"{result['throughput_rps']:>10.1f}{latency['p50']:>10.2f}"
+            f"{latency['p99']:>10.2f}{latency['p999']:>10.2f}"
+        )
+
+    for result in results:
+        if result["errors"]:
+            statuses = ", ".join(f"{code}: {count}" for code, count in result["statuses"].items())
+            print(f"{result['endpoint']} statuses: {statuses}", file = sys.stderr)
+
+    if args.output:
+        report = {
+            "timestamp": time(),
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "parameters": {
+                key: value for key, value in vars(args).items()
+                if key not in ("serve", "database", "port", "output")
+            },
+            "results": results
+        }
+
+        Path(args.output).write_text(json.dumps(report, indent = 4))
+        print(f"\nWrote results to {args.output}.", file = sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Measure how long a fresh backend worker takes to start.
+
+Two numbers are tracked, since workers are restarted and autoscaled often:
+
+- the import time of `main`, from `python -X importtime`, with the
+  packages that cost the most. Reads are the only handlers imported up
+  front, so anything else showing up near the top is a regression.
+- the time from starting the server process to its first answered
+  request, and how much memory it holds by then.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 10 --top 20 --output startup.json
+
+Each measurement is taken `--runs` times and the median reported.
+"""
+
+import asyncio, json, subprocess, sys, tempfile
+from argparse import ArgumentParser, Namespace
+from collections import defaultdict
+from pathlib import Path
+from statistics import median
+from time import perf_counter, time
+from typing import Any
+
+from load import BACKEND, free_port, git_revision, HTTPClient
+
+# =================================================================================================
+
+def measure_imports() -> tuple[float, dict[str, float]]:
+    """
+    Import `main` in a fresh interpreter with `-X importtime`.
+
+    Returns
+    -------
+    `tuple[float, dict[str, float]]`
+        the total import time of `main` in milliseconds, and the
+        time spent in each top-level package's own modules.
+    """
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd = BACKEND,
+        capture_output = True,
+        text = True,
+        check = True
+    )
+
+    total = 0.0
+    packages: defaultdict[str, float] = defaultdict(float)
+
+    # Lines look like `import time:  self [us] | cumulative | imported package`.
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+
+        if not self_us.strip().isdigit():
+            continue
+
+        packages[name.strip().split(".")[0]] += int(self_us) / 1_000
+
+        if name.strip() == "main":
+            total = int(cumulative_us) / 1_000
+
+    return total, packages
+
+async def wait_for_first_response(port: int, process: subprocess.Popen[bytes], timeout: float = 60) -> None:
+    "Keep asking the server for `/metrics` until it answers."
+
+    deadline = perf_counter() + timeout
+
+    while perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited before it answered a request.")
+
+        http = HTTPClient("127.0.0.1", port)
+
+        try:
+            await http.request("GET", "/metrics")
+            return
+        except OSError:
+            await asyncio.sleep(0.01)
+        finally:
+            await http.close()
+
+    raise TimeoutError("the server didn't answer a request in time.")
+
+def resident_memory_mb(pid: int) -> float | None:
+    "Read a process's resident memory, where `/proc` is available."
+
+    try:
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None
+
+    for line in status.splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) / 1_024
+
+    return None
+
+def measure_first_request() -> tuple[float, float | None]:
+    """
+    Start the server on a throwaway database and time
+    how long it takes to answer its first request.
+
+    Returns
+    -------
+    `tuple[float, float | None]`
+        the time to first response in milliseconds, and
+        the server's resident memory in MB by then.
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        port = free_port()
+
+        command = [
+            sys.executable, str(BACKEND / "benchmarks" / "load.py"), "--serve",
+            "--database", str(Path(directory) / "startup.sql"),
+            "--port", str(port),
+            "--pastes", "0"
+        ]
+
+        started_at = perf_counter()
+        process = subprocess.Popen(command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+        try:
+            asyncio.run(wait_for_first_response(port, process))
+            elapsed = (perf_counter() - started_at) * 1_000
+
+            return elapsed, resident_memory_mb(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+
+def run(args: Namespace) -> dict[str, Any]:
+    import_totals: list[float] = []
+    package_times: defaultdict[str, list[float]] = defaultdict(list)
+
+    for _ in range(args.runs):
+        total, packages = measure_imports()
+        import_totals.append(total)
+
+        for package, ms in packages.items():
+            package_times[package].append(ms)
+
+    first_requests: list[float] = []
+    memory: list[float] = []
+
+    for _ in range(args.runs):
+        elapsed, rss = measure_first_request()
+        first_requests.append(elapsed)
+
+        if rss is not None:
+            memory.append(rss)
+
+    packages = sorted(
+        ((package, median(times)) for package, times in package_times.items()),
+        key = lambda item: item[1],
+        reverse = True
+    )
+
+    return {
+        "import_ms": median(import_totals),
+        "first_request_ms": median(first_requests),
+        "resident_mb": median(memory) if memory else None,
+        "packages_ms": dict(packages[:args.top])
+    }
+
+def main() -> None:
+    parser = ArgumentParser(description = "Measure how long a fresh backend worker takes to start.")
+    parser.add_argument("--runs", type = int, default = 5, help = "how many times to take each measurement")
+    parser.add_argument("--top", type = int, default = 15, help = "how many of the slowest packages to list")
+    parser.add_argument("--output", help = "a path to write the results to as JSON")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print(f"\n{'package':<30}{'self ms':>10}")
+
+    for package, ms in results["packages_ms"].items():
+        print(f"{package:<30}{ms:>10.1f}")
+
+    print(f"\nimport main:       {results['import_ms']:>8.1f} ms")
+    print(f"first response:    {results['first_request_ms']:>8.1f} ms")
+
+    if results["resident_mb"] is not None:
+        print(f"resident memory:   {results['resident_mb']:>8.1f} MB")
+
+    if args.output:
+        report = {
+            "timestamp": time(),
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "parameters": {"runs": args.runs},
+            "results": results
+        }
+
+        Path(args.output).write_text(json.dumps(report, indent = 4))
+        print(f"\nWrote results to {args.output}.", file = sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"A module for caching rendered pastes in memory."
+
+from collections import OrderedDict
+from time import monotonic
+from typing import NamedTuple
+
+type CachedFiles = list[tuple[str | None, str]]
+"A type alias for the decoded files of a paste, in position order."
+
+class PasteInfo(NamedTuple):
+    "What conditional requests and cache headers need from a paste's `pastes` row."
+
+    etag: str
+    modified: int
+    expiration: int
+
+class CachedPaste(NamedTuple):
+    """
+    A paste's validators and its responses, rendered once when it's
+    read from the database, so a cache hit is a lookup and a write.
+    """
+
+    info: PasteInfo
+
+    json: bytes
+    "The body for `/get/`."
+
+    raw: bytes
+    "The body for `/raw/` with every file."
+
+    raw_files: list[bytes]
+    "The body for `/raw/` with each single file, in position order."
+
+    raw_header_sizes: list[int]
+    "How many bytes at the start of each of `raw_files` are its `[filename]` line."
+
+class PasteCache:
+    """
+    A size-bounded LRU cache of rendered pastes, keyed by paste ID.
+
+    The bound is on the (approximate) number of bytes held, not the
+    number of entries, so a handful of large pastes can't crowd out
+    memory. Entries also expire after `ttl` seconds regardless of use.
+
+    Counters for hits, misses and evictions are kept so the cache
+    can be sized from real traffic.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # paste ID -> (expires at, size in bytes, paste)
+        self._entries: OrderedDict[str, tuple[float, int, CachedPaste]] = OrderedDict()
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.generation = 0
+        "Bumped by every invalidation, so a fill that raced one can tell."
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _size_of(paste: CachedPaste) -> int:
+        "Count the bytes of the responses in `paste`."
+
+        return len(paste.json) + len(paste.raw) + sum(map(len, paste.raw_files))
+
+    def get(self, paste_id: str) -> CachedPaste | None:
+        "Get the paste under `paste_id`, or `None` if it isn't cached."
+
+        entry = self._entries.get(paste_id)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, size, paste = entry
+
+        if expires_at <= monotonic():
+            del self._entries[paste_id]
+            self.current_bytes -= size
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(paste_id)
+        self.hits += 1
+
+        return paste
+
+    def put(self, paste_id: str, paste: CachedPaste, generation: int | None = None) -> None:
+        """
+        Cache the paste under `paste_id`, evicting the least recently used pastes to make room.
+
+        Pass the `generation` from before the paste was read, and it's
+        only cached if nothing was invalidated since. Otherwise an update
+        committed while it was being decompressed could be cached over.
+        """
+
+        if generation is not None and generation != self.generation:
+            return
+
+        size = self._size_of(paste)
+
+        # Never let one paste flush the whole cache.
+        if size > self.max_bytes:
+            return
+
+        self._remove(paste_id)
+
+        while self._entries and self.current_bytes + size > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last = False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+
+        self._entries[paste_id] = (monotonic() + self.ttl, size, paste)
+        self.current_bytes += size
+
+    def invalidate(self, paste_id: str) -> None:
+        "Remove the paste under `paste_id` from the cache, if it's present."
+
+        self.generation += 1
+        self._remove(paste_id)
+
+    def clear(self) -> None:
+        "Remove every paste from the cache."
+
+        self.generation += 1
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def _remove(self, paste_id: str) -> None:
+        entry = self._entries.pop(paste_id, None)
+
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+    def stats(self) -> dict[str, int]:
+        "Get the counters for this cache, to help size it."
+
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
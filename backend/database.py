@@ -0,0 +1,816 @@
+"A module for setting up the database and running transactions on it."
+
+import asqlite, logging, os
+from asqlite import Connection, Cursor, Pool
+from asyncio import Lock
+from contextlib import asynccontextmanager, AsyncExitStack
+from hashlib import sha256
+from locks import FileLock
+from metrics import Histogram, Metrics
+from paste._codecs import Codec, make_codec
+from sanic.exceptions import SanicException
+from sqlite3 import sqlite_version_info
+from time import perf_counter, time
+from typing import Any, AsyncIterator, Iterable, TYPE_CHECKING
+from zlib import crc32
+
+log = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    from utils import Config
+
+class TimedCursor:
+    "Wraps a cursor so time spent fetching rows is recorded."
+
+    __slots__ = ("cursor", "histogram")
+
+    def __init__(self, cursor: Cursor, histogram: Histogram) -> None:
+        self.cursor = cursor
+        self.histogram = histogram
+
+    async def fetchone(self) -> Any:
+        with self.histogram.time():
+            return await self.cursor.fetchone()
+
+    async def fetchall(self) -> list[Any]:
+        with self.histogram.time():
+            return await self.cursor.fetchall()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.cursor, name)
+
+class TimedConnection:
+    "Wraps a connection so time spent running SQL is recorded."
+
+    __slots__ = ("conn", "histogram")
+
+    def __init__(self, conn: Connection, histogram: Histogram) -> None:
+        self.conn = conn
+        self.histogram = histogram
+
+    async def execute(self, sql: str, *parameters: Any) -> TimedCursor:
+        with self.histogram.time():
+            cursor = await self.conn.execute(sql, *parameters)
+
+        return TimedCursor(cursor, self.histogram)
+
+    async def executemany(self, sql: str, parameters: Iterable[Any]) -> Any:
+        with self.histogram.time():
+            return await self.conn.executemany(sql, parameters)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.conn, name)
+
+@asynccontextmanager
+async def transaction(conn: Connection | TimedConnection) -> AsyncIterator[Connection | TimedConnection]:
+    """
+    Run everything inside the block as a single transaction on `conn`,
+    committing if it finishes and rolling back if anything is raised.
+
+    The write lock is taken up front (`BEGIN IMMEDIATE`) so a transaction
+    that reads before writing can't fail halfway through because another
+    writer got in first.
+
+    Parameters
+    ----------
+    conn: `Connection | TimedConnection`
+        the connection to run the transaction on.
+    """
+
+    await conn.execute("BEGIN IMMEDIATE")
+
+    try:
+        yield conn
+    except BaseException:
+        await conn.execute("ROLLBACK")
+        raise
+
+    await conn.execute("COMMIT")
+
+async def configure_connection(conn: Connection, configs: type['Config'], *, read_only: bool) -> None:
+    """
+    Set the per-connection PRAGMAs on a connection.
+
+    Parameters
+    ----------
+    conn: `Connection`
+        the connection to set up.
+    configs: `type[Config]`
+        the configuration the app is running with.
+    read_only: `bool`
+        whether the connection should refuse to write.
+    """
+
+    await conn.execute(f"PRAGMA mmap_size = {int(configs.DATABASE_MMAP_SIZE)}")
+    await conn.execute(f"PRAGMA cache_size = -{int(configs.DATABASE_CACHE_SIZE_IN_KB)}")
+
+    # Other workers' writers can hold the write lock for a moment.
+    await conn.execute(f"PRAGMA busy_timeout = {int(configs.DATABASE_BUSY_TIMEOUT_IN_MS)}")
+
+    if read_only:
+        await conn.execute("PRAGMA query_only = ON")
+    else:
+        await conn.execute("PRAGMA foreign_keys = ON")
+        await conn.execute("PRAGMA synchronous = NORMAL")
+
+        # Keeps `PRAGMA optimize` to sampling rather than reading whole indexes.
+        await conn.execute("PRAGMA analysis_limit = 400")
+
+# =================================================================================================
+
+class Writer:
+    """
+    The single connection every write to the database goes through.
+
+    SQLite only lets one writer in at a time anyway, so rather than
+    have writes contend for (and hold up) the pooled read connections,
+    they queue up here in the order they arrived.
+    """
+
+    def __init__(self, conn: Connection, max_queue_size: int, metrics: Metrics) -> None:
+        self.conn = TimedConnection(conn, metrics.stage("sql"))
+        self.max_queue_size = max_queue_size
+        self.wait_histogram = metrics.stage("pool_acquire")
+        self._lock = Lock()
+
+        self.queue_depth = 0
+        "The number of writes currently waiting for the connection."
+
+        self.max_queue_depth = 0
+        "The most writes that have been waiting at once."
+
+        self.writes = 0
+        "The number of writes that have been given the connection."
+
+        self.total_wait = 0.0
+        "The total number of seconds writes have waited for the connection."
+
+        self.max_wait = 0.0
+        "The longest a single write has waited for the connection, in seconds."
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[TimedConnection]:
+        """
+        Wait for the write connection to be free and hold it
+        for the duration of the block.
+
+        Raises
+        ------
+        `SanicException`
+            503: too many writes are already waiting.
+        """
+
+        if self.queue_depth >= self.max_queue_size:
+            raise SanicException("Too many writes in progress. Please try again later.", 503)
+
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        start = perf_counter()
+
+        try:
+            await self._lock.acquire()
+        finally:
+            self.queue_depth -= 1
+
+        waited = perf_counter() - start
+
+        self.writes += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.wait_histogram.observe(waited)
+
+        try:
+            yield self.conn
+        finally:
+            self._lock.release()
+
+    async def close(self) -> None:
+        "Close the write connection."
+
+        await self.conn.conn.close()
+
+    def stats(self) -> dict[str, float]:
+        "Get the queue and wait time counters for the write connection."
+
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "writes": self.writes,
+            "total_wait_seconds": self.total_wait,
+            "max_wait_seconds": self.max_wait
+        }
+
+class ReadPool:
+    """
+    A pool of read-only connections, which keeps track
+    of how long requests wait to get one.
+    """
+
+    def __init__(self, pool: Pool, size: int, metrics: Metrics) -> None:
+        self.pool = pool
+        self.size = size
+        self.wait_histogram = metrics.stage("pool_acquire")
+        self.sql_histogram = metrics.stage("sql")
+
+        self.in_use = 0
+        "The number of connections currently acquired."
+
+        self.acquires = 0
+        "The number of times a connection has been acquired."
+
+        self.total_wait = 0.0
+        "The total number of seconds spent waiting for a connection."
+
+        self.max_wait = 0.0
+        "The longest a single acquire has waited for a connection, in seconds."
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[TimedConnection]:
+        "Wait for a read connection to be free and hold it for the duration of the block."
+
+        start = perf_counter()
+
+        async with self.pool.acquire() as conn:
+            waited = perf_counter() - start
+
+            self.acquires += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.wait_histogram.observe(waited)
+
+            self.in_use += 1
+
+            try:
+                yield TimedConnection(conn, self.sql_histogram)
+            finally:
+                self.in_use -= 1
+
+    async def close(self) -> None:
+        "Close every connection in the pool."
+
+        await self.pool.close()
+
+    def stats(self) -> dict[str, float]:
+        "Get the utilisation and wait time counters for the pool."
+
+        return {
+            "size": self.size,
+            "in_use": self.in_use,
+            "acquires": self.acquires,
+            "total_wait_seconds": self.total_wait,
+            "max_wait_seconds": self.max_wait
+        }
+
+async def open_database(configs: type['Config'], metrics: Metrics) -> tuple[Writer, ReadPool]:
+    """
+    Open the write connection, bring the database up to date,
+    then open the pool of read-only connections.
+
+    Parameters
+    ----------
+    configs: `type[Config]`
+        the configuration the app is running with.
+    metrics: `Metrics`
+        where to record connection wait and SQL times.
+
+    Returns
+    -------
+    `tuple[Writer, ReadPool]`
+        the write connection and the read pool.
+    """
+
+    write_conn = await asqlite.connect(configs.DATABASE_PATH)
+    await configure_connection(write_conn, configs, read_only = False)
+
+    # Every worker starts at once, so they take turns migrating.
+    with FileLock(f"{configs.DATABASE_PATH}-migrate.lock"):
+        await migrate(write_conn, configs)
+
+    pool = await asqlite.create_pool(
+        f"file:{configs.DATABASE_PATH}?mode=ro",
+        size = configs.DATABASE_READER_COUNT,
+        uri = True
+    )
+
+    # Acquire every connection at once so each is set up exactly once.
+    async with AsyncExitStack() as stack:
+        for _ in range(configs.DATABASE_READER_COUNT):
+            conn = await stack.enter_async_context(pool.acquire())
+            await configure_connection(conn, configs, read_only = True)
+
+    return (
+        Writer(write_conn, configs.DATABASE_WRITE_QUEUE_SIZE, metrics),
+        ReadPool(pool, configs.DATABASE_READER_COUNT, metrics)
+    )
+
+# =================================================================================================
+
+AUTO_VACUUM_INCREMENTAL = 2
+"What `PRAGMA auto_vacuum` reads as once it's set to `INCREMENTAL`."
+
+async def storage_stats(conn: Connection | TimedConnection, path: str) -> dict[str, int]:
+    """
+    Read how the database file's space is used: its pages, how many
+    of them are free, and the size of its WAL. Each comes from a file
+    header or `stat`, so this is cheap enough to run on every scrape.
+    """
+
+    req = await conn.execute(
+        """
+        SELECT
+            (SELECT page_size FROM pragma_page_size()) AS 'page_size',
+            (SELECT page_count FROM pragma_page_count()) AS 'pages',
+            (SELECT freelist_count FROM pragma_freelist_count()) AS 'free_pages',
+            (SELECT auto_vacuum FROM pragma_auto_vacuum()) AS 'auto_vacuum'
+        """
+    )
+    row = await req.fetchone()
+
+    try:
+        wal_bytes = os.path.getsize(f"{path}-wal")
+    except FileNotFoundError:
+        wal_bytes = 0
+
+    return {
+        "page_size": row["page_size"],
+        "pages": row["pages"],
+        "free_pages": row["free_pages"],
+        "auto_vacuum": row["auto_vacuum"],
+        "wal_bytes": wal_bytes
+    }
+
+async def migrate(conn: Connection, configs: type['Config']) -> None:
+    """
+    Create the tables, indexes and triggers the app needs, and
+    add anything an existing database might be missing.
+
+    Every step is safe to run on every startup.
+
+    Parameters
+    ----------
+    conn: `Connection`
+        the write connection to the database.
+    configs: `type[Config]`
+        the configuration the app is running with.
+    """
+
+    # Freed pages are given back to the filesystem a few at a time by
+    # `BackgroundLoops`. Opening the database already wrote its header
+    # (`asqlite` turns on WAL first), so switching always takes a `VACUUM`.
+    # That's instant with no tables yet, but rewrites an existing database.
+    req = await conn.execute("PRAGMA auto_vacuum")
+
+    if (await req.fetchone())["auto_vacuum"] != AUTO_VACUUM_INCREMENTAL:
+        req = await conn.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+        empty = await req.fetchone() is None
+
+        if empty or configs.DATABASE_VACUUM_TO_CONVERT:
+            await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await conn.execute("VACUUM")
+
+            req = await conn.execute("PRAGMA auto_vacuum")
+
+            if (await req.fetchone())["auto_vacuum"] != AUTO_VACUUM_INCREMENTAL:
+                log.warning("Couldn't switch the database to incremental vacuuming, so free pages won't be given back.")
+        else:
+            log.warning(
+                "The database isn't set up for incremental vacuuming, so free pages won't be given back. "
+                "Set `Config.DATABASE_VACUUM_TO_CONVERT` for one start to switch it."
+            )
+
+    # Persistent, so only needs setting once.
+    await conn.execute("PRAGMA journal_mode = WAL")
+
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pastes (
+            id TEXT NOT NULL PRIMARY KEY,
+            expiration INT NOT NULL,
+            removal_id TEXT NOT NULL,
+            version INT NOT NULL DEFAULT 1,
+            modified INT NOT NULL DEFAULT 0,
+            digest BLOB
+        )
+        """
+    )
+
+    req = await conn.execute("SELECT name FROM pragma_table_info('pastes')")
+    paste_columns = {row["name"] for row in await req.fetchall()}
+
+    # The validators for conditional requests: `version` counts updates,
+    # `modified` is when the files last changed, and `digest` is from
+    # `paste_digest`. Older pastes have them filled in further down.
+    if "version" not in paste_columns:
+        await conn.execute("ALTER TABLE pastes ADD COLUMN version INT NOT NULL DEFAULT 1")
+        await conn.execute("ALTER TABLE pastes ADD COLUMN modified INT NOT NULL DEFAULT 0")
+        await conn.execute("ALTER TABLE pastes ADD COLUMN digest BLOB")
+
+    await conn.execute("CREATE INDEX IF NOT EXISTS pastes_by_expiration ON pastes (expiration)")
+
+    # New pastes rely on this to reject a taken removal ID.
+    await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS pastes_by_removal_id ON pastes (removal_id)")
+
+    # File contents, stored once however many pastes have them. `hash`
+    # is the SHA-256 of the uncompressed content, and `refs` is the
+    # number of `files` rows pointing at it.
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash BLOB NOT NULL PRIMARY KEY,
+            content BLOB NOT NULL,
+            size INT NOT NULL,
+            crc32 INT NOT NULL,
+            codec TEXT NOT NULL DEFAULT 'zlib',
+            refs INT NOT NULL DEFAULT 0,
+            external INT NOT NULL DEFAULT 0
+        )
+        """
+    )
+
+    req = await conn.execute("SELECT name FROM pragma_table_info('blobs')")
+    blob_columns = {row["name"] for row in await req.fetchall()}
+
+    # Set for blobs kept in a `FileStore` instead, which
+    # have an empty `content` and are always zlib.
+    if "external" not in blob_columns:
+        await conn.execute("ALTER TABLE blobs ADD COLUMN external INT NOT NULL DEFAULT 0")
+
+    # Lets the garbage collector find unreferenced blobs without a scan.
+    await conn.execute("CREATE INDEX IF NOT EXISTS blobs_unreferenced ON blobs (hash) WHERE refs = 0")
+
+    req = await conn.execute("SELECT name FROM pragma_table_info('files')")
+    old_columns = {row["name"] for row in await req.fetchall()}
+
+    async with transaction(conn):
+        # Databases from before blobs existed keep each file's content
+        # in `files` itself, so that table is set aside to be copied over.
+        if "content" in old_columns:
+            # Indexes and triggers go with a renamed table, and would keep the
+            # `IF NOT EXISTS` below from making them on the new one.
+            req = await conn.execute(
+                "SELECT type, name FROM sqlite_master WHERE tbl_name = 'files' AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+            )
+
+            for row in await req.fetchall():
+                await conn.execute(f"DROP {row['type'].upper()} {row['name']}")
+
+            await conn.execute("ALTER TABLE files RENAME TO old_files")
+
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT NOT NULL,
+                filename TEXT,
+                position INT NOT NULL DEFAULT 1,
+                hash BLOB NOT NULL,
+
+                FOREIGN KEY (id)
+                REFERENCES pastes (id)
+                    ON DELETE CASCADE
+            )
+            """
+        )
+
+        # Serves every lookup of a paste's files, in order,
+        # and the cascade when a paste is deleted.
+        await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS files_by_position ON files (id, position)")
+
+        await conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS files_refs_insert
+            AFTER INSERT ON files
+            BEGIN
+                UPDATE blobs SET refs = refs + 1 WHERE hash = NEW.hash;
+            END
+            """
+        )
+
+        # Blobs that drop to no references are left for
+        # `BackgroundLoops` to collect, in batches.
+        await conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS files_refs_delete
+            AFTER DELETE ON files
+            BEGIN
+                UPDATE blobs SET refs = refs - 1 WHERE hash = OLD.hash;
+            END
+            """
+        )
+
+        # For updates that rewrite a file in place rather than
+        # deleting it and inserting it again.
+        await conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS files_refs_update
+            AFTER UPDATE OF hash ON files
+            BEGIN
+                UPDATE blobs SET refs = refs + 1 WHERE hash = NEW.hash;
+                UPDATE blobs SET refs = refs - 1 WHERE hash = OLD.hash;
+            END
+            """
+        )
+
+        if "content" in old_columns:
+            await move_contents_to_blobs(conn, old_columns)
+
+        await fill_paste_digests(conn)
+
+    # A single-row table holding the number of pastes, kept current
+    # by triggers so creates don't have to run `COUNT(*)`. The capacity
+    # lives here too so the insert trigger can enforce it atomically.
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS paste_count (
+            id INT NOT NULL PRIMARY KEY CHECK (id = 0),
+            count INT NOT NULL,
+            capacity INT NOT NULL
+        )
+        """
+    )
+
+    await conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS pastes_count_insert
+        AFTER INSERT ON pastes
+        BEGIN
+            UPDATE paste_count SET count = count + 1;
+        END
+        """
+    )
+
+    await conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS pastes_count_delete
+        AFTER DELETE ON pastes
+        BEGIN
+            UPDATE paste_count SET count = count - 1;
+        END
+        """
+    )
+
+    # Writes are serialised, so this can't be overshot by concurrent creates.
+    await conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS pastes_capacity
+        BEFORE INSERT ON pastes
+        WHEN (SELECT count >= capacity FROM paste_count)
+        BEGIN
+            SELECT RAISE(ABORT, 'paste capacity reached');
+        END
+        """
+    )
+
+    # Pastes that were updated or deleted, for other workers to
+    # drop from their caches. `AUTOINCREMENT`, so `seq` never goes
+    # backwards when old rows are cleared out.
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS paste_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL,
+            changed_at INT NOT NULL
+        )
+        """
+    )
+
+    await conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS pastes_changes_update
+        AFTER UPDATE OF version ON pastes
+        BEGIN
+            INSERT INTO paste_changes (id, changed_at) VALUES (NEW.id, CAST(strftime('%s', 'now') AS INT));
+        END
+        """
+    )
+
+    await conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS pastes_changes_delete
+        AFTER DELETE ON pastes
+        BEGIN
+            INSERT INTO paste_changes (id, changed_at) VALUES (OLD.id, CAST(strftime('%s', 'now') AS INT));
+        END
+        """
+    )
+
+    await migrate_search(conn)
+
+    await conn.execute(
+        "INSERT OR IGNORE INTO paste_count (id, count, capacity) VALUES (0, 0, ?)",
+        configs.MAX_ENTRIES
+    )
+
+    # The compressed bytes of file content stored (counting each
+    # blob once), kept alongside the count for the `/metrics` endpoint.
+    req = await conn.execute("SELECT name FROM pragma_table_info('paste_count')")
+
+    if "stored_bytes" not in {row["name"] for row in await req.fetchall()}:
+        await conn.execute("ALTER TABLE paste_count ADD COLUMN stored_bytes INT NOT NULL DEFAULT 0")
+
+    await conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS blobs_bytes_insert
+        AFTER INSERT ON blobs
+        BEGIN
+            UPDATE paste_count SET stored_bytes = stored_bytes + length(NEW.content);
+        END
+        """
+    )
+
+    await conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS blobs_bytes_delete
+        AFTER DELETE ON blobs
+        BEGIN
+            UPDATE paste_count SET stored_bytes = stored_bytes - length(OLD.content);
+        END
+        """
+    )
+
+    await conn.execute(
+        """
+        UPDATE paste_count SET
+            count = (SELECT COUNT(*) FROM pastes),
+            stored_bytes = (SELECT COALESCE(SUM(length(content)), 0) FROM blobs),
+            capacity = ?
+        """,
+        configs.MAX_ENTRIES
+    )
+
+
+async def migrate_search(conn: Connection) -> None:
+    """
+    Create the full-text search index over file names and contents,
+    and the queue of pastes waiting to be (re)indexed.
+
+    The index is contentless, so it doesn't keep a second, uncompressed
+    copy of every file. `search_docs` maps its rows back to files.
+
+    Rows of a contentless index can only be deleted by rowid from SQLite
+    3.43. Before that, deleting one takes the text it was indexed with,
+    so older versions keep that text in the index instead.
+    """
+
+    req = await conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'search_index'")
+    exists = bool(await req.fetchall())
+
+    if sqlite_version_info >= (3, 43, 0):
+        options = ", content = '', contentless_delete = 1"
+    else:
+        options = ""
+
+    async with transaction(conn):
+        await conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5 (filename, content{options})")
+
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS search_docs (
+                docid INTEGER PRIMARY KEY,
+                id TEXT NOT NULL,
+                position INT NOT NULL
+            )
+            """
+        )
+
+        await conn.execute("CREATE INDEX IF NOT EXISTS search_docs_by_id ON search_docs (id)")
+
+        # Pastes that were created, updated or deleted since the indexer
+        # last ran. Filled by triggers, so writes only pay for one insert.
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS search_queue (
+                seq INTEGER PRIMARY KEY,
+                id TEXT NOT NULL
+            )
+            """
+        )
+
+        for name, event, row in (
+            ("pastes_search_insert", "INSERT", "NEW"),
+            ("pastes_search_update", "UPDATE OF version", "NEW"),
+            ("pastes_search_delete", "DELETE", "OLD")
+        ):
+            await conn.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS {name}
+                AFTER {event} ON pastes
+                BEGIN
+                    INSERT INTO search_queue (id) VALUES ({row}.id);
+                END
+                """
+            )
+
+        # Pastes from before the index existed are indexed in the background.
+        if not exists:
+            await conn.execute("INSERT INTO search_queue (id) SELECT id FROM pastes")
+
+async def move_contents_to_blobs(conn: Connection, old_columns: set[str]) -> None:
+    """
+    Copy every file from `old_files` (which holds its own content)
+    into `files` and `blobs`, hashing and deduplicating on the way,
+    then drop it. This runs once, inside the migration's transaction.
+
+    Parameters
+    ----------
+    conn: `Connection`
+        the write connection to the database.
+    old_columns: `set[str]`
+        the columns `old_files` has, as older
+        versions might not have the codec.
+    """
+
+    codec = "codec" if "codec" in old_columns else "'zlib'"
+
+    codecs: dict[str, Codec] = {}
+    last_rowid = 0
+
+    # Paged by rowid so the whole table is never in memory at once.
+    while True:
+        req = await conn.execute(
+            f"""
+            SELECT rowid, id, filename, position, content, {codec} AS codec
+            FROM old_files
+            WHERE rowid > ?
+            ORDER BY rowid
+            LIMIT 500
+            """,
+            last_rowid
+        )
+        rows = await req.fetchall()
+
+        if not rows:
+            break
+
+        for row in rows:
+            if row["codec"] not in codecs:
+                codecs[row["codec"]] = make_codec(row["codec"])
+
+            data = codecs[row["codec"]].decompress(row["content"])
+            digest = sha256(data).digest()
+
+            await conn.execute(
+                "INSERT OR IGNORE INTO blobs (hash, content, size, crc32, codec) VALUES (?, ?, ?, ?, ?)",
+                digest, row["content"], len(data), crc32(data), row["codec"]
+            )
+
+            await conn.execute(
+                "INSERT INTO files (id, filename, position, hash) VALUES (?, ?, ?, ?)",
+                row["id"], row["filename"], row["position"], digest
+            )
+
+        last_rowid = rows[-1]["rowid"]
+
+    await conn.execute("DROP TABLE old_files")
+
+def paste_digest(files: Iterable[tuple[str | None, bytes]]) -> bytes:
+    """
+    Hash the filenames and blob hashes of a paste's
+    files, in order, into one digest for its ETag.
+
+    Parameters
+    ----------
+    files: `Iterable[tuple[str | None, bytes]]`
+        the filename and content hash of each file.
+    """
+
+    digest = sha256()
+
+    for filename, blob_hash in files:
+        if filename is None:
+            digest.update(b'\x00')
+        else:
+            # Length-prefixed, so different names can't run together the same way.
+            name = filename.encode()
+            digest.update(b'\x01' + len(name).to_bytes(4) + name)
+
+        digest.update(blob_hash)
+
+    return digest.digest()
+
+async def fill_paste_digests(conn: Connection) -> None:
+    """
+    Give pastes from before conditional requests were
+    supported their digest and a modification time.
+    This runs inside the migration's transaction.
+    """
+
+    now = int(time())
+
+    while True:
+        req = await conn.execute("SELECT id FROM pastes WHERE digest IS NULL LIMIT 500")
+        pastes = await req.fetchall()
+
+        if not pastes:
+            break
+
+        for paste in pastes:
+            req = await conn.execute(
+                "SELECT filename, hash FROM files WHERE id = ? ORDER BY position",
+                paste["id"]
+            )
+            files = await req.fetchall()
+
+            await conn.execute(
+                "UPDATE pastes SET digest = ?, modified = ? WHERE id = ?",
+                paste_digest((row["filename"], row["hash"]) for row in files), now, paste["id"]
+            )
@@ -0,0 +1,126 @@
+"""
+A module for rate limiting clients by address, with a token bucket
+for each class of route (`create`, `get`, ...) a client uses.
+
+The buckets live in a fixed-size table of doubles, memory-mapped from a
+file next to the database, so every Sanic worker on the host counts
+against the same buckets and memory never grows with the number of
+clients. A check hashes the address, looks at the few slots it can go
+in and updates one in place.
+
+Workers update the table without locking, so two requests checked at
+the same moment on different workers can both take the last token.
+Limits are a little loose under races, never stuck.
+"""
+
+import os
+from locks import FileLock
+from mmap import mmap
+from time import time
+from zlib import crc32
+
+WAYS = 4
+"How many slots a client's bucket can be kept in."
+
+FIELDS = 3
+"How many doubles each slot takes: the client's tag, its tokens and when they were counted."
+
+class RateLimiter:
+    """
+    Token buckets for clients, kept in a table of `slots` slots.
+
+    `budgets` maps each class of route to how many requests a client
+    can make in a burst, and how many seconds it takes for that many
+    tokens to come back.
+
+    A bucket that's been idle long enough to fill up is the same as
+    no bucket at all, so idle clients need no sweeping: when all of
+    an address's slots are taken, the one that's gone longest without
+    a request is reused.
+    """
+
+    def __init__(self, path: str, slots: int, budgets: dict[str, tuple[int, int]]) -> None:
+        self.names = {name: index for index, name in enumerate(budgets)}
+        "The index of each route class, which seeds its clients' tags."
+
+        self.capacities = [float(requests) for requests, _ in budgets.values()]
+        self.rates = [requests / seconds for requests, seconds in budgets.values()]
+
+        # A power of two, so picking a set is a mask.
+        sets = 1 << max(slots // WAYS, 1).bit_length() - 1
+        self.mask = sets - 1
+
+        size = sets * WAYS * FIELDS * 8
+
+        # Only one worker sizes the file, so none maps it mid-resize.
+        with FileLock(f"{path}.lock"):
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+
+                self.mapped = mmap(fd, size)
+            finally:
+                os.close(fd)
+
+        self.table = memoryview(self.mapped).cast("d")
+
+        self.limited = 0
+        "How many requests were refused by this worker."
+
+    def check(self, name: str, address: str) -> float:
+        """
+        Take a token from the bucket `address` has for the route class `name`.
+
+        Returns
+        -------
+        `float`
+            0 if the request can go ahead, otherwise how many
+            seconds until the bucket has a token again.
+        """
+
+        index = self.names[name]
+        capacity = self.capacities[index]
+        rate = self.rates[index]
+
+        table = self.table
+        now = time()
+
+        tag = crc32(address.encode(), index)
+        start = (tag & self.mask) * WAYS * FIELDS
+
+        victim = start
+        oldest = now
+
+        for slot in range(start, start + WAYS * FIELDS, FIELDS):
+            if table[slot] == tag:
+                break
+
+            if table[slot + 2] < oldest:
+                victim = slot
+                oldest = table[slot + 2]
+        else:
+            slot = victim
+
+            table[slot] = tag
+            table[slot + 1] = capacity
+
+        # Clamped, in case the clock has gone backwards.
+        tokens = min(capacity, table[slot + 1] + max(now - table[slot + 2], 0) * rate)
+
+        if tokens < 1:
+            self.limited += 1
+            return (1 - tokens) / rate
+
+        table[slot + 1] = tokens - 1
+        table[slot + 2] = now
+
+        return 0
+
+    def close(self) -> None:
+        "Unmap the table."
+
+        self.table.release()
+        self.mapped.close()
@@ -0,0 +1,75 @@
+"""
+A module for locks shared by every Sanic worker on the host, so work that
+must only happen once (migrating the database, running the background
+loops) does, however many workers are started with `sanic --workers N`.
+
+The locks are `flock`s on files next to the database, so the operating
+system releases them if the worker holding one dies. Platforms without
+`fcntl` only run a single worker, so there the locks always succeed.
+"""
+
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class FileLock:
+    "An exclusive lock on a file, held by one process at a time."
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.fd: int | None = None
+
+    @property
+    def held(self) -> bool:
+        "Whether this process holds the lock."
+
+        return self.fd is not None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Take the lock, waiting for it if `blocking` is set.
+
+        Returns
+        -------
+        `bool`
+            whether the lock is now held.
+        """
+
+        if self.fd is not None:
+            return True
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+
+        # Only there to tell which worker has it.
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+
+        self.fd = fd
+        return True
+
+    def release(self) -> None:
+        "Let go of the lock, if it's held."
+
+        if self.fd is None:
+            return
+
+        # Closing the file releases the lock.
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.release()
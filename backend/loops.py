@@ -0,0 +1,114 @@
+"""
+A module for running a coroutine method over and over on an interval,
+in its own `asyncio` task, for the loops in `BackgroundLoops`.
+
+It covers what the app used from `discord.ext.tasks`: `start`, `stop`
+(finish the current run, then stop) and `cancel`, and each instance
+getting its own loop.
+"""
+
+import logging
+from asyncio import CancelledError, create_task, sleep, Task
+from time import monotonic
+from typing import Any, Awaitable, Callable
+
+log = logging.getLogger(__name__)
+
+type LoopFunction = Callable[[Any], Awaitable[None]]
+"A type alias for the methods loops run."
+
+class Loop:
+    """
+    Runs a coroutine method every `interval` seconds, counted
+    from the start of each run, until it's stopped or cancelled.
+
+    Made by decorating a method with `loop`. Looking it up on an
+    instance gives that instance its own copy, so loops on different
+    instances run (and stop) independently.
+
+    An exception from a run is logged and the loop carries on, so
+    one failed run doesn't stop (say) expired pastes being deleted.
+    """
+
+    def __init__(self, function: LoopFunction, interval: float) -> None:
+        self.function = function
+        self.interval = interval
+        self.name = function.__name__
+
+        self.instance: Any = None
+        self.task: Task[None] | None = None
+
+        self.stopping = False
+        "Whether to stop once the current run finishes."
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
+
+    def __get__(self, instance: Any, owner: type) -> 'Loop':
+        if instance is None:
+            return self
+
+        bound = Loop(self.function, self.interval)
+        bound.name = self.name
+        bound.instance = instance
+
+        # Found in the instance's `__dict__` from now on, before this.
+        setattr(instance, self.name, bound)
+
+        return bound
+
+    def is_running(self) -> bool:
+        "Whether the loop's task is still going."
+
+        return self.task is not None and not self.task.done()
+
+    def start(self) -> None:
+        """
+        Start running the loop in a new task.
+
+        Raises
+        ------
+        `RuntimeError`
+            the loop is already running.
+        """
+
+        if self.is_running():
+            raise RuntimeError(f"loop '{self.name}' is already running.")
+
+        self.stopping = False
+        self.task = create_task(self.run(), name = f"loop-{self.name}")
+
+    def stop(self) -> None:
+        "Stop the loop once the current run finishes, which could be this one."
+
+        self.stopping = True
+
+    def cancel(self) -> None:
+        "Stop the loop straight away, even partway through a run."
+
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self) -> None:
+        while not self.stopping:
+            started_at = monotonic()
+
+            try:
+                await self.function(self.instance)
+            except CancelledError:
+                raise
+            except Exception:
+                log.exception("Loop '%s' failed; running it again next interval.", self.name)
+
+            if self.stopping:
+                return
+
+            await sleep(max(0, self.interval - (monotonic() - started_at)))
+
+def loop(*, seconds: float = 0, minutes: float = 0, hours: float = 0) -> Callable[[LoopFunction], Loop]:
+    "Turn a coroutine method into a `Loop` that runs on the given interval."
+
+    def decorator(function: LoopFunction) -> Loop:
+        return Loop(function, seconds + minutes * 60 + hours * 3_600)
+
+    return decorator
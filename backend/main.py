@@ -1,79 +1,184 @@
-from asqlite import create_pool
-from paste.create import create_new_paste
-from paste.delete import delete_paste_by_link
-from paste.download import download_paste_by_id
+from cache import PasteCache
+from database import open_database
+from limiter import RateLimiter
+from math import ceil
+from metrics import collect_values, Metrics
+from paste._codecs import Codecs
 from paste.get import get_paste_by_id, get_raw_paste_by_id
-from paste._types import CreateRequest, GetResponse, UpdateRequest
-from paste.update import update_existing_paste
+from sanic.exceptions import SanicException
 from sanic.request import Request
-from sanic.response import HTTPResponse, JSONResponse
-from sanic_ext import validate
-from sanic_limiter import Limiter, get_remote_address # type: ignore
+from sanic.response import HTTPResponse, JSONResponse, text
+from storage import FileStore
+from time import perf_counter
 from utils import BackgroundLoops, Config, MyAPI
+from workers import WorkerPool
+
+# Only reads are imported up front. The other handlers (and `pydantic`,
+# which validates their bodies) are imported by their routes the first
+# time they're used, so a fresh worker starts serving sooner and doesn't
+# hold modules it never needs. `benchmarks/startup.py` tracks this.
 
 app = MyAPI("pastolotl-backend")
-limiter = Limiter(app, key_func = get_remote_address)
+
+# Nothing here uses `sanic_ext`, so it isn't loaded even if it's installed.
+app.config.AUTO_EXTEND = False
 
 @app.before_server_start
 async def before_start(app: MyAPI) -> None:
     app.ctx.configs = Config
+    app.ctx.metrics = Metrics()
+    app.ctx.workers = WorkerPool(Config.WORKER_POOL, Config.WORKER_POOL_SIZE, Config.WORKER_POOL_THRESHOLD)
+    app.ctx.codecs = Codecs(
+        Config.COMPRESSION_CODEC,
+        Config.COMPRESSION_LEVEL,
+        Config.COMPRESSION_ZSTD_DICTIONARY,
+        app.ctx.metrics,
+        app.ctx.workers
+    )
     
-    app.ctx.pool = await create_pool("../entries/index.sql")
+    app.ctx.writer, app.ctx.pool = await open_database(Config, app.ctx.metrics)
+
+    app.ctx.store = None
+
+    if Config.LARGE_FILE_DIRECTORY is not None:
+        app.ctx.store = FileStore(Config.LARGE_FILE_DIRECTORY, Config.LARGE_FILE_CHUNK_SIZE, Config.LARGE_FILE_COMPRESSION_LEVEL)
+
+    app.ctx.cache = PasteCache(Config.CACHE_MAX_BYTES, Config.CACHE_TTL_IN_SECONDS)
+
+    # Turned off for benchmarks.
+    app.ctx.limiter = None
+
+    if Config.RATE_LIMITS_ENABLED:
+        app.ctx.limiter = RateLimiter(f"{Config.DATABASE_PATH}-ratelimit", Config.RATE_LIMIT_SLOTS, Config.RATE_LIMITS)
     
     app.ctx.loops = BackgroundLoops(app)
     app.ctx.loops.start()
 
 @app.after_server_stop
 async def after_end(app: MyAPI) -> None:
-    await app.ctx.pool.close()
-    
     app.ctx.loops.end()
 
-@app.post("/create/")
-@validate(json = CreateRequest)
-@limiter.limit("6/minute") # type: ignore # 10s per request
-async def app_create_new_paste(request: Request, body: CreateRequest) -> JSONResponse:
-    return await create_new_paste(app, body, request.url)
+    await app.ctx.pool.close()
+    await app.ctx.writer.close()
+
+    app.ctx.workers.close()
+
+    if app.ctx.limiter:
+        app.ctx.limiter.close()
+
+@app.on_request
+async def start_request_timer(request: Request) -> None:
+    request.ctx.started_at = perf_counter()
+
+@app.on_request
+async def check_rate_limit(request: Request) -> None:
+    # Routes name their class of rate limit with `ctx_rate_limit`.
+    if app.ctx.limiter is None or request.route is None:
+        return
+
+    name: str | None = getattr(request.route.ctx, "rate_limit", None)
+
+    if name is None:
+        return
+
+    wait = app.ctx.limiter.check(name, request.remote_addr or request.ip)
+
+    if wait:
+        raise SanicException("Too many requests.", 429, headers = {"Retry-After": str(ceil(wait))})
 
+@app.on_response
+async def record_request(request: Request, response: HTTPResponse) -> None:
+    started_at: float | None = getattr(request.ctx, "started_at", None)
 
-@app.get("/get/<paste_id>")
-@limiter.limit("20/minute") # type: ignore # 3s per request
-async def app_get_paste_by_id(request: Request, paste_id: str) -> GetResponse:
-    return await get_paste_by_id(app, paste_id)
+    if started_at is not None:
+        app.ctx.metrics.observe_request(
+            request.uri_template or "unmatched",
+            request.method,
+            response.status,
+            perf_counter() - started_at
+        )
 
-@app.get("/raw/<paste_id>")
-@limiter.limit("20/minute") # type: ignore # 3s per request
+@app.get("/metrics")
+async def app_metrics(request: Request) -> HTTPResponse:
+    return text(
+        app.ctx.metrics.render(await collect_values(app)),
+        content_type = "text/plain; version=0.0.4; charset=utf-8"
+    )
+
+@app.post("/create/", ctx_rate_limit = "create")
+async def app_create_new_paste(request: Request) -> JSONResponse:
+    from paste.create import create_new_paste
+    from paste._types import CreateRequest, parse_body
+
+    return await create_new_paste(app, parse_body(request, CreateRequest), request.url)
+
+@app.post("/create/raw/", stream = True, ctx_rate_limit = "create")
+async def app_create_streamed_paste(request: Request) -> JSONResponse:
+    from paste.create import create_streamed_paste
+
+    return await create_streamed_paste(app, request)
+
+@app.post("/create/batch", ctx_rate_limit = "create_batch")
+async def app_create_new_pastes(request: Request) -> JSONResponse:
+    from paste.create import create_new_pastes
+    from paste._types import BatchCreateRequest, parse_body
+
+    return await create_new_pastes(app, parse_body(request, BatchCreateRequest), request.url)
+
+
+@app.get("/get/<paste_id>", ctx_rate_limit = "get")
+async def app_get_paste_by_id(request: Request, paste_id: str) -> HTTPResponse:
+    return await get_paste_by_id(app, request, paste_id)
+
+@app.post("/get/batch", ctx_rate_limit = "get")
+async def app_get_pastes_by_ids(request: Request) -> HTTPResponse:
+    from paste.get import get_pastes_by_ids
+    from paste._types import BatchGetRequest, parse_body
+
+    return await get_pastes_by_ids(app, parse_body(request, BatchGetRequest))
+
+@app.get("/raw/<paste_id>", ctx_rate_limit = "get")
 async def app_get_raw_paste_by_id(request: Request, paste_id: str) -> HTTPResponse:
-    return await get_raw_paste_by_id(app, paste_id)
+    return await get_raw_paste_by_id(app, request, paste_id)
 
-@app.get("/raw/<paste_id>/<filepos>")
-@limiter.limit("20/minute") # type: ignore # 3s per request
+@app.get("/raw/<paste_id>/<filepos>", ctx_rate_limit = "get")
 async def app_get_raw_file_by_id(request: Request, paste_id: str, filepos: int) -> HTTPResponse:
-    return await get_raw_paste_by_id(app, paste_id, filepos)
+    return await get_raw_paste_by_id(app, request, paste_id, filepos)
+
+
+@app.get("/search/", ctx_rate_limit = "search")
+async def app_search_pastes(request: Request) -> HTTPResponse:
+    from paste.search import search_pastes
+
+    return await search_pastes(app, request)
 
 
-@app.get("/delete/<removal_id>")
-@limiter.limit("10/minute")  # type: ignore # 6s per request
+@app.get("/delete/<removal_id>", ctx_rate_limit = "delete")
 async def app_delete_paste_by_link(request: Request, removal_id: str) -> HTTPResponse:
+    from paste.delete import delete_paste_by_link
+
     return await delete_paste_by_link(app, removal_id)
 
 
-@app.put("/update/")
-@validate(json = UpdateRequest)
-@limiter.limit("3/minute") # type: ignore
-async def app_update_existing_paste(request: Request, body: UpdateRequest) -> None:
-    return await update_existing_paste(app, body)
+@app.put("/update/", ctx_rate_limit = "update")
+async def app_update_existing_paste(request: Request) -> JSONResponse:
+    from paste.update import update_existing_paste
+    from paste._types import parse_body, UpdateRequest
+
+    return await update_existing_paste(app, parse_body(request, UpdateRequest))
 
 
-@app.get("/download/<paste_id>")
-@limiter.limit("2/minute") # type: ignore
+@app.get("/download/<paste_id>", ctx_rate_limit = "download")
 async def app_download_paste_by_id(request: Request, paste_id: str) -> HTTPResponse:
-    return await download_paste_by_id(app, paste_id)
+    from paste.download import download_paste_by_id
 
-@app.get("/download/<paste_id>/<filepos>")
-@limiter.limit("2/minute") # type: ignore
+    return await download_paste_by_id(app, request, paste_id)
+
+@app.get("/download/<paste_id>/<filepos>", ctx_rate_limit = "download")
 async def app_download_single_paste_by_id(request: Request, paste_id: str, filepos: int) -> HTTPResponse:
-    return await download_paste_by_id(app, paste_id, filepos)
+    from paste.download import download_paste_by_id
+
+    return await download_paste_by_id(app, request, paste_id, filepos)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,217 @@
+"""
+A module for collecting metrics and exposing them in the
+Prometheus text format on the `/metrics` endpoint.
+
+Everything here is plain counters and fixed-bucket histograms,
+so recording is a few additions per observation and can be
+left on in production.
+"""
+
+from bisect import bisect_left
+from time import perf_counter
+from typing import Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from utils import MyAPI
+
+# Upper bounds (in seconds) for latency histograms, from 50µs to 10s.
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+STAGES = ("pool_acquire", "sql", "compress", "decompress", "zip_build", "serialize")
+"The stages of a request that are timed separately."
+
+class Timer:
+    "A context manager that records how long its block took into a histogram."
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: 'Histogram') -> None:
+        self.histogram = histogram
+
+    def __enter__(self) -> None:
+        self.start = perf_counter()
+
+    def __exit__(self, *_: Any) -> None:
+        self.histogram.observe(perf_counter() - self.start)
+
+class Histogram:
+    "A histogram with fixed bucket bounds."
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+
+        # The last count is for everything above the highest bound.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> Timer:
+        "Get a context manager that times its block into this histogram."
+
+        return Timer(self)
+
+    def render(self, name: str, labels: str) -> list[str]:
+        "Get the exposition lines for this histogram, with cumulative buckets."
+
+        separator = "," if labels else ""
+        lines: list[str] = []
+        cumulative = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+
+        return lines
+
+class Metrics:
+    "Holds every metric the app records."
+
+    def __init__(self) -> None:
+        self.request_latency: dict[str, Histogram] = {}
+        "Request latency histograms by route."
+
+        self.requests: dict[tuple[str, str, int], int] = {}
+        "Request counts by route, method and status code."
+
+        self.stages: dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+        "Latency histograms for each stage of handling a request."
+
+    def stage(self, name: str) -> Histogram:
+        "Get the histogram for a stage from `STAGES`."
+
+        return self.stages[name]
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float) -> None:
+        "Record a finished request."
+
+        histogram = self.request_latency.get(route)
+
+        if histogram is None:
+            histogram = self.request_latency[route] = Histogram()
+
+        histogram.observe(seconds)
+
+        key = (route, method, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def render(self, values: dict[str, tuple[str, float]]) -> str:
+        """
+        Get every metric in the Prometheus text format.
+
+        Parameters
+        ----------
+        values: `dict[str, tuple[str, float]]`
+            point-in-time values to include, as name ->
+            (help text, value). Names ending in `_total`
+            are exposed as counters, the rest as gauges.
+
+        Returns
+        -------
+        `str`
+            the exposition text.
+        """
+
+        lines = [
+            "# HELP paste_requests_total Requests handled, by route, method and status.",
+            "# TYPE paste_requests_total counter"
+        ]
+
+        for (route, method, status), count in self.requests.items():
+            lines.append(f'paste_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+
+        lines += [
+            "# HELP paste_request_seconds Time to respond to a request (to the first byte for streamed responses).",
+            "# TYPE paste_request_seconds histogram"
+        ]
+
+        for route, histogram in self.request_latency.items():
+            lines += histogram.render("paste_request_seconds", f'route="{route}"')
+
+        lines += [
+            "# HELP paste_stage_seconds Time spent in each stage of handling requests.",
+            "# TYPE paste_stage_seconds histogram"
+        ]
+
+        for stage, histogram in self.stages.items():
+            lines += histogram.render("paste_stage_seconds", f'stage="{stage}"')
+
+        for name, (description, value) in values.items():
+            kind = "counter" if name.endswith("_total") else "gauge"
+
+            lines += [
+                f"# HELP {name} {description}",
+                f"# TYPE {name} {kind}",
+                f"{name} {value}"
+            ]
+
+        return "\n".join(lines) + "\n"
+
+async def collect_values(app: 'MyAPI') -> dict[str, tuple[str, float]]:
+    """
+    Read the point-in-time values for the `/metrics` endpoint.
+
+    Everything comes from counters the app already keeps, plus a
+    single-row read and an indexed range count, so scraping stays
+    cheap at any table size.
+    """
+
+    # `database` imports this module, so it can't be imported at the top.
+    from database import AUTO_VACUUM_INCREMENTAL, storage_stats
+
+    pool = app.ctx.pool.stats()
+    writer = app.ctx.writer.stats()
+    cache = app.ctx.cache.stats()
+    workers = app.ctx.workers.stats()
+    loops = app.ctx.loops
+    limited = app.ctx.limiter.limited if app.ctx.limiter else 0
+
+    async with app.ctx.pool.acquire() as conn:
+        storage = await storage_stats(conn, app.ctx.configs.DATABASE_PATH)
+
+        req = await conn.execute("SELECT count, stored_bytes FROM paste_count")
+        counts = await req.fetchone()
+
+        # Range scan on `pastes_by_expiration`.
+        req = await conn.execute(
+            "SELECT COUNT(*) AS 'count' FROM pastes WHERE expiration <= CAST(strftime('%s', 'now') AS INT)"
+        )
+        backlog = await req.fetchone()
+
+    return {
+        "paste_count": ("Pastes currently stored.", counts["count"]),
+        "paste_stored_bytes": ("Compressed bytes of file content stored in the database.", counts["stored_bytes"]),
+        "paste_expiry_backlog": ("Pastes past their expiration that haven't been deleted yet.", backlog["count"]),
+        "paste_read_pool_size": ("Read connections in the pool.", pool["size"]),
+        "paste_read_pool_in_use": ("Read connections currently acquired.", pool["in_use"]),
+        "paste_read_pool_utilization": ("Fraction of read connections currently acquired.", pool["in_use"] / pool["size"]),
+        "paste_read_pool_wait_seconds_total": ("Total time spent waiting for a read connection.", pool["total_wait_seconds"]),
+        "paste_write_queue_depth": ("Writes waiting for the write connection.", writer["queue_depth"]),
+        "paste_write_wait_seconds_total": ("Total time writes spent waiting for the write connection.", writer["total_wait_seconds"]),
+        "paste_cache_entries": ("Pastes in the rendered paste cache.", cache["entries"]),
+        "paste_cache_bytes": ("Bytes held by the rendered paste cache.", cache["bytes"]),
+        "paste_cache_hits_total": ("Paste cache hits.", cache["hits"]),
+        "paste_cache_misses_total": ("Paste cache misses.", cache["misses"]),
+        "paste_cache_evictions_total": ("Paste cache evictions.", cache["evictions"]),
+        "paste_worker_inline_total": ("Compression calls run on the event loop.", workers["inline"]),
+        "paste_worker_offloaded_total": ("Compression calls sent to the worker pool.", workers["offloaded"]),
+        "paste_rate_limited_total": ("Requests refused by the rate limiter.", limited),
+        "paste_db_bytes": ("Size of the database file.", storage["pages"] * storage["page_size"]),
+        "paste_db_free_bytes": ("Space in the database file on its freelist, waiting to be vacuumed.", storage["free_pages"] * storage["page_size"]),
+        "paste_db_wal_bytes": ("Size of the write-ahead log.", storage["wal_bytes"]),
+        "paste_db_incremental_vacuum": ("Whether the database is set up for incremental vacuuming.", int(storage["auto_vacuum"] == AUTO_VACUUM_INCREMENTAL)),
+        "paste_db_vacuumed_bytes_total": ("Space this worker has given back to the filesystem.", loops.vacuumed_pages * storage["page_size"])
+    }
@@ -0,0 +1,301 @@
+"""
+A helper module for writing file contents into `blobs`.
+
+Each distinct content is stored once, keyed by its SHA-256, and
+`files` rows point at it. Contents already stored aren't compressed
+again, and compressing happens before the write connection is taken,
+so other writes don't queue up behind it. Large contents go to the
+`FileStore` when one is configured.
+"""
+
+from codecs import getincrementaldecoder
+from database import TimedConnection
+from hashlib import sha256
+from sanic.exceptions import BadRequest
+from storage import PendingFile
+from time import perf_counter
+from typing import NamedTuple
+from utils import MyAPI
+from zlib import crc32
+from ._codecs import make_codec
+
+class PreparedFile(NamedTuple):
+    "A file ready to be written, with its hash and checksum worked out."
+
+    filename: str | None
+    hash: bytes
+    data: bytes | None
+    "The uncompressed content, or `None` if it was streamed in."
+    compressed: bytes | None
+    "The compressed content, or `None` if a blob already had it."
+    size: int
+    crc32: int
+    codec: str
+    "The codec `compressed` was made with."
+    external: bool
+    "Whether the content is in the `FileStore`, leaving `compressed` empty."
+    pending: PendingFile | None = None
+    "A streamed-in file waiting to be moved into the `FileStore`."
+
+class StreamedFile:
+    """
+    A file read from a request body a chunk at a time, hashed,
+    checksummed and compressed as each chunk arrives, so the
+    uncompressed content is never held in memory all at once.
+
+    Once it passes `Config.LARGE_FILE_THRESHOLD`, and there's a
+    `FileStore`, the compressed output goes to a pending file in
+    it instead of memory. So it can be moved there partway, it's
+    compressed the way the `FileStore` compresses whenever there
+    is one.
+    """
+
+    def __init__(self, app: MyAPI, filename: str | None) -> None:
+        self.app = app
+        self.filename = filename
+
+        self.hash = sha256()
+        self.crc32 = 0
+        self.size = 0
+
+        # Catches invalid text without decoding it all at once.
+        self.validator = getincrementaldecoder("utf-8")()
+
+        self.store = app.ctx.store
+        self.codec = make_codec("zlib", app.ctx.configs.LARGE_FILE_COMPRESSION_LEVEL) if self.store else app.ctx.codecs.default
+        self.compressor = self.store.compressor() if self.store else self.codec.compressor()
+        self.compress_time = 0.0
+
+        self.chunks: list[bytes] = []
+        self.pending: PendingFile | None = None
+
+    def write(self, data: bytes) -> None:
+        """
+        Add the next chunk of the file.
+
+        Raises
+        ------
+        `BadRequest`
+            the file isn't valid UTF-8.
+        """
+
+        try:
+            self.validator.decode(data)
+        except UnicodeDecodeError:
+            raise BadRequest(f"File {self.filename or "???"} is not valid UTF-8.")
+
+        self.hash.update(data)
+        self.crc32 = crc32(data, self.crc32)
+        self.size += len(data)
+
+        start = perf_counter()
+        compressed = self.compressor.compress(data)
+        self.compress_time += perf_counter() - start
+
+        if self.pending is None and self.store is not None and self.size >= self.app.ctx.configs.LARGE_FILE_THRESHOLD:
+            self.pending = self.store.create()
+
+            for chunk in self.chunks:
+                self.pending.write(chunk)
+
+            self.chunks.clear()
+
+        if self.pending is not None:
+            self.pending.write(compressed)
+        elif compressed:
+            self.chunks.append(compressed)
+
+    def finish(self) -> PreparedFile:
+        """
+        Finish compressing the file.
+
+        Raises
+        ------
+        `BadRequest`
+            the file ends partway through a character.
+        """
+
+        try:
+            self.validator.decode(b'', final = True)
+        except UnicodeDecodeError:
+            raise BadRequest(f"File {self.filename or "???"} is not valid UTF-8.")
+
+        start = perf_counter()
+        compressed = self.compressor.flush()
+        self.compress_time += perf_counter() - start
+
+        self.app.ctx.metrics.stage("compress").observe(self.compress_time)
+
+        if self.pending is not None:
+            self.pending.write(compressed)
+            self.pending.index = self.compressor.index() # type: ignore
+            content = b''
+        else:
+            content = b''.join(self.chunks) + compressed
+
+        return PreparedFile(
+            self.filename,
+            self.hash.digest(),
+            None,
+            content,
+            self.size,
+            self.crc32,
+            self.codec.name,
+            self.pending is not None,
+            self.pending
+        )
+
+    def discard(self) -> None:
+        "Delete the pending file, if there is one and it wasn't committed."
+
+        if self.pending is not None:
+            self.pending.discard()
+
+async def store_content(app: MyAPI, digest: bytes, data: bytes) -> tuple[bytes, str, bool]:
+    """
+    Compress the content for a new blob.
+
+    Content of at least `Config.LARGE_FILE_THRESHOLD` bytes goes to
+    the `FileStore`, if there is one, and the blob's own `content`
+    is left empty.
+
+    Returns
+    -------
+    `tuple[bytes, str, bool]`
+        the `content` and `codec` for the blob,
+        and whether it's kept externally.
+    """
+
+    store = app.ctx.store
+
+    if store is not None and len(data) >= app.ctx.configs.LARGE_FILE_THRESHOLD:
+        with app.ctx.metrics.stage("compress").time():
+            await app.ctx.workers.run(len(data), store.write, digest, data)
+
+        return b'', "zlib", True
+
+    return await app.ctx.codecs.compress(data), app.ctx.codecs.default.name, False
+
+async def prepare_files(app: MyAPI, files: list[tuple[str | None, bytes]]) -> list[PreparedFile]:
+    """
+    Hash the given files and compress the ones
+    whose content isn't already stored.
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    files: `list[tuple[str | None, bytes]]`
+        the filename and encoded content of each file.
+
+    Returns
+    -------
+    `list[PreparedFile]`
+        the files, in the same order.
+    """
+
+    hashes = [sha256(data).digest() for _, data in files]
+
+    async with app.ctx.pool.acquire() as conn:
+        req = await conn.execute(
+            f"SELECT hash FROM blobs WHERE hash IN ({', '.join('?' * len(hashes))})",
+            *hashes
+        )
+        stored = {row["hash"] for row in await req.fetchall()}
+
+    prepared: list[PreparedFile] = []
+    compressed: dict[bytes, tuple[bytes, str, bool]] = {}
+
+    for (filename, data), digest in zip(files, hashes):
+        # The same content twice in one paste is only compressed once.
+        if digest not in stored and digest not in compressed:
+            compressed[digest] = await store_content(app, digest, data)
+
+        content, codec, external = compressed.get(digest, (None, app.ctx.codecs.default.name, False))
+
+        prepared.append(PreparedFile(
+            filename,
+            digest,
+            data,
+            content,
+            len(data),
+            crc32(data),
+            codec,
+            external
+        ))
+
+    return prepared
+
+async def insert_files(app: MyAPI, conn: TimedConnection, paste_id: str, files: list[PreparedFile]) -> None:
+    """
+    Write prepared files for a paste, adding any blobs they need.
+
+    This should be called inside a transaction on the write
+    connection, so blobs can't be collected between being
+    checked for and referenced.
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    conn: `TimedConnection`
+        the write connection to the database.
+    paste_id: `str`
+        the paste the files belong to.
+    files: `list[PreparedFile]`
+        the files to write, in order.
+    """
+
+    await insert_blobs(app, conn, files)
+
+    await conn.executemany(
+        "INSERT INTO files (id, filename, position, hash) VALUES (?, ?, ?, ?)",
+        [
+            (paste_id, file.filename, position, file.hash)
+            for position, file in enumerate(files, start = 1)
+        ]
+    )
+
+async def insert_blobs(app: MyAPI, conn: TimedConnection, files: list[PreparedFile]) -> None:
+    """
+    Add the blobs prepared files need that aren't stored yet,
+    without writing any `files` rows for them.
+
+    Like `insert_files`, this should be called inside a
+    transaction on the write connection.
+    """
+
+    store = app.ctx.store
+
+    for file in files:
+        compressed, codec, external = file.compressed, file.codec, file.external
+
+        # Either the blob existed when the file was prepared (but might
+        # have been collected since, with nothing referencing it), or
+        # the file was streamed in without checking.
+        if compressed is None or file.pending is not None:
+            req = await conn.execute("SELECT 1 FROM blobs WHERE hash = ?", file.hash)
+
+            if await req.fetchone() is not None:
+                if file.pending is not None:
+                    file.pending.discard()
+
+                continue
+
+        if compressed is None:
+            compressed, codec, external = await store_content(app, file.hash, file.data) # type: ignore
+
+        # Moved into place while holding the write connection,
+        # so the collector can't delete it before it's referenced.
+        elif file.pending is not None:
+            file.pending.commit(file.hash)
+
+        # The collector deletes files while holding the write connection,
+        # so one written before it ran needs checking for again here.
+        elif external and store is not None and not store.exists(file.hash):
+            await app.ctx.workers.run(file.size, store.write, file.hash, file.data)
+
+        await conn.execute(
+            "INSERT OR IGNORE INTO blobs (hash, content, size, crc32, codec, external) VALUES (?, ?, ?, ?, ?, ?)",
+            file.hash, compressed, file.size, file.crc32, codec, external
+        )
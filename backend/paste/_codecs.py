@@ -0,0 +1,293 @@
+"""
+A helper module for the compression codecs file contents are stored with.
+
+Each row in `files` records the name of the codec its content was
+compressed with, so the configured codec can change without breaking
+older rows. `zstd` and `brotli` need the `zstandard` and `brotli`
+packages respectively, which are only imported when used.
+"""
+
+import zlib
+from abc import ABC, abstractmethod
+from threading import local
+from metrics import Metrics
+from typing import Any, Protocol
+from workers import WorkerPool
+
+class Compressor(Protocol):
+    "An object that compresses data given to it a piece at a time."
+
+    def compress(self, data: bytes) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+class Codec(ABC):
+    "A base class for a compression codec."
+
+    name: str
+    "The name stored alongside each row compressed with this codec."
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        "Compress `data` in one go."
+
+    @abstractmethod
+    def compressor(self) -> Compressor:
+        "Get a compressor for data that arrives in pieces, giving the same format as `compress`."
+
+    @abstractmethod
+    def decompress(self, data: bytes) -> bytes:
+        "Decompress data from `compress` or `compressor`."
+
+class ZlibCodec(Codec):
+    """
+    The `zlib` codec, which every row used before codecs were tagged.
+
+    This is the only codec whose stored data can be sent straight to
+    clients as a `Content-Encoding` or put into `.zip` downloads.
+    """
+
+    name = "zlib"
+
+    def __init__(self, level: int | None = None) -> None:
+        self.level = -1 if level is None else level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def compressor(self) -> Compressor:
+        return zlib.compressobj(self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+class ZstdCodec(Codec):
+    """
+    The `zstd` codec, optionally with a trained dictionary.
+
+    A dictionary helps a lot on small, similar inputs like
+    source code. Once rows have been written with a dictionary,
+    it has to stay configured for them to be read back.
+    """
+
+    name = "zstd"
+
+    def __init__(self, level: int | None = None, dictionary: bytes | None = None) -> None:
+        import zstandard # type: ignore
+
+        kwargs: dict[str, Any] = {}
+
+        if dictionary is not None:
+            kwargs["dict_data"] = zstandard.ZstdCompressionDict(dictionary)
+
+        self.zstandard = zstandard
+        self.zstd_compressor = zstandard.ZstdCompressor(level = 3 if level is None else level, **kwargs)
+        self.decompressor = zstandard.ZstdDecompressor(**kwargs)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.zstd_compressor.compress(data)
+
+    def compressor(self) -> Compressor:
+        return self.zstd_compressor.compressobj()
+
+    def decompress(self, data: bytes) -> bytes:
+        # Frames from `compressor` don't record their size, which the one-shot decompressor needs.
+        if self.zstandard.frame_content_size(data) == -1:
+            return self.decompressor.decompressobj().decompress(data)
+
+        return self.decompressor.decompress(data)
+
+class BrotliCodec(Codec):
+    "The `brotli` codec."
+
+    name = "brotli"
+
+    def __init__(self, level: int | None = None) -> None:
+        import brotli # type: ignore
+
+        self.brotli = brotli
+        self.quality = 11 if level is None else level
+
+    def compress(self, data: bytes) -> bytes:
+        return self.brotli.compress(data, quality = self.quality)
+
+    def compressor(self) -> Compressor:
+        return BrotliCompressor(self.brotli.Compressor(quality = self.quality))
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.brotli.decompress(data)
+
+class BrotliCompressor:
+    "Gives `brotli.Compressor` the same methods as the other codecs' compressors."
+
+    def __init__(self, compressor: Any) -> None:
+        self.brotli_compressor = compressor
+
+    def compress(self, data: bytes) -> bytes:
+        return self.brotli_compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self.brotli_compressor.finish()
+
+def make_codec(name: str, level: int | None = None, dictionary_path: str | None = None) -> Codec:
+    """
+    Create a codec from its name.
+
+    Parameters
+    ----------
+    name: `str`
+        one of `zlib`, `zstd` or `brotli`.
+    level: `int | None`
+        the compression level, or `None` for the codec's default.
+    dictionary_path: `str | None`
+        a path to a trained `zstd` dictionary. Ignored
+        by other codecs.
+
+    Returns
+    -------
+    `Codec`
+        the codec, ready for use.
+
+    Raises
+    ------
+    `ValueError`
+        there's no codec with the given name.
+    """
+
+    match name:
+        case "zlib":
+            return ZlibCodec(level)
+
+        case "zstd":
+            dictionary = None
+
+            if dictionary_path is not None:
+                with open(dictionary_path, "rb") as f:
+                    dictionary = f.read()
+
+            return ZstdCodec(level, dictionary)
+
+        case "brotli":
+            return BrotliCodec(level)
+
+        case _:
+            raise ValueError(f"unknown codec '{name}'.")
+
+def check_round_trip(codec: Codec) -> None:
+    """
+    Make sure a codec reads back what both `compress` and
+    `compressor` give it, before anything is stored with it.
+
+    Raises
+    ------
+    `RuntimeError`
+        either output didn't decompress to what went in.
+    """
+
+    sample = b"def main() -> None:\n    print('Hello, world!')\n" * 64
+    middle = len(sample) // 2
+
+    compressor = codec.compressor()
+    streamed = compressor.compress(sample[:middle]) + compressor.compress(sample[middle:]) + compressor.flush()
+
+    for source, data in (("compress", codec.compress(sample)), ("compressor", streamed)):
+        try:
+            ok = codec.decompress(data) == sample
+        except Exception as e:
+            raise RuntimeError(f"codec '{codec.name}' can't read back the output of its `{source}`.") from e
+
+        if not ok:
+            raise RuntimeError(f"codec '{codec.name}' reads back the output of its `{source}` wrongly.")
+
+thread_codecs = local()
+"The codecs made so far, per thread, since `zstd` (de)compressors can't be shared between threads."
+
+def cached_codec(name: str, level: int | None, dictionary_path: str | None) -> Codec:
+    "Get a codec made from the given settings, making it once per thread."
+
+    try:
+        codecs: dict[tuple[str, int | None, str | None], Codec] = thread_codecs.codecs
+    except AttributeError:
+        codecs = thread_codecs.codecs = {}
+
+    key = (name, level, dictionary_path)
+
+    if key not in codecs:
+        codecs[key] = make_codec(name, level, dictionary_path)
+
+    return codecs[key]
+
+def compress_with(name: str, level: int | None, dictionary_path: str | None, data: bytes) -> bytes:
+    "Compress `data` with the codec with the given settings. Picklable, for worker processes."
+
+    return cached_codec(name, level, dictionary_path).compress(data)
+
+def decompress_with(name: str, dictionary_path: str | None, data: bytes) -> bytes:
+    "Decompress `data` with the codec with the given settings. Picklable, for worker processes."
+
+    # The level doesn't matter for decompressing, but the dictionary does.
+    return cached_codec(name, None, dictionary_path).decompress(data)
+
+class Codecs:
+    """
+    Holds the codec new files are written with, and compresses
+    and decompresses in the `WorkerPool`, if there is one.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        level: int | None = None,
+        dictionary_path: str | None = None,
+        metrics: Metrics | None = None,
+        workers: WorkerPool | None = None
+    ) -> None:
+        self.name = name
+        self.level = level
+        self.dictionary_path = dictionary_path
+        self.metrics = metrics
+        self.workers = workers
+
+        check_round_trip(self.default)
+
+    @property
+    def default(self) -> Codec:
+        "The codec new files are compressed with, made for the calling thread."
+
+        return cached_codec(self.name, self.level, self.dictionary_path)
+
+    def get(self, name: str) -> Codec:
+        "Get the codec a row tagged with `name` needs to be decompressed with, made for the calling thread."
+
+        return cached_codec(name, None, self.dictionary_path)
+
+    async def compress(self, data: bytes) -> bytes:
+        "Compress `data` with the default codec."
+
+        if self.metrics is None:
+            return await self._compress(data)
+
+        with self.metrics.stage("compress").time():
+            return await self._compress(data)
+
+    async def decompress(self, name: str, data: bytes) -> bytes:
+        "Decompress `data` from a row tagged with the codec `name`."
+
+        if self.metrics is None:
+            return await self._decompress(name, data)
+
+        with self.metrics.stage("decompress").time():
+            return await self._decompress(name, data)
+
+    async def _compress(self, data: bytes) -> bytes:
+        if self.workers is None:
+            return self.default.compress(data)
+
+        return await self.workers.run(len(data), compress_with, self.name, self.level, self.dictionary_path, data)
+
+    async def _decompress(self, name: str, data: bytes) -> bytes:
+        if self.workers is None:
+            return self.get(name).decompress(data)
+
+        # Compressed size, so well-compressed data is a bit more likely to stay inline.
+        return await self.workers.run(len(data), decompress_with, name, self.dictionary_path, data)
@@ -0,0 +1,94 @@
+"""
+A helper module for conditional requests and `Cache-Control` on the read
+endpoints, so clients and edge caches can reuse what they already have.
+
+Every paste has a `version` (bumped by `/update/`), a `digest` of its
+files and the time they last changed, kept on its `pastes` row. Checking
+them only needs that row, never the files.
+"""
+
+from cache import PasteInfo
+from datetime import datetime as dt, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from sanic.request import Request
+from sanic.response import HTTPResponse
+from time import time
+from typing import Any
+from utils import MyAPI
+
+def make_etag(version: int, digest: bytes) -> str:
+    "Make the ETag for a paste from its version and digest."
+
+    # Weak, since the same paste is sent inflated, deflated or gzipped.
+    return f'W/"{version}-{digest.hex()[:32]}"'
+
+def paste_info(row: Any) -> PasteInfo:
+    "Make a paste's validators from a row with its `version`, `digest`, `modified` and `expiration`."
+
+    return PasteInfo(make_etag(row["version"], row["digest"]), row["modified"], row["expiration"])
+
+async def fetch_paste_info(app: MyAPI, uuid: str) -> PasteInfo | None:
+    "Read a paste's validators and expiration, or `None` if there's no such paste."
+
+    async with app.ctx.pool.acquire() as conn:
+        req = await conn.execute(
+            "SELECT version, digest, modified, expiration FROM pastes WHERE id = ?",
+            uuid
+        )
+        row = await req.fetchone()
+
+    if row is None:
+        return None
+
+    return paste_info(row)
+
+def cache_headers(app: MyAPI, info: PasteInfo) -> dict[str, str]:
+    """
+    Get the `ETag`, `Last-Modified` and `Cache-Control` headers for a paste.
+
+    `max-age` runs until the paste expires, capped at
+    `Config.HTTP_CACHE_MAX_AGE_IN_SECONDS`.
+    """
+
+    remaining = info.expiration - int(time())
+    max_age = max(0, min(remaining, app.ctx.configs.HTTP_CACHE_MAX_AGE_IN_SECONDS))
+
+    return {
+        "ETag": info.etag,
+        "Last-Modified": format_datetime(dt.fromtimestamp(info.modified, timezone.utc), usegmt = True),
+        "Cache-Control": f"public, max-age={max_age}"
+    }
+
+def is_not_modified(request: Request, info: PasteInfo) -> bool:
+    """
+    Check whether the client's copy of a paste is still current,
+    going by `If-None-Match`, or `If-Modified-Since` without it.
+    """
+
+    if_none_match = request.headers.get("If-None-Match")
+
+    if if_none_match is not None:
+        # Weak comparison, as RFC 9110 asks for here.
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(',')}
+
+        return "*" in tags or info.etag.removeprefix("W/") in tags
+
+    if_modified_since = request.headers.get("If-Modified-Since")
+
+    if if_modified_since is None:
+        return False
+
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+    if since.tzinfo is None:
+        since = since.replace(tzinfo = timezone.utc)
+
+    return info.modified <= since.timestamp()
+
+def not_modified(headers: dict[str, str]) -> HTTPResponse:
+    "Make a `304 Not Modified` response with the given cache headers."
+
+    return HTTPResponse(status = 304, headers = headers)
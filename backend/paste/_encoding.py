@@ -0,0 +1,181 @@
+"A helper module for sending stored zlib content as a `Content-Encoding`."
+
+from mmap import mmap
+from sanic.request import Request
+from zlib import adler32, compressobj, crc32, DEFLATED, MAX_WBITS, Z_SYNC_FLUSH
+
+# The largest prime below 2^16, used by Adler-32.
+ADLER_BASE = 65521
+
+# A gzip member header with no filename, no timestamp
+# and an unknown OS, wrapping deflate data.
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+def preferred_encoding(request: Request) -> str | None:
+    """
+    Pick the encoding to send stored content with, based
+    on the request's `Accept-Encoding` header.
+
+    Codings are ranked by their q-values, and ones with `q=0` are never
+    picked. On a tie, `deflate` is preferred since stored content can be
+    sent as-is; `gzip` only needs a different header and trailer. If the
+    client ranks `identity` above both, nothing is encoded.
+
+    Returns
+    -------
+    `str | None`
+        `"deflate"`, `"gzip"` or `None` if neither is
+        acceptable to (or preferred by) the client.
+    """
+
+    weights: dict[str, float] = {}
+
+    for part in request.headers.get("accept-encoding", "").split(','):
+        coding, *params = part.split(';')
+        coding = coding.strip().lower()
+
+        if not coding:
+            continue
+
+        weight = 1.0
+
+        for param in params:
+            name, _, value = param.strip().partition('=')
+
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+
+        weights[coding] = weight
+
+    wildcard = weights.get("*", 0.0)
+    best, best_weight = None, 0.0
+
+    # Strictly greater, so `deflate` wins a tie.
+    for coding in ("deflate", "gzip"):
+        weight = weights.get(coding, wildcard)
+
+        if weight > best_weight:
+            best, best_weight = coding, weight
+
+    if weights.get("identity", 0.0) > best_weight:
+        return None
+
+    return best
+
+def adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+    "Get the Adler-32 of two pieces of data joined together from their separate checksums."
+
+    remainder = len2 % ADLER_BASE
+
+    sum1 = adler1 & 0xffff
+    sum2 = (remainder * sum1) % ADLER_BASE
+
+    sum1 += (adler2 & 0xffff) + ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + ADLER_BASE - remainder
+
+    return (sum1 % ADLER_BASE) | ((sum2 % ADLER_BASE) << 16)
+
+def crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+    """
+    Get the CRC-32 of two pieces of data joined together from their separate checksums.
+
+    CRC-32 is affine over XOR, so pushing `len2` zero bytes through
+    the first checksum lines it up with the second. That's a pass of
+    `crc32` over `len2` bytes, which is far cheaper than inflating.
+    """
+
+    zeros = bytes(len2)
+
+    return crc32(zeros, crc1) ^ crc32(zeros) ^ crc2
+
+def encoded_parts(
+    encoding: str,
+    stored: bytes | mmap,
+    size: int,
+    checksum: int,
+    prefix: bytes = b''
+) -> tuple[bytes, slice, bytes]:
+    """
+    Work out how to wrap a stored zlib stream for sending with the
+    given `encoding`, without inflating it or copying it.
+
+    If there's a `prefix`, it's deflated on its own (ending on a byte
+    boundary without finishing the stream) and the stored deflate
+    blocks are spliced on after it.
+
+    Parameters
+    ----------
+    encoding: `str`
+        `"deflate"` or `"gzip"`.
+    stored: `bytes | mmap`
+        the zlib stream, as made by `zlib.compress`.
+    size: `int`
+        the size of the data inside `stored`.
+    checksum: `int`
+        the CRC-32 of the data inside `stored`.
+    prefix: `bytes`
+        some uncompressed data to go before the stored data.
+
+    Returns
+    -------
+    `tuple[bytes, slice, bytes]`
+        what to send before the stored data, the part of
+        the stored data to send, and what to send after it.
+    """
+
+    # Everything but the 2-byte zlib header and 4-byte Adler-32 trailer.
+    body = slice(2, len(stored) - 4)
+    deflated_prefix = b''
+
+    if prefix:
+        compressor = compressobj(1, DEFLATED, -MAX_WBITS)
+        deflated_prefix = compressor.compress(prefix) + compressor.flush(Z_SYNC_FLUSH)
+
+    if encoding == "deflate":
+        if not prefix:
+            return b'', slice(0, len(stored)), b''
+
+        adler = adler32_combine(adler32(prefix), int.from_bytes(stored[-4:], "big"), size)
+
+        return stored[:2] + deflated_prefix, body, adler.to_bytes(4, "big")
+
+    if encoding == "gzip":
+        if prefix:
+            checksum = crc32_combine(crc32(prefix), checksum, size)
+
+        total_size = len(prefix) + size
+
+        return (
+            GZIP_HEADER + deflated_prefix,
+            body,
+            checksum.to_bytes(4, "little") + (total_size & 0xffffffff).to_bytes(4, "little")
+        )
+
+    raise ValueError(f"unsupported encoding '{encoding}'.")
+
+def encode_stored(
+    encoding: str,
+    stored: bytes,
+    size: int,
+    checksum: int,
+    prefix: bytes = b''
+) -> bytes:
+    """
+    Wrap a stored zlib stream for sending with the given `encoding`,
+    without inflating it. See `encoded_parts` for the parameters.
+
+    Returns
+    -------
+    `bytes`
+        the response body for the given `Content-Encoding`.
+    """
+
+    head, body, tail = encoded_parts(encoding, stored, size, checksum, prefix)
+
+    if not head and not tail:
+        return stored
+
+    return head + stored[body] + tail
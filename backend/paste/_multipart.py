@@ -0,0 +1,110 @@
+"""
+A helper module for reading `multipart/form-data` bodies as they
+arrive, without holding a whole part (or the whole body) in memory.
+"""
+
+from sanic.exceptions import BadRequest
+from sanic.headers import parse_content_header
+from typing import AsyncIterator
+
+# Part headers are tiny in practice, so anything bigger is refused.
+MAX_HEADERS_SIZE = 16_384
+
+async def iter_multipart(
+    chunks: AsyncIterator[bytes],
+    boundary: str
+) -> AsyncIterator[tuple[str | None, bytes | None]]:
+    """
+    Split a `multipart/form-data` body into its parts as it's read.
+
+    Each part starts with `(filename, None)`, where `filename` is
+    taken from its `Content-Disposition` (or `None` if it has
+    none), and its content follows as `(None, data)` pieces.
+
+    Parameters
+    ----------
+    chunks: `AsyncIterator[bytes]`
+        the body, as it arrives.
+    boundary: `str`
+        the `boundary` parameter from the `Content-Type`.
+
+    Raises
+    ------
+    `BadRequest`
+        the body isn't valid `multipart/form-data`.
+    """
+
+    delimiter = b"\r\n--" + boundary.encode()
+
+    # Lets the first delimiter, which has no line break before it,
+    # be found the same way as the rest.
+    buffer = b"\r\n"
+    in_part = False
+
+    async for chunk in chunks:
+        buffer += chunk
+
+        while True:
+            index = buffer.find(delimiter)
+
+            if index == -1:
+                # Keep back enough to catch a delimiter split across chunks.
+                keep = len(delimiter) - 1
+
+                if len(buffer) > keep:
+                    if in_part:
+                        yield None, buffer[:-keep]
+
+                    buffer = buffer[-keep:]
+
+                break
+
+            if in_part and index:
+                yield None, buffer[:index]
+
+            rest = buffer[index + len(delimiter):]
+
+            # Wait for enough to tell the closing delimiter
+            # apart and to have all of the next part's headers.
+            if len(rest) < 2:
+                buffer = buffer[index:]
+                break
+
+            if rest.startswith(b"--"):
+                # Anything after is an epilogue to ignore, but it's still read,
+                # or the connection can't be used for another request.
+                async for _ in chunks:
+                    pass
+
+                return
+
+            end = rest.find(b"\r\n\r\n")
+
+            if end == -1:
+                if len(rest) > MAX_HEADERS_SIZE:
+                    raise BadRequest("Multipart headers are too large.")
+
+                buffer = buffer[index:]
+                in_part = False
+                break
+
+            yield parse_part_filename(rest[:end]), None
+
+            buffer = rest[end + 4:]
+            in_part = True
+
+    raise BadRequest("Multipart body ended before its closing boundary.")
+
+def parse_part_filename(headers: bytes) -> str | None:
+    "Get the filename from a part's headers, if there is one."
+
+    for line in headers.decode("utf-8", "replace").split("\r\n"):
+        name, _, value = line.partition(':')
+
+        if name.strip().lower() == "content-disposition":
+            _, params = parse_content_header(value.strip())
+            filename = params.get("filename")
+
+            return str(filename) if filename else None
+
+    return None
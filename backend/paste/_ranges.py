@@ -0,0 +1,188 @@
+"""
+A helper module for sending part of a file: byte ranges (`Range` and
+`206 Partial Content`) and line ranges (`?lines=a-b`), on `/raw/` and
+`/download/` for single files.
+
+Only single byte ranges are supported. A `Range` with several ranges in
+it gets the whole file, which RFC 9110 allows.
+"""
+
+from cache import PasteInfo
+from email.utils import parsedate_to_datetime
+from sanic.exceptions import BadRequest, SanicException
+from sanic.request import Request
+from sanic.response import HTTPResponse
+from typing import Iterable, Iterator
+
+def parse_range(request: Request, size: int, info: PasteInfo) -> tuple[int, int] | None:
+    """
+    Work out which bytes of a `size`-byte body the `Range` header asks for.
+
+    Parameters
+    ----------
+    request: `Request`
+        the request being responded to.
+    size: `int`
+        the size of the whole body.
+    info: `PasteInfo`
+        the paste's validators, to check `If-Range` against.
+
+    Returns
+    -------
+    `tuple[int, int] | None`
+        the first byte to send and the byte to stop before,
+        or `None` if the whole body should be sent.
+
+    Raises
+    ------
+    `SanicException`
+        416: the range starts past the end of the body.
+    """
+
+    header = request.headers.get("Range")
+
+    if header is None:
+        return None
+
+    if_range = request.headers.get("If-Range")
+
+    # Only a date can match: ETags here are weak, and `If-Range` needs a strong one.
+    if if_range is not None and not matches_date(if_range, info.modified):
+        return None
+
+    unit, _, spec = header.partition('=')
+
+    if unit.strip().lower() != "bytes" or ',' in spec:
+        return None
+
+    first, _, last = spec.strip().partition('-')
+
+    try:
+        if first:
+            start = int(first)
+            end = int(last) + 1 if last else size
+        else:
+            # A suffix: the last so many bytes.
+            start = max(0, size - int(last))
+            end = size
+    except ValueError:
+        return None
+
+    # A last byte before the first makes the range invalid, and it's ignored.
+    # An open-ended one starting past the end is unsatisfiable instead.
+    if start < 0 or (first and last and end <= start):
+        return None
+
+    if start >= size:
+        raise SanicException("Range not satisfiable.", 416, headers = {"Content-Range": f"bytes */{size}"})
+
+    return start, min(end, size)
+
+def ranged_response(
+    request: Request,
+    info: PasteInfo,
+    body: bytes,
+    headers: dict[str, str],
+    content_type: str
+) -> HTTPResponse:
+    "Send `body`, or just the part of it `Range` asks for with a `206`."
+
+    byte_range = parse_range(request, len(body), info)
+
+    if byte_range is None:
+        return HTTPResponse(body, headers = headers, content_type = content_type)
+
+    start, end = byte_range
+
+    return HTTPResponse(
+        body[start:end],
+        status = 206,
+        headers = headers | content_range(start, end, len(body)),
+        content_type = content_type
+    )
+
+def matches_date(value: str, modified: int) -> bool:
+    "Check whether an HTTP date is exactly the given timestamp."
+
+    try:
+        return parsedate_to_datetime(value).timestamp() == modified
+    except (TypeError, ValueError):
+        return False
+
+def content_range(start: int, end: int, size: int) -> dict[str, str]:
+    "Get the headers for a `206` response sending bytes `start` to `end` (exclusive)."
+
+    return {"Content-Range": f"bytes {start}-{end - 1}/{size}"}
+
+def parse_lines(request: Request) -> tuple[int, int] | None:
+    """
+    Read the `lines` query argument: `a-b`, `a-` or just `a`,
+    where lines are counted from 1 and both ends are included.
+
+    Returns
+    -------
+    `tuple[int, int] | None`
+        the first and last line, or `None` if it wasn't given.
+
+    Raises
+    ------
+    `BadRequest`
+        the argument isn't a valid line range.
+    """
+
+    value: str | None = request.args.get("lines")
+
+    if value is None:
+        return None
+
+    first, dash, last = value.partition('-')
+
+    try:
+        start = int(first)
+        end = (int(last) if last else 1 << 62) if dash else start
+    except ValueError:
+        raise BadRequest("'lines' must look like 'a-b', 'a-' or 'a'.")
+
+    if not 1 <= start <= end:
+        raise BadRequest("'lines' must start at 1 or later, and not end before it starts.")
+
+    return start, end
+
+def slice_lines(chunks: Iterable[bytes], first: int, last: int) -> Iterator[bytes]:
+    """
+    Pick lines `first` to `last` out of some text as it's read,
+    a slice of each chunk at a time, and stop reading after `last`.
+    """
+
+    line = 1
+
+    for chunk in chunks:
+        start = 0
+
+        while line < first:
+            newline = chunk.find(b'\n', start)
+
+            if newline == -1:
+                start = len(chunk)
+                break
+
+            start = newline + 1
+            line += 1
+
+        end = start
+
+        while line <= last:
+            newline = chunk.find(b'\n', end)
+
+            if newline == -1:
+                end = len(chunk)
+                break
+
+            end = newline + 1
+            line += 1
+
+        if end > start:
+            yield chunk[start:end]
+
+        if line > last:
+            return
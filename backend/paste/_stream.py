@@ -0,0 +1,108 @@
+"A helper module for streaming blobs kept in the `FileStore` to clients."
+
+from codecs import getincrementaldecoder
+from json import dumps
+from mmap import mmap
+from sanic.exceptions import SanicException
+from sanic.response import ResponseStream
+from storage import FileStore
+from typing import Iterable
+from utils import MyAPI
+from ._encoding import encoded_parts
+from ._ranges import slice_lines
+
+def get_store(app: MyAPI) -> FileStore:
+    """
+    Get the `FileStore` to read a blob kept in it.
+
+    Raises
+    ------
+    `SanicException`
+        503: there's no `FileStore`, which only happens if
+        `Config.LARGE_FILE_DIRECTORY` was unset after large
+        files were stored.
+    """
+
+    if app.ctx.store is None:
+        raise SanicException("Large files are unavailable right now.", 503)
+
+    return app.ctx.store
+
+async def send_encoded(
+    response: ResponseStream,
+    store: FileStore,
+    mapped: mmap,
+    encoding: str,
+    size: int,
+    checksum: int,
+    prefix: bytes = b''
+) -> None:
+    """
+    Send a mapped zlib stream with the given `Content-Encoding`,
+    a chunk at a time. See `encoded_parts` for the parameters.
+    """
+
+    head, body, tail = encoded_parts(encoding, mapped, size, checksum, prefix)
+
+    if head:
+        await response.write(head)
+
+    for chunk in store.slices(mapped, body.start, body.stop):
+        await response.write(chunk)
+
+    if tail:
+        await response.write(tail)
+
+async def send_inflated(response: ResponseStream, store: FileStore, mapped: mmap) -> None:
+    "Inflate a mapped zlib stream and send it, a chunk at a time."
+
+    for chunk in store.inflate(mapped):
+        await response.write(chunk)
+
+async def send_json_text(response: ResponseStream, chunks: Iterable[bytes]) -> None:
+    """
+    Send UTF-8 `chunks` as the inside of a JSON string (without
+    its quotes), escaping them a chunk at a time.
+    """
+
+    # A character can be split between chunks.
+    decoder = getincrementaldecoder("utf-8")()
+
+    for chunk in chunks:
+        if text := decoder.decode(chunk):
+            await response.write(dumps(text, ensure_ascii = False)[1:-1].encode())
+
+    if text := decoder.decode(b'', final = True):
+        await response.write(dumps(text, ensure_ascii = False)[1:-1].encode())
+
+async def send_range(
+    response: ResponseStream,
+    store: FileStore,
+    mapped: mmap,
+    digest: bytes,
+    prefix: bytes,
+    start: int,
+    end: int
+) -> None:
+    """
+    Send bytes `start` to `end` (exclusive) of `prefix` followed by
+    a mapped file's content, inflating from the chunk the range
+    starts in and stopping where it ends.
+    """
+
+    if start < len(prefix):
+        await response.write(prefix[start:end])
+
+    if end > len(prefix):
+        index = store.read_index(digest)
+
+        for chunk in store.inflate_range(mapped, index, max(0, start - len(prefix)), end - len(prefix)):
+            await response.write(chunk)
+
+async def send_lines(response: ResponseStream, store: FileStore, mapped: mmap, prefix: bytes, first: int, last: int) -> None:
+    "Send `prefix` and lines `first` to `last` of a mapped file, inflating no further than them."
+
+    await response.write(prefix)
+
+    for chunk in slice_lines(store.inflate(mapped), first, last):
+        await response.write(chunk)
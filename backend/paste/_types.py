@@ -1,8 +1,25 @@
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, field_validator, model_validator, ValidationError
 from sanic.exceptions import BadRequest
-from typing import TypedDict
+from sanic.request import Request
+from typing import Literal, TypedDict
 from utils import Config
 
+def parse_body[T: BaseModel](request: Request, model: type[T]) -> T:
+    """
+    Validate a request's JSON body as `model`. This stands in for
+    `sanic_ext.validate`, so workers don't have to import `sanic_ext`.
+
+    Raises
+    ------
+    `BadRequest`
+        the body isn't JSON, or doesn't match `model`.
+    """
+
+    try:
+        return model.model_validate_json(request.body)
+    except ValidationError as e:
+        raise BadRequest(f"Invalid request body: {model.__name__}. Error: {e}")
+
 class CountRow(TypedDict):
     """
     Represents the resulting row of the SQL:
@@ -48,14 +65,69 @@ class CreateResponse(BaseModel):
     removal_link: str
 
 
+class UpdateResponse(BaseModel):
+    """
+    A type class that models how a JSON response
+    from the `/update/` endpoint should be formatted.
+    """
+
+    version: int
+
+class FileEdit(BaseModel):
+    """
+    A type class that models one change to a paste's files,
+    as sent to the `/update/` endpoint under `edits`.
+
+    `replace` swaps the content of the file at `position` (and
+    its name, if `filename` is given), `append` adds a file at
+    the end, `rename` changes the name of the file at `position`
+    and `remove` takes it out, moving later files up one.
+    """
+
+    action: Literal["replace", "append", "rename", "remove"]
+    position: int | None = None
+    filename: str | None = None
+    content: str | None = None
+
+
 class UpdateRequest(BaseModel):
     """
     A type class that models how a JSON request
     to the `/update/` endpoint should be formatted.
+
+    Either `files`, to replace every file, or `edits`,
+    to change some of them, has to be given.
     """
 
     id: str
-    files: Files
+    files: Files | None = None
+    edits: list[FileEdit] | None = None
+
+    @model_validator(mode = 'after')
+    def validate_fields(self) -> 'UpdateRequest':
+        if (self.files is None) == (self.edits is None):
+            raise BadRequest("Exactly one of 'files' and 'edits' must be given.")
+
+        return self
+
+
+class BatchCreateRequest(BaseModel):
+    """
+    A type class that models how a JSON request to the
+    `/create/batch` endpoint should be formatted: a
+    list of what `/create/` takes, one per paste.
+    """
+
+    pastes: list[CreateRequest]
+
+
+class BatchGetRequest(BaseModel):
+    """
+    A type class that models how a JSON request
+    to the `/get/batch` endpoint should be formatted.
+    """
+
+    ids: list[str]
 
 
 class GetResponse(BaseModel):
@@ -64,4 +136,25 @@ class GetResponse(BaseModel):
     from the `/get/` endpoint should be formatted.
     """
 
-    files: Files
\ No newline at end of file
+    files: Files
+
+class SearchResult(BaseModel):
+    """
+    A type class that models a single file
+    matched by the `/search/` endpoint.
+    """
+
+    paste_id: str
+    position: int
+    filename: str | None
+
+
+class SearchResponse(BaseModel):
+    """
+    A type class that models how a JSON response
+    from the `/search/` endpoint should be formatted.
+    """
+
+    results: list[SearchResult]
+    page: int
+    next_page: int | None
@@ -0,0 +1,156 @@
+"A helper module for writing `.zip` archives one entry at a time."
+
+import struct
+from datetime import datetime as dt
+from zipfile import ZIP_DEFLATED
+from zlib import compressobj, DEFLATED, MAX_WBITS
+
+# Bit 11 of the general purpose flags marks filenames as UTF-8.
+UTF8_FLAG = 1 << 11
+
+def raw_deflate(stored: bytes) -> bytes:
+    """
+    Strip the 2-byte header and 4-byte Adler-32 trailer off a
+    zlib stream, leaving the raw deflate data `.zip` files use.
+    """
+
+    return stored[2:-4]
+
+def deflate(data: bytes, level: int = -1) -> bytes:
+    "Compress `data` into a raw deflate stream."
+
+    compressor = compressobj(level, DEFLATED, -MAX_WBITS)
+
+    return compressor.compress(data) + compressor.flush()
+
+class ZipStream:
+    """
+    Builds a `.zip` archive as a series of byte chunks, so
+    it can be sent to a client before it's finished.
+
+    Entries are written with their sizes and checksums in the
+    local header, so they have to be known up front - each
+    blob records them when it's written.
+    Archives over 4 GB (ZIP64) are not supported.
+    """
+
+    def __init__(self) -> None:
+        self.offset = 0
+        self.central_directory: list[bytes] = []
+
+        now = dt.now()
+
+        self.dos_time = (now.hour << 11) | (now.minute << 5) | (now.second // 2)
+        self.dos_date = ((now.year - 1980) << 9) | (now.month << 5) | now.day
+
+    def entry(
+        self,
+        filename: str,
+        compressed: bytes,
+        crc: int,
+        size: int,
+        method: int = ZIP_DEFLATED
+    ) -> bytes:
+        """
+        Get the bytes for a single file in the archive.
+
+        Parameters
+        ----------
+        filename: `str`
+            the name of the file inside the archive.
+        compressed: `bytes`
+            the file content, already compressed with `method`.
+        crc: `int`
+            the CRC-32 of the uncompressed content.
+        size: `int`
+            the size of the uncompressed content.
+        method: `int`
+            the compression method of `compressed`.
+
+        Returns
+        -------
+        `bytes`
+            the local file header followed by the file content.
+        """
+
+        return self.entry_header(filename, len(compressed), crc, size, method) + compressed
+
+    def entry_header(
+        self,
+        filename: str,
+        compressed_size: int,
+        crc: int,
+        size: int,
+        method: int = ZIP_DEFLATED
+    ) -> bytes:
+        """
+        Get the local file header for a single file in the archive,
+        for when its content is sent separately. Exactly
+        `compressed_size` bytes of content have to follow it.
+
+        See `entry` for the other parameters.
+        """
+
+        name = filename.encode()
+
+        local_header = struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034b50,         # Local file header signature
+            20,                 # Version needed to extract
+            UTF8_FLAG,
+            method,
+            self.dos_time,
+            self.dos_date,
+            crc,
+            compressed_size,
+            size,
+            len(name),
+            0                   # Extra field length
+        )
+
+        self.central_directory.append(
+            struct.pack(
+                "<IHHHHHHIIIHHHHHII",
+                0x02014b50,     # Central directory header signature
+                20,             # Version made by
+                20,             # Version needed to extract
+                UTF8_FLAG,
+                method,
+                self.dos_time,
+                self.dos_date,
+                crc,
+                compressed_size,
+                size,
+                len(name),
+                0,              # Extra field length
+                0,              # Comment length
+                0,              # Disk number
+                0,              # Internal attributes
+                0o644 << 16,    # External attributes (rw-r--r--)
+                self.offset
+            ) + name
+        )
+
+        header = local_header + name
+        self.offset += len(header) + compressed_size
+
+        return header
+
+    def finish(self) -> bytes:
+        "Get the central directory and end record that close off the archive."
+
+        directory = b''.join(self.central_directory)
+
+        end_record = struct.pack(
+            "<IHHHHIIH",
+            0x06054b50,         # End of central directory signature
+            0,                  # Disk number
+            0,                  # Disk with the central directory
+            len(self.central_directory),
+            len(self.central_directory),
+            len(directory),
+            self.offset,
+            0                   # Comment length
+        )
+
+        return directory + end_record
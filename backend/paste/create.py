@@ -2,17 +2,25 @@ import shortuuid, re
 from datetime import datetime as dt, timedelta as td
 from json import JSONDecodeError
 from sanic.exceptions import BadRequest, SanicException
+from sanic.headers import parse_content_header
 from sanic.request import Request
 from sanic.response import JSONResponse, json as to_json
-from ._types import CountRow, CreateRequest, CreateResponse
+from sqlite3 import IntegrityError, SQLITE_CONSTRAINT_PRIMARYKEY, SQLITE_CONSTRAINT_TRIGGER, SQLITE_CONSTRAINT_UNIQUE
+from database import paste_digest, TimedConnection, transaction
+from ._blobs import insert_files, prepare_files, PreparedFile, StreamedFile
+from ._multipart import iter_multipart
+from ._types import BatchCreateRequest, CountRow, CreateRequest, CreateResponse
+from typing import AsyncIterator
 from utils import format_file_size, MyAPI
-from zlib import compress
 
 # URL regex that's used to extract the domain name
 # from the `url` attribute on `request`.
 # Group 1 is the domain and group 2 is the route.
 url_regex = re.compile(r"(https?:\/\/[\w.]*?(\:\d{4})?)\/")
 
+MAX_ID_ATTEMPTS = 10
+"How many times a paste's IDs are drawn again after colliding, before giving up."
+
 async def create_new_paste(
     app: MyAPI,
     data: CreateRequest,
@@ -50,7 +58,122 @@ async def create_new_paste(
         422: file size exceeded allowed maximum.
     """
 
-    total_paste_size = sum([len(content) for _, content in data.files])
+    check_paste_size(app, data)
+
+    await check_capacity(app)
+
+    # Compressing happens here, before queueing for the write connection.
+    files = await prepare_files(app, [(filename, content.encode()) for filename, content in data.files])
+
+    return await insert_paste(app, files, data.keep_for, request_url)
+
+async def create_new_pastes(
+    app: MyAPI,
+    data: BatchCreateRequest,
+    request_url: str
+) -> JSONResponse:
+    """
+    Create several pastes at once, the way `create_new_paste` would
+    each of them, in a single transaction - either all of them are
+    created or none are.
+
+    Each paste is held to `Config.MAX_PASTE_SIZE`, and the batch
+    as a whole to `Config.MAX_BATCH_SIZE` pastes and
+    `Config.MAX_BATCH_CONTENT_SIZE` bytes.
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    data: `BatchCreateRequest`
+        the pastes to create.
+    request_url: `str`
+        the complete URL the request was made from,
+        for generating delete links.
+
+    Returns
+    -------
+    `JSONResponse`
+        a JSON document with what `/create/` would have sent
+        for each paste, in the order they were given.
+
+    Raises
+    ------
+    `BadRequest`
+        there were no pastes, or more than `Config.MAX_BATCH_SIZE`.
+    `SanicException`
+        403: database reached allowed maximum; no space left.
+        422: file size exceeded allowed maximum.
+    """
+
+    if not 1 <= len(data.pastes) <= app.ctx.configs.MAX_BATCH_SIZE:
+        raise BadRequest(f"Between 1 and {app.ctx.configs.MAX_BATCH_SIZE} pastes can be created at once.")
+
+    total_batch_size = 0
+
+    for paste in data.pastes:
+        total_batch_size += check_paste_size(app, paste)
+
+    if total_batch_size > app.ctx.configs.MAX_BATCH_CONTENT_SIZE:
+        raise SanicException(
+            f"Combined size of the pastes exceeds maximum limit of" +
+            f" {format_file_size(app.ctx.configs.MAX_BATCH_CONTENT_SIZE)} by" +
+            f" {format_file_size(total_batch_size - app.ctx.configs.MAX_BATCH_CONTENT_SIZE)}",
+
+            422
+        )
+
+    await check_capacity(app)
+
+    # Prepared together, so content shared between pastes is only compressed once.
+    prepared = await prepare_files(app, [
+        (filename, content.encode())
+        for paste in data.pastes
+        for filename, content in paste.files
+    ])
+
+    created: list[tuple[str, str, int]] = []
+
+    async with app.ctx.writer.acquire() as conn, transaction(conn):
+        start = 0
+
+        for paste in data.pastes:
+            files = prepared[start : start + len(paste.files)]
+            start += len(paste.files)
+
+            created.append(await insert_paste_rows(app, conn, files, paste.keep_for))
+
+    for _, _, expiration in created:
+        app.ctx.loops.notify_expiration(expiration)
+
+    return to_json({
+        "pastes": [
+            {
+                "paste_id": paste_id,
+                "removal_link": removal_link(request_url, removal_id)
+            }
+            for paste_id, removal_id, _ in created
+        ]
+    })
+
+def encoded_size(text: str) -> int:
+    "Count the bytes `text` takes as UTF-8, which every size limit is in."
+
+    # Knowing a string is ASCII is free, and then nothing needs encoding.
+    return len(text) if text.isascii() else len(text.encode())
+
+def check_paste_size(app: MyAPI, data: CreateRequest) -> int:
+    """
+    Check a paste isn't over `Config.MAX_PASTE_SIZE`,
+    in UTF-8 bytes, and return its size.
+
+    Raises
+    ------
+    `SanicException`
+        422: file size exceeded allowed maximum.
+    """
+
+    total_paste_size = sum(map(encoded_size, (content for _, content in data.files)))
 
     # If the paste size exceeds what is required, return
     # a 422 (Unprocessable Entity) HTTP status code.
@@ -63,64 +186,254 @@ async def create_new_paste(
             422
         )
 
-    async with app.ctx.pool.acquire() as conn:
-        req = await conn.execute("SELECT COUNT(*) AS 'count' FROM pastes")
-        row: CountRow = await req.fetchone() # type: ignore
-        count = row["count"]
-    
-    # Verify that there's still space available in the database.
-    # If there isn't, return a 403 notifying the user.
-    if count == app.ctx.configs.MAX_ENTRIES:
-        raise SanicException("System is full. Please try again later.", 403)
+    return total_paste_size
 
-    async def get_unique_uuid(*, length: int, column: str) -> str:
-        "Get a new UUID with length `length` that hasn't appeared in the `column` column of the database."
+async def create_streamed_paste(app: MyAPI, request: Request) -> JSONResponse:
+    """
+    Create a new paste from a request body that's read as it arrives,
+    instead of being parsed as JSON all at once.
 
-        async with app.ctx.pool.acquire() as conn:
-            while True:
-                # Generate a new ID
-                next_uuid = shortuuid.random(length)
+    A `text/plain` body is a single file, named by the `filename`
+    query parameter. A `multipart/form-data` body has a file for
+    each part, named by its `Content-Disposition`. Either way, the
+    paste is kept for the `keep_for` query parameter's days.
 
-                # Check it doesn't already exist
-                req = await conn.execute(f"SELECT 1 FROM pastes WHERE {column} = ?", next_uuid)
-                row = await req.fetchone()
+    Each file is hashed and compressed chunk by chunk, and the
+    request is refused as soon as it goes over the size limit.
 
-                # Unique ID is found
-                if not row:
-                    return next_uuid
-    
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    request: `Request`
+        the request, from a route with a streamed body.
 
-    paste_id = await get_unique_uuid(
-        length = app.ctx.configs.PASTE_ID_LENGTH,
-        column = "id"
-    )
-    
-    removal_id = await get_unique_uuid(
-        length = app.ctx.configs.REMOVAL_ID_LENGTH,
-        column = "removal_id"
-    )
+    Returns
+    -------
+    `JSONResponse`
+        the same document `create_new_paste` gives.
 
-    expiration = int((dt.now() + td(days = data.keep_for)).timestamp())
+    Raises
+    ------
+    `BadRequest`
+        the query parameters or body were invalid.
+    `SanicException`
+        403: database reached allowed maximum; no space left.
+        413: combined file size exceeded allowed maximum.
+        415: the body was neither `text/plain` nor `multipart/form-data`.
+    """
 
-    async with app.ctx.pool.acquire() as conn:
-        # Add to the `pastes` table
-        await conn.execute(
-            "INSERT INTO pastes (id, expiration, removal_id) VALUES (?, ?, ?)",
-            paste_id, expiration, removal_id
-        )
+    streamed: list[StreamedFile] = []
+    total_paste_size = 0
+
+    async def read_body() -> AsyncIterator[bytes]:
+        while (chunk := await request.stream.read()) is not None: # type: ignore
+            yield chunk
 
-        # Add all the file data to the `files` table
-        await conn.executemany(
-            "INSERT INTO files (id, filename, content, position) VALUES (?, ?, ?, ?)",
-            [
-                (paste_id, filename, compress(content.encode()), position)
-                for position, (filename, content) in enumerate(data.files, start = 1)
-            ]
+    try:
+        try:
+            keep_for = float(request.args.get("keep_for", app.ctx.configs.DEFAULT_EXPIRATION_IN_DAYS))
+        except ValueError:
+            raise BadRequest("'keep_for' is not a number.")
+
+        if not 1 <= keep_for <= 30:
+            raise BadRequest("'keep_for' is not in range 1-30 inclusive.")
+
+        content_type, params = parse_content_header(request.headers.get("content-type", "text/plain"))
+        max_size = app.ctx.configs.MAX_PASTE_SIZE
+
+        too_large = SanicException(
+            f"Combined file size exceeds maximum limit of {format_file_size(max_size)}",
+            413
         )
+
+        try:
+            content_length = int(request.headers.get("content-length", 0))
+        except ValueError:
+            raise BadRequest("'Content-Length' is not a number.")
+
+        # A plain body is exactly the file, so its length can be checked up front.
+        if content_type == "text/plain" and content_length > max_size:
+            raise too_large
+
+        await check_capacity(app)
+
+        if content_type == "text/plain":
+            streamed.append(StreamedFile(app, request.args.get("filename")))
+
+            async for chunk in read_body():
+                total_paste_size += len(chunk)
+
+                if total_paste_size > max_size:
+                    raise too_large
+
+                streamed[0].write(chunk)
+
+        elif content_type == "multipart/form-data":
+            boundary = params.get("boundary")
+
+            if not boundary:
+                raise BadRequest("Multipart body has no boundary.")
+
+            async for filename, chunk in iter_multipart(read_body(), str(boundary)):
+                if chunk is None:
+                    streamed.append(StreamedFile(app, filename))
+                    continue
+
+                total_paste_size += len(chunk)
+
+                if total_paste_size > max_size:
+                    raise too_large
+
+                streamed[-1].write(chunk)
+
+        else:
+            raise SanicException("Content type must be 'text/plain' or 'multipart/form-data'.", 415)
+
+        if not streamed:
+            raise BadRequest("No files were given.")
+
+        files = [file.finish() for file in streamed]
+
+        return await insert_paste(app, files, keep_for, request.url)
+    except SanicException:
+        # Whatever's left of a refused body is read and dropped,
+        # so the connection can be kept alive for the next request.
+        async for _ in read_body():
+            pass
+
+        raise
+    finally:
+        # Pending files in the `FileStore` that didn't
+        # make it into the database are cleaned up here.
+        for file in streamed:
+            file.discard()
+
+async def check_capacity(app: MyAPI) -> None:
+    """
+    Verify that there's still space available in the database.
+    If there isn't, raise a 403 notifying the user. This is only
+    a quick check - the insert itself is what enforces the limit.
+    """
+
+    async with app.ctx.pool.acquire() as conn:
+        req = await conn.execute("SELECT count FROM paste_count")
+        row: CountRow = await req.fetchone() # type: ignore
+
+    if row["count"] >= app.ctx.configs.MAX_ENTRIES:
+        raise SanicException("System is full. Please try again later.", 403)
+
+async def insert_paste(
+    app: MyAPI,
+    files: list[PreparedFile],
+    keep_for: int | float,
+    request_url: str
+) -> JSONResponse:
+    """
+    Insert a new paste with the given prepared files.
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    files: `list[PreparedFile]`
+        the files of the paste, in order.
+    keep_for: `int | float`
+        the number of days to keep the paste for.
+    request_url: `str`
+        the complete URL the request was made from,
+        for generating a delete link.
+
+    Returns
+    -------
+    `JSONResponse`
+        a JSON document containing the ID of the created
+        paste and its removal link.
+
+    Raises
+    ------
+    `SanicException`
+        403: database reached allowed maximum; no space left.
+    """
+
+    async with app.ctx.writer.acquire() as conn:
+        # Both tables are written in one transaction, so a paste
+        # is never visible (or left behind) without its files.
+        async with transaction(conn):
+            paste_id, removal_id, expiration = await insert_paste_rows(app, conn, files, keep_for)
     
-    base_url = re.sub(url_regex, r'\1', request_url)
+    app.ctx.loops.notify_expiration(expiration)
     
     return to_json({
         "paste_id": paste_id,
-        "removal_link": f"{base_url}/delete/{removal_id}"
-    })
\ No newline at end of file
+        "removal_link": removal_link(request_url, removal_id)
+    })
+
+async def insert_paste_rows(
+    app: MyAPI,
+    conn: TimedConnection,
+    files: list[PreparedFile],
+    keep_for: int | float
+) -> tuple[str, str, int]:
+    """
+    Insert a paste and its files on the write connection,
+    inside a transaction the caller has started.
+
+    Returns
+    -------
+    `tuple[str, str, int]`
+        the paste's ID, removal ID and expiration timestamp.
+
+    Raises
+    ------
+    `SanicException`
+        403: database reached allowed maximum; no space left.
+        503: every ID drawn was already taken.
+    `IntegrityError`
+        the paste was rejected for any other reason.
+    """
+
+    now = dt.now()
+    expiration = int((now + td(days = keep_for)).timestamp())
+    digest = paste_digest((file.filename, file.hash) for file in files)
+
+    # IDs are random enough that collisions are rare, so instead of
+    # checking each one is free first, insert them and let the UNIQUE
+    # indexes on `id` and `removal_id` reject the odd taken one.
+    for _ in range(MAX_ID_ATTEMPTS):
+        paste_id = shortuuid.random(app.ctx.configs.PASTE_ID_LENGTH)
+        removal_id = shortuuid.random(app.ctx.configs.REMOVAL_ID_LENGTH)
+
+        try:
+            # Add to the `pastes` table
+            await conn.execute(
+                "INSERT INTO pastes (id, expiration, removal_id, modified, digest) VALUES (?, ?, ?, ?, ?)",
+                paste_id, expiration, removal_id, int(now.timestamp()), digest
+            )
+        except IntegrityError as e:
+            # Raised by the `pastes_capacity` trigger.
+            if e.sqlite_errorcode == SQLITE_CONSTRAINT_TRIGGER:
+                raise SanicException("System is full. Please try again later.", 403)
+
+            # Only a taken ID is worth drawing again for; anything
+            # else would fail the same way on every attempt.
+            if e.sqlite_errorcode in (SQLITE_CONSTRAINT_PRIMARYKEY, SQLITE_CONSTRAINT_UNIQUE):
+                continue
+
+            raise
+
+        break
+    else:
+        raise SanicException("Couldn't find a free paste ID. Please try again later.", 503)
+
+    # Add all the file data to the `files` and `blobs` tables
+    await insert_files(app, conn, paste_id, files)
+
+    return paste_id, removal_id, expiration
+
+def removal_link(request_url: str, removal_id: str) -> str:
+    "Make the link that deletes a paste, on the domain the request was made to."
+
+    base_url = re.sub(url_regex, r'\1', request_url)
+
+    return f"{base_url}/delete/{removal_id}"
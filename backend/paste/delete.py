@@ -30,13 +30,15 @@ async def delete_paste_by_link(app: MyAPI, removal_id: str) -> HTTPResponse:
         there was no paste with the given removal ID.
     """
     
-    async with app.ctx.pool.acquire() as conn:
-        req = await conn.execute("SELECT 1 FROM pastes WHERE removal_id = ?", removal_id)
-        row = await req.fetchone()
+    async with app.ctx.writer.acquire() as conn:
+        req = await conn.execute("DELETE FROM pastes WHERE removal_id = ? RETURNING id", removal_id)
 
-        if not row:
-            raise NotFound(f"No resource was found under the id '{removal_id}'.")
+        # Read every row so the statement finishes and commits.
+        rows = await req.fetchall()
 
-        await conn.execute("DELETE FROM pastes WHERE removal_id = ?", removal_id)
+    if not rows:
+        raise NotFound(f"No resource was found under the id '{removal_id}'.")
     
+    app.ctx.cache.invalidate(rows[0]["id"])
+
     return HTTPResponse("Success.")
\ No newline at end of file
@@ -1,33 +1,54 @@
-from io import BytesIO
 from sanic.exceptions import BadRequest, NotFound
-from sanic.response import HTTPResponse
+from sanic.response import HTTPResponse, ResponseStream
 from sanic.response.convenience import raw
 from sanic.request import Request
-from typing import overload
+from ._conditional import cache_headers, fetch_paste_info, is_not_modified, not_modified
+from ._encoding import encode_stored, preferred_encoding
+from ._ranges import content_range, parse_range, ranged_response
+from ._stream import get_store, send_encoded, send_inflated, send_range
+from ._zip import deflate, raw_deflate, ZipStream
+from typing import Any, overload
 from utils import MyAPI
-from zipfile import ZipFile, ZIP_DEFLATED
-from zlib import decompress
+from zlib import crc32
 
 @overload
-async def download_paste_by_id(app: MyAPI, paste_id: str) -> HTTPResponse:
+async def download_paste_by_id(app: MyAPI, request: Request, paste_id: str) -> HTTPResponse | ResponseStream:
     "Download all files under the given `paste_id`."
 
 @overload
-async def download_paste_by_id(app: MyAPI, paste_id: str, filepos: int) -> HTTPResponse:
+async def download_paste_by_id(app: MyAPI, request: Request, paste_id: str, filepos: int) -> HTTPResponse | ResponseStream:
     "Download a single file at position `filepos` under the given `paste_id`."
 
-async def download_paste_by_id(app: MyAPI, paste_id: str, filepos: int = 0) -> HTTPResponse:
+async def download_paste_by_id(app: MyAPI, request: Request, paste_id: str, filepos: int = 0) -> HTTPResponse | ResponseStream:
     """
     Download a group of files (as a `.zip`) or a single file
     (as whatever the extension is) from the database.
     
-    The `.zip` file is built in memory from database rows
-    and then dispatched through a HTTP response as a file.
+    The `.zip` file is streamed to the client one file at a
+    time, so output starts before the archive is finished. When
+    `Config.ZIP_PASSTHROUGH` is set, the stored deflate data goes
+    straight into the archive without being recompressed.
+
+    A single file is sent as its stored compressed data, with
+    a `Content-Encoding`, if the client accepts `deflate` or `gzip`.
+    Files kept in the `FileStore` are always streamed from it a
+    chunk at a time, including into `.zip` files.
+
+    A single file can be sent in part, as the byte range its `Range`
+    header asks for, with a `206`. Ranges count bytes of the file's
+    content, so a partial response never has a `Content-Encoding`.
+
+    Responses carry an `ETag`, `Last-Modified` and `Cache-Control`,
+    and a `304` is sent if the client's copy is still current.
 
     Parameters
     ----------
     app: `MyAPI`
         the app currently running.
+    request: `Request`
+        the request being responded to, used to check
+        which encodings are accepted and its conditional
+        headers, and for streaming the `.zip` file back.
     paste_id: `str`
         the ID of the paste to download.
     filepos: `int`
@@ -36,7 +57,7 @@ async def download_paste_by_id(app: MyAPI, paste_id: str, filepos: int = 0) -> H
     
     Returns
     -------
-    `HTTPResponse`
+    `HTTPResponse | ResponseStream`
         the file containing the requested
         data to then be download.
     
@@ -50,13 +71,23 @@ async def download_paste_by_id(app: MyAPI, paste_id: str, filepos: int = 0) -> H
     
     if filepos < 0:
         raise BadRequest("'filepos' cannot be less than zero.")
+
+    info = await fetch_paste_info(app, paste_id)
+
+    if info is None:
+        raise NotFound(f"No paste was found with the ID '{paste_id}'.")
+
+    cache = cache_headers(app, info)
+
+    if is_not_modified(request, info):
+        return not_modified(cache)
     
     # User wants to download a single file
     if filepos:
         async with app.ctx.pool.acquire() as conn:
             req = await conn.execute(
                 """
-                SELECT filename, content FROM files
+                SELECT filename, hash, content, size, crc32, codec, external FROM files JOIN blobs USING (hash)
                 WHERE id = ? AND position = ?
                 """,
                 paste_id, filepos
@@ -67,35 +98,168 @@ async def download_paste_by_id(app: MyAPI, paste_id: str, filepos: int = 0) -> H
         if not row:
             raise NotFound(f"No file at index {filepos} for paste {paste_id} found.")
 
-        return raw(
-            decompress(row["content"]).decode(),
-            headers = {
-                "Content-Disposition": f'attachment; filename="{row["filename"] or f'{paste_id}-{row[filepos]}.txt'}"'
-            }
+        headers = cache | {
+            "Content-Disposition": f'attachment; filename="{row["filename"] or f'{paste_id}-{filepos}.txt'}"',
+            "Vary": "Accept-Encoding",
+            "Accept-Ranges": "bytes"
+        }
+
+        # Ranges are counted in unencoded bytes, so part of a file is sent as it is.
+        encoding = None if "Range" in request.headers else preferred_encoding(request)
+
+        if row["external"]:
+            return stream_stored_file(app, row, encoding, headers, parse_range(request, row["size"], info))
+
+        # Send the stored data as-is if the client can inflate it.
+        if encoding and row["codec"] == "zlib":
+            headers["Content-Encoding"] = encoding
+
+            return raw(
+                encode_stored(encoding, row["content"], row["size"], row["crc32"]),
+                headers = headers
+            )
+
+        return ranged_response(
+            request,
+            info,
+            await app.ctx.codecs.decompress(row["codec"], row["content"]),
+            headers,
+            "application/octet-stream"
         )
 
     # ================================================================================================
 
     # User wants to download all files
     async with app.ctx.pool.acquire() as conn:
-        req = await conn.execute("SELECT filename, content, position FROM files WHERE id = ?", paste_id)
+        req = await conn.execute(
+            "SELECT filename, position, hash FROM files WHERE id = ? ORDER BY position",
+            paste_id
+        )
         rows = await req.fetchall()
     
     if not rows:
         raise NotFound(f"No files were found with the paste ID '{paste_id}'.")
 
-    buffer = BytesIO()
-    
-    with ZipFile(buffer, "w", ZIP_DEFLATED, False) as myzip: # type: ignore
-        for row in rows:
-            filename = row["filename"] or f"{paste_id}-{row["position"]}"
+    response = await request.respond(
+        headers = cache | {
+            "Content-Disposition": f'attachment; filename="{paste_id}.zip"'
+        },
+        content_type = "application/zip"
+    )
+
+    archive = ZipStream()
+
+    # Files are fetched one at a time so only one is ever
+    # held in memory, and the connection isn't held while
+    # a slow client reads the response.
+    for row in rows:
+        async with app.ctx.pool.acquire() as conn:
+            req = await conn.execute(
+                "SELECT content, size, crc32, codec, external FROM blobs WHERE hash = ?",
+                row["hash"]
+            )
+            content_row = await req.fetchone()
+        
+        # Deleted or updated (and collected) while streaming - skip it.
+        if not content_row:
+            continue
+
+        filename = row["filename"] or f"{paste_id}-{row["position"]}"
+
+        # Large files are copied into the archive from
+        # the `FileStore` a chunk at a time.
+        if content_row["external"]:
+            store = get_store(app)
+
+            try:
+                with store.open(row["hash"]) as mapped:
+                    await response.send(archive.entry_header(filename, len(mapped) - 6, content_row["crc32"], content_row["size"]))
+
+                    for chunk in store.slices(mapped, 2, len(mapped) - 4):
+                        await response.send(chunk)
+            except FileNotFoundError:
+                # Collected before it could be opened - skip it.
+                pass
 
-            with myzip.open(filename, "w") as file:
-                file.write(decompress(row["content"]))
+            continue
+
+        stored: bytes = content_row["content"]
+
+        with app.ctx.metrics.stage("zip_build").time():
+            # Only zlib data can go into the archive as-is.
+            if app.ctx.configs.ZIP_PASSTHROUGH and content_row["codec"] == "zlib":
+                crc, size = content_row["crc32"], content_row["size"]
+                compressed = raw_deflate(stored)
+            else:
+                data = await app.ctx.codecs.decompress(content_row["codec"], stored)
+                crc, size = crc32(data), len(data)
+                compressed = await app.ctx.workers.run(size, deflate, data)
+
+            chunk = archive.entry(filename, compressed, crc, size)
+
+        await response.send(chunk)
     
-    return raw(
-        buffer.getvalue(),
-        headers = {
-            "Content-Disposition": f'attachment; filename="{paste_id}.zip"'
-        }
-    )
\ No newline at end of file
+    await response.send(archive.finish())
+    await response.eof()
+
+    return response
+
+
+def stream_stored_file(
+    app: MyAPI,
+    row: Any,
+    encoding: str | None,
+    headers: dict[str, str],
+    byte_range: tuple[int, int] | None = None
+) -> ResponseStream:
+    """
+    Send a single file kept in the `FileStore` a chunk at a time,
+    as its stored zlib stream if the client accepts an encoding,
+    or just the given byte range of it with a `206`.
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    row: `Any`
+        the file's row, with its hash, size and checksum.
+    encoding: `str | None`
+        the encoding the client accepts, from `preferred_encoding`.
+    headers: `dict[str, str]`
+        the headers to send the file with.
+    byte_range: `tuple[int, int] | None`
+        the range to send, from `parse_range`, if any.
+
+    Returns
+    -------
+    `ResponseStream`
+        the streamed response.
+    """
+
+    store = get_store(app)
+
+    if byte_range:
+        start, end = byte_range
+
+        async def stream_range(response: ResponseStream) -> None:
+            with store.open(row["hash"]) as mapped:
+                await send_range(response, store, mapped, row["hash"], b'', start, end)
+
+        return ResponseStream(
+            stream_range,
+            status = 206,
+            headers = headers | content_range(start, end, row["size"]),
+            content_type = "application/octet-stream"
+        )
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    async def stream(response: ResponseStream) -> None:
+        with store.open(row["hash"]) as mapped:
+            if encoding:
+                await send_encoded(response, store, mapped, encoding, row["size"], row["crc32"])
+            else:
+                await send_inflated(response, store, mapped)
+
+    return ResponseStream(stream, headers = headers)
@@ -1,53 +1,532 @@
+from cache import CachedFiles, CachedPaste, PasteInfo
+from itertools import groupby
+from json import dumps
 from sanic.exceptions import BadRequest, NotFound
-from sanic.response import HTTPResponse
-from ._types import GetResponse
-from typing import overload
+from sanic.request import Request
+from sanic.response import HTTPResponse, ResponseStream
+from ._conditional import cache_headers, fetch_paste_info, is_not_modified, not_modified, paste_info
+from ._encoding import encode_stored, preferred_encoding
+from ._ranges import content_range, parse_lines, parse_range, ranged_response, slice_lines
+from ._stream import get_store, send_encoded, send_inflated, send_json_text, send_lines, send_range
+from typing import Any, overload, TYPE_CHECKING
 from utils import MyAPI
-from zlib import decompress
 
-async def get_paste_by_id(app: MyAPI, uuid: str) -> GetResponse:
+# Only for annotations, so reads don't have to import `pydantic`.
+if TYPE_CHECKING:
+    from ._types import BatchGetRequest
+
+async def fetch_paste_rows(app: MyAPI, uuid: str) -> list[Any]:
+    """
+    Get the rows for the files of a paste, in position order, with
+    their content still compressed. Blobs kept in the `FileStore`
+    have an empty `content`.
+
+    Every row also has the paste's validators, read in the same
+    query, so they always match the files; see `paste_info`.
+    """
+
+    async with app.ctx.pool.acquire() as conn:
+        req = await conn.execute(
+            """
+            SELECT
+                version, digest, modified, expiration,
+                filename, files.hash AS hash, content, size, crc32, codec, external
+            FROM pastes
+            JOIN files ON files.id = pastes.id
+            JOIN blobs ON blobs.hash = files.hash
+            WHERE pastes.id = ?
+            ORDER BY position
+            """,
+            uuid
+        )
+
+        return await req.fetchall()
+
+async def decompress_rows(app: MyAPI, rows: list[Any]) -> CachedFiles:
+    """
+    Decompress the rows from `fetch_paste_rows`. Files in the `FileStore`
+    are only ever streamed, so none of the rows can be one of them.
+    """
+
+    files: CachedFiles = []
+
+    for row in rows:
+        data = await app.ctx.codecs.decompress(row["codec"], row["content"])
+        files.append((row["filename"], data.decode()))
+
+    return files
+
+async def lookup_paste(app: MyAPI, uuid: str) -> tuple[PasteInfo | None, CachedPaste | None]:
+    """
+    Get a paste's validators, from the paste cache if it's
+    there or else from its `pastes` row, without its files.
+
+    Returns
+    -------
+    `tuple[PasteInfo | None, CachedPaste | None]`
+        the validators, or `None` if no paste has the given
+        UUID, and the cached paste, if there is one.
+    """
+
+    cached = app.ctx.cache.get(uuid)
+
+    if cached is not None:
+        return cached.info, cached
+
+    return await fetch_paste_info(app, uuid), None
+
+def render_paste(app: MyAPI, info: PasteInfo, files: CachedFiles) -> CachedPaste:
+    """
+    Render the `/get/` and `/raw/` bodies of a paste, once,
+    so cache hits don't build them again.
+    """
+
+    with app.ctx.metrics.stage("serialize").time():
+        # The same bytes `GetResponse(files = files).model_dump_json()` gives.
+        json = dumps({"files": files}, ensure_ascii = False, separators = (',', ':')).encode()
+
+        raw = '\n\n***\n\n***'.join(                       # Separator
+            f"[{i}. {filename or "???"}]" '\n'              # Header
+            f"{content}"                                     # Text
+            for i, (filename, content) in enumerate(files, start = 1)
+        ).encode()
+
+        file_headers = [f"[{filename}]\n".encode() for filename, _ in files]
+        raw_files = [header + content.encode() for header, (_, content) in zip(file_headers, files)]
+
+    return CachedPaste(info, json, raw, raw_files, list(map(len, file_headers)))
+
+async def cache_paste(app: MyAPI, uuid: str, rows: list[Any], generation: int) -> CachedPaste:
+    """
+    Decompress and render a paste that wasn't cached,
+    then cache it with its validators.
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    uuid: `str`
+        the UUID of the paste.
+    rows: `list[Any]`
+        the paste's rows, from `fetch_paste_rows`, with
+        none of them in the `FileStore`.
+    generation: `int`
+        the cache's generation from before the rows were read.
+    
+    Returns
+    -------
+    `CachedPaste`
+        the rendered paste.
+    """
+
+    paste = render_paste(app, paste_info(rows[0]), await decompress_rows(app, rows))
+
+    app.ctx.cache.put(uuid, paste, generation)
+
+    return paste
+
+async def send_json_paste(app: MyAPI, response: ResponseStream, rows: list[Any]) -> None:
+    """
+    Send the `/get/` body of a paste that has files in the `FileStore`,
+    the same bytes `render_paste` would make, inflating and escaping
+    those files a chunk at a time.
+    """
+
+    store = get_store(app)
+
+    await response.write(b'{"files":[')
+
+    for i, row in enumerate(rows):
+        await response.write((b',' if i else b'') + b'[' + dumps(row["filename"], ensure_ascii = False).encode() + b',"')
+
+        if not row["external"]:
+            data = await app.ctx.codecs.decompress(row["codec"], row["content"])
+            await response.write(dumps(data.decode(), ensure_ascii = False)[1:-1].encode())
+        else:
+            try:
+                with store.open(row["hash"]) as mapped:
+                    await send_json_text(response, store.inflate(mapped))
+            except FileNotFoundError:
+                # Updated (and collected) since the rows were read - sent empty.
+                pass
+
+        await response.write(b'"]')
+
+    await response.write(b']}')
+
+async def get_paste_by_id(app: MyAPI, request: Request, uuid: str) -> HTTPResponse | ResponseStream:
     """
     Retrieve a paste in the database from a given `uuid`.
 
+    The response carries an `ETag`, `Last-Modified` and `Cache-Control`,
+    and a `304` is sent without reading the files if the client's
+    copy is still current.
+
     Parameters
     ----------
     app: `MyAPI`
         the instance of the app currently running right now.
+    request: `Request`
+        the request being responded to, for its conditional headers.
     uuid: `str`
         the UUID of the paste to retrieve.
 
     Returns
     -------
-    `GetResponse`
-        the resulting response.
+    `HTTPResponse | ResponseStream`
+        the paste as a `GetResponse`, or a `304`. Pastes with
+        files in the `FileStore` are streamed, and never cached.
     """
 
     if len(uuid) < app.ctx.configs.PASTE_ID_LENGTH:
         raise BadRequest("Invalid UUID.")
 
+    info, cached = await lookup_paste(app, uuid)
+
+    if info is None:
+        raise NotFound(f"No paste was found with the ID '{uuid}'.")
+
+    headers = cache_headers(app, info)
+
+    if is_not_modified(request, info):
+        return not_modified(headers)
+
+    paste = cached
+
+    if paste is None:
+        generation = app.ctx.cache.generation
+        rows = await fetch_paste_rows(app, uuid)
+
+        if not rows:
+            raise NotFound(f"No paste was found with the ID '{uuid}'.")
+
+        # Updated since its validators were read, so the ones that match the body are sent.
+        if paste_info(rows[0]) != info:
+            headers = cache_headers(app, paste_info(rows[0]))
+
+        # Large files are streamed rather than held in memory (or cached).
+        if any(row["external"] for row in rows):
+            async def stream(response: ResponseStream) -> None:
+                await send_json_paste(app, response, rows)
+
+            return ResponseStream(stream, headers = headers, content_type = "application/json")
+
+        paste = await cache_paste(app, uuid, rows, generation)
+
+    return HTTPResponse(paste.json, headers = headers, content_type = "application/json")
+
+async def fetch_pastes(app: MyAPI, uuids: list[str]) -> tuple[dict[str, CachedPaste], dict[str, list[Any]]]:
+    """
+    Read, decompress and render several pastes that weren't
+    cached, in one query, then cache them.
+
+    Returns
+    -------
+    `tuple[dict[str, CachedPaste], dict[str, list[Any]]]`
+        the rendered pastes, by ID, and the rows of pastes with files
+        in the `FileStore`, which are left to be streamed instead.
+        IDs with no paste are in neither.
+    """
+
+    generation = app.ctx.cache.generation
+
     async with app.ctx.pool.acquire() as conn:
-        req = await conn.execute("SELECT filename, content FROM files WHERE id = ?", uuid)
+        req = await conn.execute(
+            f"""
+            SELECT
+                pastes.id, version, digest, modified, expiration,
+                filename, files.hash AS hash, content, size, codec, external
+            FROM pastes
+            JOIN files ON files.id = pastes.id
+            JOIN blobs ON blobs.hash = files.hash
+            WHERE pastes.id IN ({', '.join('?' * len(uuids))})
+            ORDER BY pastes.id, position
+            """,
+            *uuids
+        )
         rows = await req.fetchall()
+
+    pastes: dict[str, CachedPaste] = {}
+    large: dict[str, list[Any]] = {}
+
+    for uuid, group in groupby(rows, key = lambda row: row["id"]):
+        paste_rows = list(group)
+
+        if any(row["external"] for row in paste_rows):
+            large[uuid] = paste_rows
+        else:
+            pastes[uuid] = await cache_paste(app, uuid, paste_rows, generation)
+
+    return pastes, large
+
+async def get_pastes_by_ids(app: MyAPI, data: 'BatchGetRequest') -> HTTPResponse | ResponseStream:
+    """
+    Retrieve many pastes at once, the way `get_paste_by_id` would
+    each of them. Cached pastes are used as they are and the rest
+    are read with a single query.
+
+    The response maps each ID to what `/get/` would have sent for
+    it, or to `null` if there's no such paste:
+
+    ```json
+    {"pastes": {"8xV3y38NbY": {"files": [["test.py", "print(1)"]]}, "missing123": null}}
+    ```
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    data: `BatchGetRequest`
+        the IDs of the pastes to get.
+
+    Returns
+    -------
+    `HTTPResponse | ResponseStream`
+        the pastes, as JSON. It's streamed if any
+        of them have files in the `FileStore`.
+
+    Raises
+    ------
+    `BadRequest`
+        more than `Config.MAX_BATCH_SIZE` IDs were given.
+    """
+
+    if len(data.ids) > app.ctx.configs.MAX_BATCH_SIZE:
+        raise BadRequest(f"No more than {app.ctx.configs.MAX_BATCH_SIZE} pastes can be fetched at once.")
+
+    # Duplicates are only looked up (and sent) once.
+    uuids = list(dict.fromkeys(data.ids))
+
+    pastes: dict[str, CachedPaste] = {}
+    large: dict[str, list[Any]] = {}
+    missing: list[str] = []
+
+    for uuid in uuids:
+        cached = app.ctx.cache.get(uuid)
+
+        if cached is not None:
+            pastes[uuid] = cached
+
+        # Too short to be an ID, so there's no need to look.
+        elif len(uuid) >= app.ctx.configs.PASTE_ID_LENGTH:
+            missing.append(uuid)
+
+    if missing:
+        fetched, large = await fetch_pastes(app, missing)
+        pastes |= fetched
+
+    if large:
+        async def stream(response: ResponseStream) -> None:
+            await response.write(b'{"pastes":{')
+
+            for i, uuid in enumerate(uuids):
+                await response.write((b',' if i else b'') + dumps(uuid).encode() + b':')
+
+                if uuid in large:
+                    await send_json_paste(app, response, large[uuid])
+                else:
+                    await response.write(pastes[uuid].json if uuid in pastes else b'null')
+
+            await response.write(b'}}')
+
+        return ResponseStream(stream, content_type = "application/json")
+
+    # Spliced together from each paste's rendered `/get/` body.
+    body = b','.join(
+        dumps(uuid).encode() + b':' + (pastes[uuid].json if uuid in pastes else b'null')
+        for uuid in uuids
+    )
+
+    return HTTPResponse(b'{"pastes":{' + body + b'}}', content_type = "application/json")
+
+def get_encoded_raw_paste(
+    app: MyAPI,
+    rows: list[Any],
+    filepos: int,
+    encoding: str,
+    headers: dict[str, str]
+) -> HTTPResponse | ResponseStream | None:
+    """
+    Try to send the raw content of a paste using its stored
+    compressed data as the `Content-Encoding`, without inflating it.
+
+    This only works when there's a single file to send and it was
+    compressed with `zlib`. Files kept in the `FileStore` are
+    streamed from it a chunk at a time.
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    rows: `list[Any]`
+        the rows of the files to send, from `fetch_paste_rows`.
+    filepos: `int`
+        which file was selected, or 0 for all of them.
+    encoding: `str`
+        the encoding the client accepts, from `preferred_encoding`.
+    headers: `dict[str, str]`
+        the cache headers to send with it.
     
-    if not rows:
-        raise NotFound(f"No paste was found with the ID '{uuid}'.")
+    Returns
+    -------
+    `HTTPResponse | ResponseStream | None`
+        the encoded response, or `None` if the
+        uncompressed path needs to be used instead.
+    """
+
+    # Several files can't be spliced into one stream,
+    # and only zlib data is a valid `Content-Encoding`.
+    if len(rows) != 1:
+        return None
+
+    row = rows[0]
 
-    return GetResponse(
-        files = [
-            (row["filename"], decompress(row["content"]).decode())
-            for row in rows
-        ]
+    if row["codec"] != "zlib":
+        return None
+
+    if filepos:
+        header = f"[{row["filename"]}]\n"
+    else:
+        header = f"[1. {row["filename"] or "???"}]\n"
+
+    headers = headers | {"Content-Encoding": encoding}
+
+    if row["external"]:
+        store = get_store(app)
+
+        async def stream(response: ResponseStream) -> None:
+            with store.open(row["hash"]) as mapped:
+                await send_encoded(response, store, mapped, encoding, row["size"], row["crc32"], header.encode())
+
+        return ResponseStream(stream, headers = headers, content_type = "text/plain; charset=utf-8")
+
+    return HTTPResponse(
+        encode_stored(encoding, row["content"], row["size"], row["crc32"], header.encode()),
+        headers = headers,
+        content_type = "text/plain; charset=utf-8"
     )
 
+async def send_raw_file(
+    app: MyAPI,
+    request: Request,
+    info: PasteInfo,
+    row: Any,
+    lines: tuple[int, int] | None,
+    headers: dict[str, str]
+) -> HTTPResponse | ResponseStream:
+    """
+    Send one file of a paste that has files in the `FileStore`, or the
+    part of it asked for by `Range` or `?lines=`. A file that's in the
+    `FileStore` itself is streamed, inflating no more of it than needed.
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    request: `Request`
+        the request being responded to, for its `Range`.
+    info: `PasteInfo`
+        the paste's validators, for `If-Range`.
+    row: `Any`
+        the file's row, from `fetch_paste_rows`.
+    lines: `tuple[int, int] | None`
+        the lines to send, from `parse_lines`.
+    headers: `dict[str, str]`
+        the cache headers to send with it.
+
+    Returns
+    -------
+    `HTTPResponse | ResponseStream`
+        the (possibly partial) response.
+    """
+
+    header = f"[{row["filename"]}]\n".encode()
+    content_type = "text/plain; charset=utf-8"
+
+    if not row["external"]:
+        content = await app.ctx.codecs.decompress(row["codec"], row["content"])
+
+        if lines:
+            return HTTPResponse(header + b''.join(slice_lines([content], *lines)), headers = headers, content_type = content_type)
+
+        return ranged_response(request, info, header + content, headers, content_type)
+
+    store = get_store(app)
+
+    if lines:
+        async def stream_lines(response: ResponseStream) -> None:
+            with store.open(row["hash"]) as mapped:
+                await send_lines(response, store, mapped, header, *lines)
+
+        return ResponseStream(stream_lines, headers = headers, content_type = content_type)
+
+    size = len(header) + row["size"]
+    byte_range = parse_range(request, size, info)
+    start, end = byte_range or (0, size)
+
+    async def stream(response: ResponseStream) -> None:
+        with store.open(row["hash"]) as mapped:
+            await send_range(response, store, mapped, row["hash"], header, start, end)
+
+    if byte_range is None:
+        return ResponseStream(stream, headers = headers, content_type = content_type)
+
+    return ResponseStream(stream, status = 206, headers = headers | content_range(start, end, size), content_type = content_type)
+
+def stream_raw_paste(app: MyAPI, rows: list[Any], headers: dict[str, str]) -> ResponseStream:
+    """
+    Send the raw content of a paste that has files in the `FileStore`,
+    a chunk at a time, in the same layout as `get_raw_paste_by_id`.
+    Single files are sent by `send_raw_file`.
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    rows: `list[Any]`
+        the paste's rows, from `fetch_paste_rows`.
+    headers: `dict[str, str]`
+        the cache headers to send with it.
+
+    Returns
+    -------
+    `ResponseStream`
+        the streamed response.
+    """
+
+    store = get_store(app)
+
+    parts = [
+        (("\n\n***\n\n***" if i > 1 else "") + f"[{i}. {row["filename"] or "???"}]\n", row)
+        for i, row in enumerate(rows, start = 1)
+    ]
+
+    async def stream(response: ResponseStream) -> None:
+        for header, row in parts:
+            await response.write(header.encode())
+
+            if not row["external"]:
+                await response.write(await app.ctx.codecs.decompress(row["codec"], row["content"]))
+                continue
+
+            try:
+                with store.open(row["hash"]) as mapped:
+                    await send_inflated(response, store, mapped)
+            except FileNotFoundError:
+                # Updated (and collected) since the rows were read - skip it.
+                pass
+
+    return ResponseStream(stream, headers = headers, content_type = "text/plain; charset=utf-8")
+
 @overload
-async def get_raw_paste_by_id(app: MyAPI, uuid: str) -> HTTPResponse:
+async def get_raw_paste_by_id(app: MyAPI, request: Request, uuid: str) -> HTTPResponse | ResponseStream:
     "Get the raw content of a paste by its UUID."
 
 @overload
-async def get_raw_paste_by_id(app: MyAPI, uuid: str, filepos: int) -> HTTPResponse:
+async def get_raw_paste_by_id(app: MyAPI, request: Request, uuid: str, filepos: int) -> HTTPResponse | ResponseStream:
     "Get the raw content of a specific file in a paste."
 
-async def get_raw_paste_by_id(app: MyAPI, uuid: str, filepos: int = 0) -> HTTPResponse:
+async def get_raw_paste_by_id(app: MyAPI, request: Request, uuid: str, filepos: int = 0) -> HTTPResponse | ResponseStream:
     r"""
     Works the same as `_get_paste_by_id` but returns content
     as plain text instead of through JSON.
@@ -77,10 +556,27 @@ async def get_raw_paste_by_id(app: MyAPI, uuid: str, filepos: int = 0) -> HTTPRe
     print("I don't have a name.")
     ```
 
+    If the client accepts `deflate` or `gzip`, there's only one file
+    to send and the paste isn't cached, its stored compressed data is
+    sent as-is with a `Content-Encoding` instead of being inflated. Pastes with files
+    in the `FileStore` are streamed from it a chunk at a time.
+
+    Like `get_paste_by_id`, responses carry cache headers and
+    a `304` is sent if the client's copy is still current.
+
+    A single file can also be sent in part: a byte range from
+    its `Range` header (answered with a `206`), or some of its
+    lines with `?lines=a-b`, after its `[filename]` line. Parts
+    are never sent with a `Content-Encoding`.
+
     Parameters
     ----------
     app: `MyAPI`
         the app currently running.
+    request: `Request`
+        the request being responded to, used to check
+        which encodings are accepted, and for its
+        conditional headers.
     uuid: `str`
         the UUID of the paste to get.
     filepos: `int`
@@ -89,7 +585,7 @@ async def get_raw_paste_by_id(app: MyAPI, uuid: str, filepos: int = 0) -> HTTPRe
     
     Returns
     -------
-    `HTTPResponse`
+    `HTTPResponse | ResponseStream`
         the raw text retrieved from the database.
     
     Raises
@@ -107,36 +603,74 @@ async def get_raw_paste_by_id(app: MyAPI, uuid: str, filepos: int = 0) -> HTTPRe
     if filepos < 0:
         raise BadRequest("Invalid file position.")
 
-    # Specified - get specified file
+    lines = parse_lines(request)
+
+    if lines and not filepos:
+        raise BadRequest("'lines' needs a file position.")
+
+    info, cached = await lookup_paste(app, uuid)
+
+    if info is None:
+        raise NotFound("Resource not found.")
+
+    headers = cache_headers(app, info) | {"Vary": "Accept-Encoding"}
+
     if filepos:
-        async with app.ctx.pool.acquire() as conn:
-            req = await conn.execute(
-                """
-                SELECT filename, content FROM files
-                WHERE id = ? AND position = ?
-                """,
-                uuid, filepos
-            )
-            row = await req.fetchone()
-        
-        if not row:
+        headers["Accept-Ranges"] = "bytes"
+
+    if is_not_modified(request, info):
+        return not_modified(headers)
+
+    paste = cached
+
+    if paste is None:
+        # One query for the whole paste, whichever file is asked for.
+        generation = app.ctx.cache.generation
+        rows = await fetch_paste_rows(app, uuid)
+
+        if not rows or filepos > len(rows):
             raise NotFound("Resource not found.")
 
-        text = f"[{row["filename"]}]\n{decompress(row["content"]).decode()}"
-    
-    # Not specified - get all files
-    else:
-        async with app.ctx.pool.acquire() as conn:
-            req = await conn.execute("SELECT filename, content FROM files WHERE id = ?", uuid)
-            rows = await req.fetchall()
-        
-        if not rows:
+        # Updated since its validators were read, so the ones that match the files are sent.
+        if paste_info(rows[0]) != info:
+            info = paste_info(rows[0])
+            headers |= cache_headers(app, info)
+
+        # Part of a file is sent as it is, since ranges are counted in unencoded bytes.
+        partial = filepos and (lines or "Range" in request.headers)
+        encoding = None if partial else preferred_encoding(request)
+
+        if encoding:
+            response = get_encoded_raw_paste(app, rows[filepos - 1:filepos] if filepos else rows, filepos, encoding, headers)
+
+            if response:
+                return response
+
+        # Large files are streamed rather than held in memory (or cached).
+        if any(row["external"] for row in rows):
+            if not filepos:
+                return stream_raw_paste(app, rows, headers)
+
+            return await send_raw_file(app, request, info, rows[filepos - 1], lines, headers)
+
+        paste = await cache_paste(app, uuid, rows, generation)
+
+    # Specified - get specified file
+    if filepos:
+        # Positions are 1-indexed and contiguous,
+        # so they line up with the rendered list.
+        if filepos > len(paste.raw_files):
             raise NotFound("Resource not found.")
 
-        text = '\n\n***\n\n***'.join(                   # Separator
-            f"[{i}. {row["filename"] or "???"}]" '\n'   # Header
-            f"{decompress(row["content"]).decode()}"    # Text
-            for i, row in enumerate(rows, start = 1)
-        )
+        body = paste.raw_files[filepos - 1]
+
+        if lines:
+            header_size = paste.raw_header_sizes[filepos - 1]
+            body = body[:header_size] + b''.join(slice_lines([body[header_size:]], *lines))
 
-    return HTTPResponse(text)
\ No newline at end of file
+            return HTTPResponse(body, headers = headers, content_type = "text/plain; charset=utf-8")
+
+        return ranged_response(request, info, body, headers, "text/plain; charset=utf-8")
+    
+    # Not specified - get all files
+    return HTTPResponse(paste.raw, headers = headers, content_type = "text/plain; charset=utf-8")
\ No newline at end of file
@@ -0,0 +1,89 @@
+from sanic.exceptions import BadRequest
+from sanic.request import Request
+from sanic.response import HTTPResponse
+from sqlite3 import OperationalError
+from ._types import SearchResponse, SearchResult
+from utils import MyAPI
+
+def to_match_query(text: str) -> str:
+    """
+    Turn what was typed into an FTS5 query that matches files
+    with every word in it, quoting each word so punctuation
+    (as in tracebacks) is searched for rather than parsed.
+    """
+
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+async def search_pastes(app: MyAPI, request: Request) -> HTTPResponse:
+    """
+    Find the files whose name or content has every word in
+    the `q` query argument, best matches first.
+
+    Results come `Config.SEARCH_PAGE_SIZE` at a time, and `page`
+    (from 1) picks which. The index is kept up to date by the
+    background indexer, so a paste shows up a few seconds
+    after it's created or updated.
+
+    Parameters
+    ----------
+    app: `MyAPI`
+        the app currently running.
+    request: `Request`
+        the request being responded to, for its
+        `q` and `page` query arguments.
+
+    Returns
+    -------
+    `HTTPResponse`
+        the matching files, as a `SearchResponse`.
+
+    Raises
+    ------
+    `BadRequest`
+        the query is empty, or the page isn't valid.
+    """
+
+    query = to_match_query(request.args.get("q", ""))
+
+    if not query:
+        raise BadRequest("'q' must have at least one word to search for.")
+
+    try:
+        page = int(request.args.get("page", 1))
+    except ValueError:
+        raise BadRequest("'page' must be a number.")
+
+    if page < 1:
+        raise BadRequest("'page' cannot be less than one.")
+
+    page_size = app.ctx.configs.SEARCH_PAGE_SIZE
+
+    async with app.ctx.pool.acquire() as conn:
+        try:
+            # One extra row, to tell whether there's another page. The
+            # join leaves out files deleted since they were indexed.
+            req = await conn.execute(
+                """
+                SELECT files.id, files.position, files.filename FROM search_index
+                JOIN search_docs ON search_docs.docid = search_index.rowid
+                JOIN files ON files.id = search_docs.id AND files.position = search_docs.position
+                WHERE search_index MATCH ?
+                ORDER BY search_index.rank
+                LIMIT ? OFFSET ?
+                """,
+                query, page_size + 1, (page - 1) * page_size
+            )
+            rows = await req.fetchall()
+        except OperationalError:
+            raise BadRequest("Invalid search query.")
+
+    response = SearchResponse(
+        results = [
+            SearchResult(paste_id = row["id"], position = row["position"], filename = row["filename"])
+            for row in rows[:page_size]
+        ],
+        page = page,
+        next_page = page + 1 if len(rows) > page_size else None
+    )
+
+    return HTTPResponse(response.model_dump_json(), content_type = "application/json")
@@ -1,15 +1,31 @@
-from sanic.exceptions import NotFound, SanicException
-from ._types import UpdateRequest
+from database import paste_digest, transaction
+from sanic.exceptions import BadRequest, NotFound, SanicException
+from sanic.response import JSONResponse, json as to_json
+from ._blobs import insert_blobs, prepare_files, PreparedFile
+from ._types import FileEdit, UpdateRequest
+from time import time
+from typing import Any
 from utils import format_file_size, MyAPI
-from zlib import compress
 
-async def update_existing_paste(app: MyAPI, data: UpdateRequest) -> None:
+# What each position of a paste ends up holding: its filename, and
+# either the hash of a file it already had or brand new content.
+type Target = list[tuple[str | None, bytes | None, bytes | None]]
+
+async def update_existing_paste(app: MyAPI, data: UpdateRequest) -> JSONResponse:
     """
     Update an existing paste in the database.
 
     This uses a similar JSON document structure
     to the `/create/` endpoint, providing
-    intuitive usage.
+    intuitive usage. Instead of `files`, a list
+    of `edits` can be sent to change only some
+    of the files.
+
+    Either way, only the files that actually changed are
+    compressed and have their rows rewritten, so the cost
+    of an update follows the size of the edit rather than
+    the size of the paste. An update that changes nothing
+    writes nothing.
 
     Parameters
     ----------
@@ -17,6 +33,12 @@ async def update_existing_paste(app: MyAPI, data: UpdateRequest) -> None:
         the app currently running.
     data: `UpdateRequest`
         the data relevant to the operation.
+
+    Returns
+    -------
+    `JSONResponse`
+        a JSON document with the paste's version
+        after the update, as an `UpdateResponse`.
     
     Raises
     ------
@@ -25,20 +47,37 @@ async def update_existing_paste(app: MyAPI, data: UpdateRequest) -> None:
     `NotFound`
         the given paste ID could not
         be found in the database.
+    `SanicException`
+        409: `edits` were sent and the paste was
+        changed by another update in the meantime.
     """
-    
+
     async with app.ctx.pool.acquire() as conn:
-        req = await conn.execute("SELECT expiration, removal_id FROM pastes WHERE id = ?", data.id)
-        paste_data_row = await req.fetchone()
-    
-    if not paste_data_row:
-        raise NotFound(f"No paste was found with the ID '{data.id}'.")
+        req = await conn.execute("SELECT version FROM pastes WHERE id = ?", data.id)
+        paste = await req.fetchone()
 
-    args_for_database: list[tuple[str, str | None, bytes, int]] = []
+        if paste is None:
+            raise NotFound(f"No paste was found with the ID '{data.id}'.")
+
+        req = await conn.execute(
+            "SELECT filename, hash, size FROM files JOIN blobs USING (hash) WHERE id = ? ORDER BY position",
+            data.id
+        )
+        current = await req.fetchall()
+
+    if data.files is not None:
+        target: Target = [(filename, None, content.encode()) for filename, content in data.files]
+        expected_version = None
+    else:
+        target = apply_edits(current, data.edits) # type: ignore
+        # Edits only make sense against the files they were made to.
+        expected_version = paste["version"]
+
+    sizes = {row["hash"]: row["size"] for row in current}
     total_paste_size = 0
 
-    for i, (filename, content) in enumerate(data.files):
-        total_paste_size += len(content)
+    for i, (_, digest, content) in enumerate(target):
+        total_paste_size += sizes[digest] if content is None else len(content) # type: ignore
 
         # If the paste size exceeds what is required, return
         # a 422 (Unprocessable Entity) HTTP status code.
@@ -50,20 +89,125 @@ async def update_existing_paste(app: MyAPI, data: UpdateRequest) -> None:
                 
                 422
             )
-        
-        args_for_database.append((
-            data.id,
-            filename,
-            compress(content.encode()),
-            i + 1
-        ))
 
-    async with app.ctx.pool.acquire() as conn:
-        # Delete the existing files
-        await conn.execute("DELETE FROM files WHERE id = ?", data.id)
+    # Compressing happens here, before queueing for the write connection,
+    # and only for new content (which is skipped if it's already stored).
+    prepared = iter(await prepare_files(
+        app,
+        [(filename, content) for filename, _, content in target if content is not None]
+    ))
+
+    files: list[tuple[str | None, bytes, PreparedFile | None]] = []
+
+    for filename, digest, content in target:
+        if content is None:
+            files.append((filename, digest, None)) # type: ignore
+        else:
+            file = next(prepared)
+            files.append((filename, file.hash, file))
+
+    if [(filename, digest) for filename, digest, _ in files] == [(row["filename"], row["hash"]) for row in current]:
+        return to_json({"version": paste["version"]})
+
+    # Checking the paste exists and changing its files happen in one
+    # transaction, so it can't expire or be deleted partway through.
+    async with app.ctx.writer.acquire() as conn, transaction(conn):
+        # A new version and digest give the paste a new ETag.
+        req = await conn.execute(
+            """
+            UPDATE pastes SET version = version + 1, modified = ?, digest = ?
+            WHERE id = ? AND (? IS NULL OR version = ?)
+            RETURNING version
+            """,
+            int(time()), paste_digest((filename, digest) for filename, digest, _ in files),
+            data.id, expected_version, expected_version
+        )
+        paste_data_row = await req.fetchall()
+    
+        if not paste_data_row:
+            req = await conn.execute("SELECT 1 FROM pastes WHERE id = ?", data.id)
+
+            if await req.fetchone() is None:
+                raise NotFound(f"No paste was found with the ID '{data.id}'.")
+
+            raise SanicException("The paste was changed by another update. Fetch it again and retry.", 409)
+
+        # Read again here, since another update may have
+        # come in since they were read for the size check.
+        req = await conn.execute("SELECT position, filename, hash FROM files WHERE id = ?", data.id)
+        existing = {row["position"]: (row["filename"], row["hash"]) for row in await req.fetchall()}
+
+        changed = [
+            (position, filename, digest, file)
+            for position, (filename, digest, file) in enumerate(files, start = 1)
+            if existing.get(position) != (filename, digest)
+        ]
+
+        # Blobs first, so the rows below have something to point at.
+        await insert_blobs(app, conn, [file for *_, file in changed if file is not None])
+
+        await conn.executemany(
+            "UPDATE files SET filename = ?, hash = ? WHERE id = ? AND position = ?",
+            [(filename, digest, data.id, position) for position, filename, digest, _ in changed if position in existing]
+        )
 
-        # Add back the new files
         await conn.executemany(
-            "INSERT INTO files (id, filename, content, position) VALUES (?, ?, ?, ?)",
-            args_for_database
-        )
\ No newline at end of file
+            "INSERT INTO files (id, filename, position, hash) VALUES (?, ?, ?, ?)",
+            [(data.id, filename, position, digest) for position, filename, digest, _ in changed if position not in existing]
+        )
+
+        # Blobs only the removed or replaced files used
+        # are left for the garbage collector.
+        await conn.execute("DELETE FROM files WHERE id = ? AND position > ?", data.id, len(files))
+    
+    app.ctx.cache.invalidate(data.id)
+
+    return to_json({"version": paste_data_row[0]["version"]})
+
+def apply_edits(current: list[Any], edits: list[FileEdit]) -> Target:
+    """
+    Work out what a paste's files become after `edits`, applied
+    in order, keeping the hashes of the files left as they were.
+
+    Raises
+    ------
+    `BadRequest`
+        an edit is missing what it needs, or refers
+        to a position the paste doesn't have.
+    """
+
+    target: Target = [(row["filename"], row["hash"], None) for row in current]
+
+    for i, edit in enumerate(edits):
+        if edit.action == "append":
+            if edit.content is None:
+                raise BadRequest(f"Edit {i} ('append') needs 'content'.")
+
+            target.append((edit.filename, None, edit.content.encode()))
+            continue
+
+        # Positions are 1-indexed, as everywhere else.
+        if edit.position is None or not 1 <= edit.position <= len(target):
+            raise BadRequest(f"Edit {i} ('{edit.action}') needs a 'position' from 1 to {len(target)}.")
+
+        index = edit.position - 1
+        filename, digest, content = target[index]
+
+        match edit.action:
+            case "replace":
+                if edit.content is None:
+                    raise BadRequest(f"Edit {i} ('replace') needs 'content'.")
+
+                new_name = filename if edit.filename is None else edit.filename
+                target[index] = (new_name, None, edit.content.encode())
+
+            case "rename":
+                target[index] = (edit.filename, digest, content)
+
+            case "remove":
+                del target[index]
+
+    if not target:
+        raise BadRequest("A paste has to keep at least one file.")
+
+    return target
@@ -0,0 +1,322 @@
+"""
+A module for keeping large file contents on disk instead of in SQLite.
+
+Each blob over `Config.LARGE_FILE_THRESHOLD` is written to its own file,
+named by its hash, as a zlib stream - the same format `blobs.content`
+uses, so it can still be sent as a `Content-Encoding` or put into `.zip`
+downloads without inflating it. The database only keeps its metadata.
+
+Everything is compressed, read and inflated in fixed-size chunks, and
+reads go through `mmap`, so serving a large file never needs all of it
+in memory (or in SQLite's page cache).
+
+The stream is fully flushed after every chunk, and where each chunk starts
+is written to an index file beside it. A byte range can then be inflated
+starting from the chunk it falls in, rather than from the start.
+"""
+
+import os, struct
+from contextlib import contextmanager
+from mmap import mmap, ACCESS_READ
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO, Iterator
+from zlib import compressobj, decompressobj, MAX_WBITS, Z_FULL_FLUSH
+
+class ChunkedCompressor:
+    """
+    Compresses a zlib stream that's fully flushed after every `chunk_size`
+    bytes of input, so inflating can start at any chunk, and keeps track
+    of where in the output each chunk starts.
+    """
+
+    def __init__(self, chunk_size: int, level: int) -> None:
+        self.chunk_size = chunk_size
+        self.compressor = compressobj(level)
+
+        self.filled = 0
+        "How much of the current chunk has been given."
+
+        self.position = 0
+        "How many compressed bytes have been given out."
+
+        self.offsets: list[int] = []
+        "Where each chunk starts in the compressed stream."
+
+    def _output(self, compressed: bytes) -> bytes:
+        self.position += len(compressed)
+        return compressed
+
+    def compress(self, data: bytes | memoryview) -> bytes:
+        "Compress some more of the input."
+
+        out: list[bytes] = []
+        view = memoryview(data)
+
+        while view:
+            if self.filled == 0:
+                # Past the two-byte zlib header for the first chunk.
+                self.offsets.append(max(self.position, 2))
+
+            part = view[:self.chunk_size - self.filled]
+            view = view[len(part):]
+
+            out.append(self._output(self.compressor.compress(part)))
+            self.filled += len(part)
+
+            if self.filled == self.chunk_size:
+                out.append(self._output(self.compressor.flush(Z_FULL_FLUSH)))
+                self.filled = 0
+
+        return b''.join(out)
+
+    def flush(self) -> bytes:
+        "Finish the stream."
+
+        return self._output(self.compressor.flush())
+
+    def index(self) -> bytes:
+        "Get the index of chunk offsets, in the format `FileStore` reads."
+
+        return struct.pack(f"<Q{len(self.offsets)}Q", self.chunk_size, *self.offsets)
+
+class PendingFile:
+    """
+    A file being written into a `FileStore` before its hash is known,
+    under a temporary name until it's committed.
+    """
+
+    def __init__(self, store: 'FileStore', file: BinaryIO) -> None:
+        self.store = store
+        self.file = file
+
+        self.index: bytes | None = None
+        "The chunk index to write beside the file, once the stream is finished."
+
+    def write(self, compressed: bytes) -> None:
+        "Append some of the zlib stream."
+
+        self.file.write(compressed)
+
+    def commit(self, digest: bytes) -> None:
+        "Move the file into place as the blob with the given hash."
+
+        self.file.close()
+
+        path = self.store.path(digest)
+        path.parent.mkdir(exist_ok = True)
+
+        # The index goes first, so a file that's in place always has one.
+        if self.index is not None:
+            self.store.write_index(path, self.index)
+
+        os.replace(self.file.name, path)
+
+    def discard(self) -> None:
+        "Delete the file if it was never committed."
+
+        self.file.close()
+
+        Path(self.file.name).unlink(missing_ok = True)
+
+class FileStore:
+    "Keeps blobs as zlib streams in files under a directory, one per hash."
+
+    def __init__(self, root: str, chunk_size: int, level: int | None = None) -> None:
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+        self.level = -1 if level is None else level
+
+        self.root.mkdir(parents = True, exist_ok = True)
+
+    def path(self, digest: bytes) -> Path:
+        "Get where the blob with the given hash is kept."
+
+        name = digest.hex()
+
+        # Spread over 256 folders so none get too big to list.
+        return self.root / name[:2] / name
+
+    def exists(self, digest: bytes) -> bool:
+        "Check whether the blob with the given hash has been written."
+
+        return self.path(digest).exists()
+
+    def write(self, digest: bytes, data: bytes) -> None:
+        """
+        Compress `data` into the file for the given hash.
+
+        The file is written under a temporary name and then moved
+        into place, so readers never see a half-written one, and
+        two uploads of the same content can't corrupt each other.
+
+        Parameters
+        ----------
+        digest: `bytes`
+            the SHA-256 of `data`.
+        data: `bytes`
+            the uncompressed content.
+        """
+
+        path = self.path(digest)
+        path.parent.mkdir(exist_ok = True)
+
+        compressor = self.compressor()
+        view = memoryview(data)
+
+        with NamedTemporaryFile(dir = path.parent, delete = False) as f:
+            try:
+                for start in range(0, len(view), self.chunk_size):
+                    f.write(compressor.compress(view[start : start + self.chunk_size]))
+
+                f.write(compressor.flush())
+            except BaseException:
+                os.unlink(f.name)
+                raise
+
+        self.write_index(path, compressor.index())
+
+        os.replace(f.name, path)
+
+    def compressor(self) -> ChunkedCompressor:
+        "Make a compressor for content going into the store."
+
+        return ChunkedCompressor(self.chunk_size, self.level)
+
+    def write_index(self, path: Path, index: bytes) -> None:
+        "Write the chunk index for the blob at `path`."
+
+        with NamedTemporaryFile(dir = path.parent, delete = False) as f:
+            f.write(index)
+
+        os.replace(f.name, path.with_suffix(".idx"))
+
+    def read_index(self, digest: bytes) -> tuple[int, list[int]] | None:
+        """
+        Read the chunk index for the blob with the given hash.
+
+        Returns
+        -------
+        `tuple[int, list[int]] | None`
+            the chunk size it was written with and where each
+            chunk starts, or `None` for blobs written before
+            indexes were (which can only be read from the start).
+        """
+
+        try:
+            index = self.path(digest).with_suffix(".idx").read_bytes()
+        except FileNotFoundError:
+            return None
+
+        chunk_size, *offsets = struct.unpack(f"<{len(index) // 8}Q", index)
+
+        return chunk_size, offsets
+
+    def create(self) -> PendingFile:
+        "Start writing a file whose hash isn't known yet."
+
+        return PendingFile(self, NamedTemporaryFile(dir = self.root, prefix = "pending-", delete = False))
+
+    def delete(self, digest: bytes) -> None:
+        "Delete the file for the given hash, if it's there."
+
+        path = self.path(digest)
+
+        path.unlink(missing_ok = True)
+        path.with_suffix(".idx").unlink(missing_ok = True)
+
+    @contextmanager
+    def open(self, digest: bytes) -> Iterator[mmap]:
+        """
+        Memory-map the stored zlib stream for the given hash.
+
+        The map stays valid even if the blob is collected (and
+        its file deleted) while it's open.
+
+        Raises
+        ------
+        `FileNotFoundError`
+            there's no file for the given hash.
+        """
+
+        with open(self.path(digest), "rb") as f, mmap(f.fileno(), 0, access = ACCESS_READ) as mapped:
+            yield mapped
+
+    def slices(self, mapped: mmap, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        "Read part of a mapped file in chunks."
+
+        end = len(mapped) if end is None else end
+
+        for offset in range(start, end, self.chunk_size):
+            yield mapped[offset : min(offset + self.chunk_size, end)]
+
+    def inflate(self, mapped: mmap) -> Iterator[bytes]:
+        """
+        Inflate a mapped file in chunks, none of them bigger
+        than the chunk size however well the content compressed.
+        """
+
+        inflater = decompressobj()
+
+        for chunk in self.slices(mapped):
+            data = inflater.decompress(chunk, self.chunk_size)
+
+            while data:
+                yield data
+
+                data = inflater.decompress(inflater.unconsumed_tail, self.chunk_size)
+
+    def inflate_range(self, mapped: mmap, index: tuple[int, list[int]] | None, start: int, end: int) -> Iterator[bytes]:
+        """
+        Inflate bytes `start` to `end` (exclusive) of a mapped file's
+        content, in chunks, starting from the chunk `start` falls in.
+
+        Parameters
+        ----------
+        mapped: `mmap`
+            the mapped file, from `open`.
+        index: `tuple[int, list[int]] | None`
+            its index, from `read_index`. Without one, the
+            content is inflated from the start and skipped.
+        start: `int`
+            the first byte to send.
+        end: `int`
+            the byte to stop before.
+        """
+
+        # Nothing to send, which is all there is of an empty file.
+        if start >= end:
+            return
+
+        if index is None or not index[1]:
+            inflater = decompressobj()
+            position = 0
+            source = 0
+        else:
+            chunk_size, offsets = index
+            chunk = min(start // chunk_size, len(offsets) - 1)
+
+            # Each chunk starts on a full flush, so it inflates as raw deflate.
+            inflater = decompressobj(-MAX_WBITS)
+            position = chunk * chunk_size
+            source = offsets[chunk]
+
+        for piece in self.slices(mapped, source):
+            data = inflater.decompress(piece, self.chunk_size)
+
+            while data:
+                if position + len(data) > start:
+                    yield data[max(0, start - position) : end - position]
+
+                position += len(data)
+
+                if position >= end:
+                    return
+
+                data = inflater.decompress(inflater.unconsumed_tail, self.chunk_size)
+
+    def read(self, digest: bytes) -> bytes:
+        "Read and inflate the whole blob for the given hash."
+
+        with self.open(digest) as mapped:
+            return b''.join(self.inflate(mapped))
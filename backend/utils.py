@@ -1,20 +1,76 @@
 "A helper module to provide helper functions."
 
-from asqlite import Pool
-from asyncio import sleep
+from asyncio import Event, sleep, wait_for
+from cache import PasteCache
+from database import AUTO_VACUUM_INCREMENTAL, ReadPool, storage_stats, transaction, Writer
 from datetime import datetime as dt
-from discord.ext import tasks
+from limiter import RateLimiter
+from locks import FileLock
+from loops import Loop, loop
+from metrics import Metrics
+from paste._codecs import Codecs
 from sanic import Sanic
-from typing import overload
+from storage import FileStore
+from workers import WorkerPool
 
 # =================================================================================================
 
 class Config:
+    RATE_LIMITS_ENABLED = True
+    "A constant for whether the per-route rate limits are enforced."
+
+    RATE_LIMITS = {
+        "create": (6, 60),          # 10s per request
+        "create_batch": (2, 60),    # 30s per request
+        "get": (20, 60),            # 3s per request
+        "delete": (10, 60),         # 6s per request
+        "update": (3, 60),          # 20s per request
+        "download": (2, 60),        # 30s per request
+        "search": (10, 60)          # 6s per request
+    }
+    "A constant for each class of route's rate limit: how many requests a client can make at once, and over how many seconds they come back."
+
+    RATE_LIMIT_SLOTS = 65_536
+    "A constant for how many client buckets the rate limiter keeps, shared by every worker. Each takes 24 bytes."
+
+    DATABASE_PATH = "../entries/index.sql"
+    "A constant for where the SQLite database is, relative to the backend folder."
+
+    DATABASE_READER_COUNT = 5
+    "A constant for the number of read-only connections to keep open to the database."
+
+    DATABASE_WRITE_QUEUE_SIZE = 100
+    "A constant for the maximum number of writes that can be waiting for the write connection."
+
+    DATABASE_BUSY_TIMEOUT_IN_MS = 5_000
+    "A constant for how long a write waits for another worker's write to finish before failing."
+
+    DATABASE_MMAP_SIZE = 256_000_000 # 256 MB
+    "A constant for how many bytes of the database each connection may memory-map."
+
+    DATABASE_CACHE_SIZE_IN_KB = 16_000 # 16 MB
+    "A constant for the size of each connection's page cache, in kilobytes."
+
+    DATABASE_VACUUM_TO_CONVERT = False
+    "A constant for whether to `VACUUM` a database made before incremental vacuuming at startup, which switching it needs. This rewrites the whole file, so that start is slow."
+
+    VACUUM_PAGES_PER_STEP = 128
+    "A constant for how many free pages each incremental vacuum step gives back. Each step holds the write connection, so this keeps it to a few milliseconds."
+
+    VACUUM_MAX_STEPS = 50
+    "A constant for the most incremental vacuum steps taken each time the maintenance loop finds the database idle."
+
     MAX_ENTRIES = 100_000
     "A constant for the maximum number of entries the database should be able to take."
 
     MAX_PASTE_SIZE = 100_000 # 100 KB
-    "A constant for the maximum number of bytes each paste should have in total."
+    "A constant for the maximum number of bytes each paste should have in total. Set `LARGE_FILE_DIRECTORY` before raising this far."
+
+    MAX_BATCH_SIZE = 100
+    "A constant for the maximum number of pastes that can be fetched or created in one batch request."
+
+    MAX_BATCH_CONTENT_SIZE = 1_000_000 # 1 MB
+    "A constant for the maximum number of bytes all the pastes in one `/create/batch` request can have together."
 
     DEFAULT_EXPIRATION_IN_DAYS = 1
     "A constant for the number of days to keep a paste, by default."
@@ -25,9 +81,70 @@ class Config:
     REMOVAL_ID_LENGTH = 22
     "A constant for how long removal IDs in the database should be."
 
+    EXPIRY_BATCH_SIZE = 1_000
+    "A constant for the maximum number of expired pastes (or unreferenced blobs) to delete in one statement."
+
+    EXPIRY_MAX_SLEEP_IN_SECONDS = 60
+    "A constant for the longest the expiry loop sleeps before checking the database again."
+
+    COMPRESSION_CODEC = "zlib"
+    "A constant for the codec new files are compressed with: `zlib`, `zstd` or `brotli`."
+
+    COMPRESSION_LEVEL: int | None = None
+    "A constant for the level new files are compressed at, or `None` for the codec's default."
+
+    COMPRESSION_ZSTD_DICTIONARY: str | None = None
+    "A constant for the path to a trained `zstd` dictionary, if one should be used."
+
+    ZIP_PASSTHROUGH = True
+    "A constant for whether stored deflate data is written straight into `.zip` downloads instead of being recompressed."
+
+    LARGE_FILE_DIRECTORY: str | None = None
+    "A constant for where large file contents are kept on disk, relative to the backend folder, or `None` to keep everything in the database."
+
+    LARGE_FILE_THRESHOLD = 64_000 # 64 KB
+    "A constant for the size, in bytes, from which a file's content is kept on disk when `LARGE_FILE_DIRECTORY` is set."
+
+    LARGE_FILE_CHUNK_SIZE = 1_048_576 # 1 MiB
+    "A constant for how many bytes of a large file are compressed, read or inflated at a time."
+
+    LARGE_FILE_COMPRESSION_LEVEL: int | None = None
+    "A constant for the `zlib` level (-1 to 9) large files, and uploads streamed in while `LARGE_FILE_DIRECTORY` is set, are compressed at, or `None` for the default. Separate from `COMPRESSION_LEVEL`, since these are always `zlib`."
+
+    WORKER_POOL = "thread"
+    "A constant for where compression and archive building run: `thread`, `process` or `none` (on the event loop)."
+
+    WORKER_POOL_SIZE = 4
+    "A constant for the number of threads or processes in the worker pool."
+
+    WORKER_POOL_THRESHOLD = 32_000 # 32 KB
+    "A constant for the size, in bytes, from which work is sent to the worker pool instead of run inline."
+
+    CACHE_MAX_BYTES = 32_000_000 # 32 MB
+    "A constant for the maximum number of bytes of rendered pastes (their `/get/` and `/raw/` bodies) to keep cached in memory."
+
+    CACHE_TTL_IN_SECONDS = 300
+    "A constant for the number of seconds a paste is kept cached before it's read again from the database."
+
+    HTTP_CACHE_MAX_AGE_IN_SECONDS = 3_600 # 1 hour
+    "A constant for the longest `Cache-Control: max-age` sent for a paste, since updates change it before it expires."
+
+    SEARCH_INDEX_BATCH_SIZE = 100
+    "A constant for the maximum number of queued pastes the search indexer reads and indexes at a time."
+
+    SEARCH_PAGE_SIZE = 20
+    "A constant for the number of results on each page from `/search/`."
+
 class APIContext:
-    pool: Pool
+    pool: ReadPool
+    writer: Writer
     configs: type[Config]
+    cache: PasteCache
+    codecs: Codecs
+    metrics: Metrics
+    store: FileStore | None
+    workers: WorkerPool
+    limiter: RateLimiter | None
     loops: 'BackgroundLoops'
 
 class MyAPI(Sanic):
@@ -36,68 +153,414 @@ class MyAPI(Sanic):
 # =================================================================================================
 
 class BackgroundLoops:
+    """
+    The loops that run alongside the app.
+
+    With several Sanic workers, only the one holding the leader lock
+    runs the loops in `LEADER_LOOPS`, so pastes are expired (and blobs
+    collected) once. The others keep trying for it, and one takes over
+    within `elect_leader`'s interval if the leader dies. Every worker
+    runs the rest, like `sync_cache_in_background`.
+    """
+
+    LEADER_LOOPS = (
+        "delete_in_background",
+        "collect_garbage_in_background",
+        "resync_paste_count",
+        "index_in_background",
+        "vacuum_in_background",
+        "checkpoint_in_background",
+        "optimize_in_background"
+    )
+    "The names of the loops only the leader runs."
+
     def __init__(self, app: MyAPI) -> None:
         self.app = app
-    
-    @overload
-    async def sleep_until(self, timestamp: int | float, /) -> None:
-        "Returns a coroutine to let you sleep until a given `timestamp` is reached."
-    
-    @overload
-    async def sleep_until(self, datetime: dt, /) -> None:
-        "Returns a coroutine to let you sleep until a given `datetime` is reached."
 
-    async def sleep_until(self, _dt_or_ts: dt | int | float, /) -> None:
-        "Returns a coroutine to let you sleep until a given `datetime` or `timestamp` is reached."
+        self.next_expiration: int | None = None
+        "The earliest expiration timestamp the expiry loop is currently waiting on."
 
-        if isinstance(_dt_or_ts, dt):
-            time_asleep = _dt_or_ts.timestamp() - dt.now().timestamp()
-        elif isinstance(_dt_or_ts, (int, float)): # type: ignore
-            time_asleep = _dt_or_ts - dt.now().timestamp()
-        else:
-            raise TypeError("given argument is not an integer or datetime object.")
-        
-        await sleep(time_asleep)
+        self.expiration_changed = Event()
+        "An event set to wake the expiry loop before its current deadline."
+
+        self.leader = FileLock(f"{app.ctx.configs.DATABASE_PATH}-leader.lock")
+        "The lock held by whichever worker runs the `LEADER_LOOPS`."
+
+        self.last_change: int | None = None
+        "The `seq` of the last row read from `paste_changes`."
+
+        self.last_writes = 0
+        "How many writes the write connection had taken the last time the vacuum loop ran."
 
+        self.vacuumed_pages = 0
+        "How many free pages this worker has given back to the filesystem."
+    
     def start(self) -> None:
-        "Start all loops attached to this instance."
+        "Start all loops attached to this instance, apart from the leader's."
 
-        for attr_value in self.__dict__.values():
-            if isinstance(attr_value, tasks.Loop):
-                attr_value.start()
+        for name, attr_value in type(self).__dict__.items():
+            if isinstance(attr_value, Loop) and name not in self.LEADER_LOOPS:
+                getattr(self, name).start()
     
     def end(self) -> None:
-        "Cancel all loops attached to this instance."
+        "Cancel all loops attached to this instance and give up the leader lock."
 
-        for attr_value in self.__dict__.values():
-            if isinstance(attr_value, tasks.Loop):
-                attr_value.cancel()
-    
-    @tasks.loop(seconds = 1)
-    async def delete_in_background(self) -> None:
+        for name, attr_value in type(self).__dict__.items():
+            if isinstance(attr_value, Loop):
+                getattr(self, name).cancel()
+
+        self.leader.release()
+
+    @loop(seconds = 10)
+    async def elect_leader(self) -> None:
         """
-        Repeatedly sleep until an entry needs to
-        be deleted and then delete it.
+        Try to become the leader, and start the
+        `LEADER_LOOPS` (and stop trying) once this is.
+        """
+
+        if not self.leader.acquire(blocking = False):
+            return
+
+        for name in self.LEADER_LOOPS:
+            getattr(self, name).start()
+
+        self.elect_leader.stop()
+
+    @loop(seconds = 1)
+    async def sync_cache_in_background(self) -> None:
+        """
+        Drop pastes other workers updated or deleted from this
+        worker's cache, going by the `paste_changes` triggers.
         """
 
         async with self.app.ctx.pool.acquire() as conn:
+            if self.last_change is None:
+                # Anything from before this worker started can't be cached.
+                req = await conn.execute("SELECT COALESCE(MAX(seq), 0) AS 'seq' FROM paste_changes")
+                self.last_change = (await req.fetchone())["seq"]
+                return
+
             req = await conn.execute(
-                """
-                SELECT id, expiration FROM pastes
-                ORDER BY expiration
-                LIMIT 1
-                """
+                "SELECT seq, id FROM paste_changes WHERE seq > ? ORDER BY seq",
+                self.last_change
+            )
+            rows = await req.fetchall()
+
+        for row in rows:
+            self.app.ctx.cache.invalidate(row["id"])
+
+        if rows:
+            self.last_change = rows[-1]["seq"]
+    
+    def notify_expiration(self, expiration: int) -> None:
+        """
+        Let the expiry loop know a paste expiring at `expiration`
+        was added, waking it up if that's sooner than its deadline.
+        """
+
+        if self.next_expiration is None or expiration < self.next_expiration:
+            self.next_expiration = expiration
+            self.expiration_changed.set()
+
+    async def delete_expired(self) -> int:
+        """
+        Delete every paste that has expired, in batches of
+        `Config.EXPIRY_BATCH_SIZE`, and return how many went.
+        """
+
+        now = int(dt.now().timestamp())
+        batch_size = self.app.ctx.configs.EXPIRY_BATCH_SIZE
+        total_deleted = 0
+
+        while True:
+            async with self.app.ctx.writer.acquire() as conn:
+                req = await conn.execute(
+                    """
+                    DELETE FROM pastes
+                    WHERE id IN (
+                        SELECT id FROM pastes
+                        WHERE expiration <= ?
+                        LIMIT ?
+                    )
+                    RETURNING id
+                    """,
+                    now, batch_size
+                )
+                rows = await req.fetchall()
+
+            for row in rows:
+                self.app.ctx.cache.invalidate(row["id"])
+
+            total_deleted += len(rows)
+
+            if len(rows) < batch_size:
+                return total_deleted
+
+            # Let requests through between batches.
+            await sleep(0)
+
+    async def collect_garbage(self) -> int:
+        """
+        Delete every blob no file refers to any more, in batches
+        of `Config.EXPIRY_BATCH_SIZE`, and return how many went.
+        """
+
+        batch_size = self.app.ctx.configs.EXPIRY_BATCH_SIZE
+        total_deleted = 0
+
+        while True:
+            # A transaction, so other workers can't write until the files are gone too.
+            async with self.app.ctx.writer.acquire() as conn, transaction(conn):
+                # Found through the partial `blobs_unreferenced` index.
+                req = await conn.execute(
+                    """
+                    DELETE FROM blobs
+                    WHERE hash IN (
+                        SELECT hash FROM blobs
+                        WHERE refs = 0
+                        LIMIT ?
+                    )
+                    RETURNING hash, external
+                    """,
+                    batch_size
+                )
+                rows = await req.fetchall()
+
+                # Done before committing, so a new blob with
+                # the same content can't be written in between.
+                if self.app.ctx.store is not None:
+                    for row in rows:
+                        if row["external"]:
+                            self.app.ctx.store.delete(row["hash"])
+
+            total_deleted += len(rows)
+
+            if len(rows) < batch_size:
+                return total_deleted
+
+            # Let requests through between batches.
+            await sleep(0)
+
+    async def index_queued(self) -> int:
+        """
+        Bring the search index up to date with the pastes in
+        `search_queue`, in batches of `Config.SEARCH_INDEX_BATCH_SIZE`,
+        and return how many were reindexed.
+
+        A paste's files are read and decompressed on the read pool,
+        and its rows replaced in one write. A paste that's gone has
+        its rows removed. Anything queued while a batch is being
+        read has a later `seq`, so it's picked up next time.
+        """
+
+        batch_size = self.app.ctx.configs.SEARCH_INDEX_BATCH_SIZE
+        total_indexed = 0
+
+        while True:
+            async with self.app.ctx.pool.acquire() as conn:
+                req = await conn.execute("SELECT seq, id FROM search_queue ORDER BY seq LIMIT ?", batch_size)
+                queued = await req.fetchall()
+
+                if not queued:
+                    return total_indexed
+
+                ids = list(dict.fromkeys(row["id"] for row in queued))
+                marks = ", ".join("?" * len(ids))
+
+                req = await conn.execute(
+                    f"""
+                    SELECT id, position, filename, hash, content, size, codec, external FROM files JOIN blobs USING (hash)
+                    WHERE id IN ({marks})
+                    """,
+                    *ids
+                )
+                rows = await req.fetchall()
+
+            docs: list[tuple[str, int, str, str]] = []
+
+            for row in rows:
+                if row["external"]:
+                    # Unreadable without `LARGE_FILE_DIRECTORY`.
+                    if self.app.ctx.store is None:
+                        continue
+
+                    data = await self.app.ctx.workers.run(row["size"], self.app.ctx.store.read, row["hash"])
+                else:
+                    data = await self.app.ctx.codecs.decompress(row["codec"], row["content"])
+
+                docs.append((row["id"], row["position"], row["filename"] or "", data.decode("utf-8", "replace")))
+
+            async with self.app.ctx.writer.acquire() as conn, transaction(conn):
+                await conn.execute(
+                    f"DELETE FROM search_index WHERE rowid IN (SELECT docid FROM search_docs WHERE id IN ({marks}))",
+                    *ids
+                )
+                await conn.execute(f"DELETE FROM search_docs WHERE id IN ({marks})", *ids)
+
+                for paste_id, position, filename, content in docs:
+                    req = await conn.execute(
+                        "INSERT INTO search_docs (id, position) VALUES (?, ?) RETURNING docid",
+                        paste_id, position
+                    )
+                    docid = (await req.fetchall())[0]["docid"]
+
+                    await conn.execute(
+                        "INSERT INTO search_index (rowid, filename, content) VALUES (?, ?, ?)",
+                        docid, filename, content
+                    )
+
+                await conn.execute("DELETE FROM search_queue WHERE seq <= ?", queued[-1]["seq"])
+
+            total_indexed += len(ids)
+
+            # Let requests through between batches.
+            await sleep(0)
+
+    @loop(seconds = 2)
+    async def index_in_background(self) -> None:
+        """
+        Every couple of seconds, index the pastes created or
+        updated (and drop the ones deleted) since the last run,
+        so search never slows down the writes themselves.
+        """
+
+        await self.index_queued()
+
+    @loop(minutes = 1)
+    async def collect_garbage_in_background(self) -> None:
+        """
+        Every so often, delete the blobs left unreferenced
+        by pastes being updated or deleted.
+        """
+
+        await self.collect_garbage()
+
+        # Older changes can only be about cache entries that have expired anyway.
+        async with self.app.ctx.writer.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM paste_changes WHERE changed_at < CAST(strftime('%s', 'now') AS INT) - ?",
+                self.app.ctx.configs.CACHE_TTL_IN_SECONDS
             )
+
+    @loop(hours = 1)
+    async def resync_paste_count(self) -> None:
+        """
+        Every so often, recount the pastes to correct any drift
+        in the counter the `paste_count` triggers maintain.
+        """
+
+        async with self.app.ctx.writer.acquire() as conn:
+            await conn.execute("UPDATE paste_count SET count = (SELECT COUNT(*) FROM pastes)")
+
+    async def vacuum_step(self) -> int:
+        """
+        Give up to `Config.VACUUM_PAGES_PER_STEP` free pages back to
+        the filesystem, and return how many there were to give.
+        """
+
+        pages = self.app.ctx.configs.VACUUM_PAGES_PER_STEP
+
+        async with self.app.ctx.writer.acquire() as conn:
+            stats = await storage_stats(conn, self.app.ctx.configs.DATABASE_PATH)
+
+            # Does nothing until the database has been converted.
+            if not stats["free_pages"] or stats["auto_vacuum"] != AUTO_VACUUM_INCREMENTAL:
+                return 0
+
+            # Each page freed is a step of the statement, so every row has to be read.
+            req = await conn.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+            await req.fetchall()
+
+        freed = min(pages, stats["free_pages"])
+        self.vacuumed_pages += freed
+
+        return freed
+
+    @loop(seconds = 5)
+    async def vacuum_in_background(self) -> None:
+        """
+        Every few seconds, if nothing was written since the last
+        check, shrink the database file a bounded step at a time,
+        stopping as soon as a write comes in.
+        """
+
+        writer = self.app.ctx.writer
+        idle = writer.writes == self.last_writes
+
+        for _ in range(self.app.ctx.configs.VACUUM_MAX_STEPS if idle else 0):
+            if writer.queue_depth or not await self.vacuum_step():
+                break
+
+            # Let requests through between steps.
+            await sleep(0)
+
+        self.last_writes = writer.writes
+
+    @loop(minutes = 1)
+    async def checkpoint_in_background(self) -> None:
+        "Every minute, copy the WAL into the database and truncate it back to nothing."
+
+        configs = self.app.ctx.configs
+
+        async with self.app.ctx.writer.acquire() as conn:
+            # Gives up rather than wait for readers to finish, and tries again next time.
+            await conn.execute("PRAGMA busy_timeout = 0")
+
+            try:
+                req = await conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                await req.fetchall()
+            finally:
+                await conn.execute(f"PRAGMA busy_timeout = {int(configs.DATABASE_BUSY_TIMEOUT_IN_MS)}")
+
+    @loop(hours = 1)
+    async def optimize_in_background(self) -> None:
+        """
+        Every hour, refresh the query planner's statistics. Capped
+        by `analysis_limit`, so each table only samples a few rows.
+        """
+
+        async with self.app.ctx.writer.acquire() as conn:
+            await conn.execute("PRAGMA optimize")
+
+    @loop(seconds = 1)
+    async def delete_in_background(self) -> None:
+        """
+        Repeatedly sleep until the earliest paste expires
+        (or a sooner one is created) and then delete every
+        paste that has expired by then.
+
+        This never stops by itself, even if there's nothing
+        left to delete - it just checks back in later.
+        """
+
+        # Cleared before reading so a paste created
+        # mid-query still wakes us up afterwards.
+        self.expiration_changed.clear()
+
+        async with self.app.ctx.pool.acquire() as conn:
+            req = await conn.execute("SELECT MIN(expiration) AS 'expiration' FROM pastes")
             row = await req.fetchone()
         
-        if not row:
-            self.app.ctx.loops.delete_in_background.cancel()
-            return
-        
-        await self.sleep_until(row["expiration"])
+        self.next_expiration = row["expiration"]
+        max_sleep = self.app.ctx.configs.EXPIRY_MAX_SLEEP_IN_SECONDS
 
-        async with self.app.ctx.pool.acquire() as conn:
-            await conn.execute("DELETE FROM pastes WHERE id = ?", row["id"])
+        if self.next_expiration is None:
+            time_asleep = max_sleep
+        else:
+            time_asleep = min(max_sleep, self.next_expiration - dt.now().timestamp())
+
+        if time_asleep > 0:
+            try:
+                await wait_for(self.expiration_changed.wait(), time_asleep)
+
+                # Woken up early, so work out the new deadline.
+                return
+            except TimeoutError:
+                pass
+
+        if self.next_expiration is not None and self.next_expiration <= dt.now().timestamp():
+            if await self.delete_expired():
+                await self.collect_garbage()
 
 # =================================================================================================
 
@@ -0,0 +1,78 @@
+"""
+A module for running CPU-heavy work (compressing, decompressing and
+building archives) off the event loop, so one big paste doesn't hold
+up every other request on the worker.
+
+`zlib` releases the GIL while it works, so threads are usually
+enough. A process pool is there for codecs that don't.
+"""
+
+from asyncio import get_running_loop
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Callable
+
+class WorkerPool:
+    """
+    Runs functions in a thread or process pool, or inline
+    when the work is small enough that handing it off would
+    cost more than it saves.
+
+    `kind` is `thread`, `process` or `none` (to run everything
+    inline), and work of at least `threshold` bytes is sent to
+    the pool.
+    """
+
+    def __init__(self, kind: str, size: int, threshold: int) -> None:
+        self.kind = kind
+        self.threshold = threshold
+
+        self.inline = 0
+        "How many calls ran on the event loop."
+
+        self.offloaded = 0
+        "How many calls were sent to the pool."
+
+        self.executor: Executor | None
+
+        match kind:
+            case "thread":
+                self.executor = ThreadPoolExecutor(size, thread_name_prefix = "paste-worker")
+
+            case "process":
+                # Not forked, since the database connections run in threads.
+                self.executor = ProcessPoolExecutor(size, mp_context = get_context("spawn"))
+
+            case "none":
+                self.executor = None
+
+            case _:
+                raise ValueError(f"unknown worker pool '{kind}'.")
+
+    async def run[T](self, size: int, function: Callable[..., T], *args: Any) -> T:
+        """
+        Call `function(*args)`, in the pool if `size` is at least the
+        threshold. For a process pool, the function and its arguments
+        have to be picklable.
+        """
+
+        if self.executor is None or size < self.threshold:
+            self.inline += 1
+            return function(*args)
+
+        self.offloaded += 1
+        return await get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def close(self) -> None:
+        "Shut the pool down, without waiting for work that hasn't started."
+
+        if self.executor is not None:
+            self.executor.shutdown(wait = False, cancel_futures = True)
+
+    def stats(self) -> dict[str, int]:
+        "Get the counters for this pool."
+
+        return {
+            "inline": self.inline,
+            "offloaded": self.offloaded
+        }